@@ -0,0 +1,4 @@
+from .synthetic import generate
+from .suite import run_benchmarks, read_results, compare
+
+__all__ = ['generate', 'run_benchmarks', 'read_results', 'compare']
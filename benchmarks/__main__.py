@@ -0,0 +1,33 @@
+import argparse
+import os
+from .suite import compare, read_results, run_benchmarks
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the pipeline on synthetic MIMIC III like data')
+    parser.add_argument('--hpo', default='data/hp.obo', help='the HPO ontology the synthetic data uses')
+    parser.add_argument('--events', type=float, nargs='+', default=[1e3, 1e5],
+                        help='the numbers of labevents, from 1e3 to 1e8')
+    parser.add_argument('--directory', default='data/benchmark',
+                        help='where the synthetic data is generated')
+    parser.add_argument('--results', default='data/benchmark/results.jsonl',
+                        help='the file the results are appended to')
+    parser.add_argument('--workers', type=int, default=1, help='the workers of `add_hpo_information`')
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--compare', action='store_true',
+                        help='compares the results with the previous ones for the same number of events')
+    args = parser.parse_args()
+
+    for events in args.events:
+        previous = [result for result in read_results(args.results) if result['events'] == int(events)] \
+            if os.path.exists(args.results) else []
+        result = run_benchmarks(args.hpo, int(events), args.directory, args.results,
+                                args.workers, args.batch_size, args.seed)
+        if args.compare and previous:
+            compare(previous[-1], result)
+
+
+if __name__ == '__main__':
+    main()
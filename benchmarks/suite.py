@@ -0,0 +1,224 @@
+import contextlib
+import copy
+import datetime
+import json
+import os
+import platform
+import subprocess
+import threading
+import time
+from typing import Iterator, Optional
+import numpy as np
+import torch
+import torch.nn as nn
+import utils
+from utils import instrument
+import nn_data
+import nn_files
+from nn_files.training import split_dataset_type
+from .synthetic import generate
+
+STAGES = ['read_hpo_from_obo', 'read_hpo_from_obo compiled', 'add_hpo_information', 'LoadedData',
+          'HPODatasetCreator', 'ICDDatasetCreator', 'training epoch', 'inference']
+'the measured stages, in the order they are run'
+
+
+def run_benchmarks(
+    hpo_path: str,
+    events: int,
+    directory: str = 'data/benchmark',
+    results_path: Optional[str] = 'data/benchmark/results.jsonl',
+    workers: int = 1,
+    batch_size: int = 256,
+    seed: int = 0,
+) -> dict:
+    '''generates a synthetic dataset with `events` labevents (see `benchmarks.synthetic.generate`)
+    in `directory` and runs the `STAGES` of the pipeline on it.
+
+    For each stage the wall-clock time, the peak resident memory of the process and its increase
+    during the stage are measured. The memory is sampled every few milliseconds and only on Linux.
+    The results are appended as one json line to `results_path`, together with the commit and
+    the versions of the libraries, to compare them between commits (see `compare`).
+    The stages recorded by `utils.instrument` within the pipeline are stored as `details`.
+    '''
+    paths = generate(os.path.join(directory, f'events_{events}'), hpo_path, events, seed=seed)
+    labevents_hpo_path = os.path.join(os.path.dirname(paths['labevents']), 'LABEVENTS_hpo.csv')
+    for stale in [labevents_hpo_path, f'{labevents_hpo_path}.state.json']:
+        if os.path.exists(stale):
+            os.remove(stale)
+    stages: list[dict] = []
+    torch.manual_seed(seed)
+    # the instrumented parts of the pipeline are recorded in more detail
+    with instrument.recording() as recorder:
+        with _measure('read_hpo_from_obo', stages):
+            utils.read_hpo_from_obo(paths['hpo'], use_compiled=False)
+        # the compiled file is stored next to the generated `hp.obo`
+        utils.read_hpo_from_obo(paths['hpo'])
+        with _measure('read_hpo_from_obo compiled', stages):
+            utils.read_hpo_from_obo(paths['hpo'])
+        with _measure('add_hpo_information', stages):
+            utils.add_hpo_information(paths['labitems'], paths['labevents'], paths['annotations'],
+                                      labevents_hpo_path, workers=workers)
+        with _measure('LoadedData', stages):
+            data = nn_data.LoadedData(paths['hpo'], labevents_hpo_path, paths['diagnoses'])
+        with _measure('HPODatasetCreator', stages):
+            inputs = nn_data.HPODatasetCreator(data, 'labevents', enable_parent_nodes=True)
+        with _measure('ICDDatasetCreator', stages):
+            targets = nn_data.ICDDatasetCreator(data, batch=True)
+
+        input_size, target_size = len(inputs.feature_list), len(targets.feature_list)
+        model = nn_files.FCNModel(input_size, int(max(input_size, target_size) * 1.4), target_size, 1.4,
+                                  sparse_input=True)
+        dataset_split = nn_files.split_dataset(
+            batch_size, nn_data.CSRDataset(inputs, targets, sparse_inputs=True), seed=seed)
+        _warm_up(model, dataset_split)
+        with _measure('training epoch', stages):
+            nn_files.training(model, torch.device('cpu'), dataset_split, nn.CrossEntropyLoss(),
+                              torch.optim.Adam(model.parameters(), lr=1e-4), 1, verbose=False)
+
+        table = data.labevents_hpo
+        feature_sets = [table.features(i) for i in range(len(table))]
+        predictor = nn_files.Predictor.from_creators(model, inputs, targets, enable_parent_nodes=True)
+        with _measure('inference', stages):
+            for _ in predictor.iter_scores(feature_sets):
+                pass
+
+    result = {
+        'commit': _git('rev-parse', 'HEAD'),
+        'modified': bool(_git('status', '--porcelain', '--untracked-files=no')),
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'events': events,
+        'subjects': len(data.subject_ids),
+        'input_features': input_size,
+        'target_features': target_size,
+        'workers': workers,
+        'batch_size': batch_size,
+        'seed': seed,
+        'machine': {
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'threads': torch.get_num_threads(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'torch': torch.__version__,
+        },
+        'stages': stages,
+        'details': recorder.to_json(),
+    }
+    if results_path is not None:
+        directory = os.path.dirname(results_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(results_path, 'a') as f:
+            f.write(json.dumps(result) + '\n')
+    _print_stages(stages)
+    return result
+
+
+def read_results(results_path: str) -> list[dict]:
+    'returns the results appended to `results_path` by `run_benchmarks`, oldest first'
+    with open(results_path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare(before: dict, after: dict) -> dict[str, float]:
+    '''prints the time and memory of the stages of two results of `run_benchmarks`,
+    e.g. of two commits, and returns the ratio of the times (after / before) of each stage'''
+    assert before['events'] == after['events'], 'the results must have the same number of events'
+    print(f'{before["commit"] or "unknown"} -> {after["commit"] or "unknown"}, {after["events"]} events')
+    before_stages = {stage['name']: stage for stage in before['stages']}
+    ratios = {}
+    print(f'{"stage":<28}{"before s":>12}{"after s":>12}{"ratio":>8}{"before MB":>12}{"after MB":>12}')
+    for stage in after['stages']:
+        if stage['name'] not in before_stages:
+            continue
+        old = before_stages[stage['name']]
+        ratios[stage['name']] = stage['seconds'] / max(old['seconds'], 1e-9)
+        print(f'{stage["name"]:<28}{old["seconds"]:>12.3f}{stage["seconds"]:>12.3f}'
+              f'{ratios[stage["name"]]:>8.2f}{_mb(old["peak_rss_mb"]):>12}{_mb(stage["peak_rss_mb"]):>12}')
+    return ratios
+
+
+def _warm_up(model: nn.Module, dataset_split: split_dataset_type):
+    'trains a copy of `model` on one batch, the first calls of torch and its optimizers are slower'
+    model = copy.deepcopy(model)
+    optimizer = torch.optim.Adam(model.parameters())
+    inputs, targets = next(iter(dataset_split[0]))
+    nn.CrossEntropyLoss()(model(inputs), targets).backward()
+    optimizer.step()
+
+
+class _MemorySampler(threading.Thread):
+    'samples the resident memory of the process until `stop` is called'
+
+    def __init__(self, interval: float = 0.005):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.start_rss = _rss()
+        self.peak_rss = self.start_rss
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            rss = _rss()
+            if rss is not None and rss > self.peak_rss:
+                self.peak_rss = rss
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        rss = _rss()
+        if rss is not None and rss > self.peak_rss:
+            self.peak_rss = rss
+
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def _rss() -> Optional[int]:
+    'the resident memory of the process in bytes, `None` where `/proc` is not available'
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except OSError:
+        return None
+
+
+@contextlib.contextmanager
+def _measure(name: str, stages: list[dict]) -> Iterator[None]:
+    'appends the time and memory of the code in the `with` block to `stages`'
+    sampler = _MemorySampler()
+    sampler.start()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        sampler.stop()
+    memory_known = sampler.start_rss is not None
+    stages.append({
+        'name': name,
+        'seconds': seconds,
+        'peak_rss_mb': sampler.peak_rss / 2**20 if memory_known else None,
+        'rss_increase_mb': (sampler.peak_rss - sampler.start_rss) / 2**20 if memory_known else None,
+    })
+
+
+def _mb(value: Optional[float]) -> str:
+    return '-' if value is None else f'{value:.1f}'
+
+
+def _print_stages(stages: list[dict]):
+    print(f'{"stage":<28}{"seconds":>12}{"peak MB":>12}{"increase MB":>14}')
+    for stage in stages:
+        print(f'{stage["name"]:<28}{stage["seconds"]:>12.3f}'
+              f'{_mb(stage["peak_rss_mb"]):>12}{_mb(stage["rss_increase_mb"]):>14}')
+
+
+def _git(*args: str) -> Optional[str]:
+    'the output of a git command in the repository of this file, `None` if git is not available'
+    try:
+        return subprocess.run(['git', *args], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
@@ -0,0 +1,188 @@
+import os
+import shutil
+from typing import Optional
+import numpy as np
+import pandas as pd
+import tqdm
+import utils
+from utils.files import file_digest, read_json, write_json
+
+# The sizes of the generated data follow MIMIC III: about 600 labevents and 14 diagnoses
+# per subject, 750 lab items and 7000 ICD9 codes. The items and codes are chosen with
+# Zipf-like frequencies, a few of them make up most of the rows.
+
+EVENTS_PER_SUBJECT = 600
+DIAGNOSES_PER_SUBJECT = 14
+
+FILES = {
+    'hpo': 'hp.obo',
+    'labitems': 'D_LABITEMS.csv',
+    'annotations': 'loinc2hpo-annotations.tsv',
+    'labevents': 'LABEVENTS.csv',
+    'diagnoses': 'DIAGNOSES_ICD_hpo.csv',
+}
+'the generated files, by the names used in `generate`'
+
+_ORDINAL_VALUES = np.array(['NEG', 'POS', '0-', '1+', '2+', '3+'], dtype=object)
+_UNITS = np.array(['mg/dL', 'mEq/L', 'K/uL', 'g/dL', '%', 'IU/L', 'sec'])
+_FLAGS = np.array(['', 'abnormal', 'delta'], dtype=object)
+_FLAG_FREQUENCIES = [0.7, 0.27, 0.03]
+
+
+def generate(
+    directory: str,
+    hpo_path: str,
+    events: int,
+    subjects: Optional[int] = None,
+    items: int = 750,
+    icd_codes: int = 7000,
+    seed: int = 0,
+    chunksize: int = 1_000_000,
+) -> dict[str, str]:
+    '''writes a synthetic MIMIC III like dataset with `events` labevents to `directory`
+    and returns the paths of the `FILES`.
+
+    The labitems, loinc2hpo annotations and diagnoses use the HPO terms of the ontology at `hpo_path`
+    (e.g. the real `hp.obo`), which is copied to `directory`. By default there are `EVENTS_PER_SUBJECT`
+    labevents per subject. The labevents are sorted by subject and written in chunks of `chunksize`
+    rows, so the memory usage does not grow with `events`.
+
+    The data only depends on the parameters and the content of `hpo_path`. If `directory` contains
+    data generated with the same parameters, it is not generated again.
+    '''
+    if subjects is None:
+        subjects = max(10, events // EVENTS_PER_SUBJECT)
+    paths = {name: os.path.join(directory, file) for name, file in FILES.items()}
+    parameters = {'events': events, 'subjects': subjects, 'items': items, 'icd_codes': icd_codes,
+                  'seed': seed, 'hpo_digest': file_digest(hpo_path)}
+    state_path = os.path.join(directory, 'synthetic.json')
+    if read_json(state_path) == parameters and all(map(os.path.exists, paths.values())):
+        return paths
+
+    os.makedirs(directory, exist_ok=True)
+    if os.path.abspath(hpo_path) != os.path.abspath(paths['hpo']):
+        shutil.copyfile(hpo_path, paths['hpo'])
+    hpo = utils.read_hpo_from_obo(paths['hpo'], use_compiled=False)
+    hpo_ids = np.array([id for id in hpo.entries_by_id if id != hpo.root.id])
+
+    rng = np.random.default_rng(seed)
+    itemids, ordinal = _write_labitems(
+        rng, paths['labitems'], paths['annotations'], hpo_ids, items)
+    _write_labevents(rng, paths['labevents'], itemids,
+                     ordinal, events, subjects, chunksize)
+    _write_diagnoses(rng, paths['diagnoses'], hpo_ids,
+                     subjects, icd_codes, chunksize)
+    write_json(state_path, parameters)
+    return paths
+
+
+def _zipf(n: int) -> np.ndarray:
+    'frequencies of `n` values, proportional to 1 / rank'
+    frequencies = 1 / np.arange(1, n + 1)
+    return frequencies / frequencies.sum()
+
+
+def _write_labitems(rng: np.random.Generator, labitems_path: str, annotations_path: str,
+                    hpo_ids: np.ndarray, items: int) -> tuple[np.ndarray, np.ndarray]:
+    '''writes the labitems and the loinc2hpo annotations of their loinc codes.
+    Returns the itemids and whether their values are ordinal'''
+    itemids = 50800 + np.arange(items)
+    loinc_codes = np.array([f'{10000 + 7 * i}-{i % 10}' for i in range(items)])
+    has_loinc = rng.random(items) < 0.8
+    annotated = has_loinc & (rng.random(items) < 0.85)
+    ordinal = rng.random(items) < 0.15
+    pd.DataFrame({
+        'row_id': np.arange(1, items + 1),
+        'itemid': itemids,
+        'label': [f'Synthetic lab {i}' for i in range(items)],
+        'fluid': rng.choice(['Blood', 'Urine', 'Other Body Fluid'], items, p=[0.8, 0.15, 0.05]),
+        'category': rng.choice(['Chemistry', 'Hematology', 'Blood Gas'], items),
+        'loinc_code': np.where(has_loinc, loinc_codes, ''),
+    }).to_csv(labitems_path, index=False)
+
+    rows = []
+    for i in np.flatnonzero(annotated).tolist():
+        outcomes = ['NEG', 'POS'] if ordinal[i] else ['L', 'N', 'H']
+        scale = 'Ord' if ordinal[i] else 'Qn'
+        for outcome, hpo_id in zip(outcomes, rng.choice(hpo_ids, len(outcomes), replace=False)):
+            rows.append((loinc_codes[i], scale, outcome, hpo_id, 'false', ''))
+    pd.DataFrame(rows, columns=['loincId', 'loincScale', 'outcome', 'hpoTermId', 'isNegated', 'createdOn']
+                 ).to_csv(annotations_path, sep='\t', index=False)
+    return itemids, ordinal
+
+
+def _write_labevents(rng: np.random.Generator, path: str, itemids: np.ndarray, ordinal: np.ndarray,
+                     events: int, subjects: int, chunksize: int):
+    '''writes the labevents sorted by subject. The subjects have log-normally distributed numbers of
+    labevents, in total `events`. Each subject is in the hospital for up to 60 days.'''
+    ends = np.cumsum(rng.lognormal(0, 1, subjects))
+    ends = np.floor(ends / ends[-1] * events).astype(np.int64)
+    ends[-1] = events
+    first_day = rng.integers(0, 36500, subjects)
+    item_frequencies = _zipf(len(itemids))[rng.permutation(len(itemids))]
+
+    # formatting the values one by one is slow, the rows are joined from tables of strings instead
+    subject_ids = _strings(10000 + np.arange(subjects))
+    hadm_ids = _strings(100000 + np.arange(4 * subjects))
+    item_strings = _strings(itemids)
+    units = rng.choice(_UNITS, len(itemids)).astype(object)
+    days = np.datetime_as_string(np.datetime64('2100-01-01') + np.arange(36560)).astype(object)
+    times = np.array([f' {minute // 60:02d}:{minute % 60:02d}:00' for minute in range(1440)], dtype=object)
+    numbers = np.array([f'{tenths / 10:.1f}' for tenths in range(100_000)], dtype=object)
+
+    with open(path, 'w', newline='') as f:
+        f.write('row_id,subject_id,hadm_id,itemid,charttime,value,valuenum,valueuom,flag\n')
+        for start in tqdm.trange(0, events, chunksize, unit_scale=chunksize, desc='labevents'):
+            n = min(chunksize, events - start)
+            subject = np.searchsorted(ends, np.arange(start, start + n), side='right')
+            item = rng.choice(len(itemids), n, p=item_frequencies)
+            hadm_id = hadm_ids[4 * subject + rng.integers(0, 4, n)]
+            hadm_id[rng.random(n) < 0.1] = ''
+            charttime = days[first_day[subject] + rng.integers(0, 60, n)] + times[rng.integers(0, 1440, n)]
+            valuenum = numbers[np.minimum(np.round(rng.lognormal(2, 1, n) * 10).astype(np.int64), 99_999)]
+            value = valuenum.copy()
+            value[ordinal[item]] = rng.choice(_ORDINAL_VALUES, n)[ordinal[item]]
+            # a few values are free text, like 'GREATER THAN 10' in MIMIC
+            value[rng.random(n) < 0.01] = 'GREATER THAN 10'
+            valuenum[value != valuenum] = ''
+            columns = [map(str, range(start + 1, start + n + 1)), subject_ids[subject].tolist(), hadm_id.tolist(),
+                       item_strings[item].tolist(), charttime.tolist(), value.tolist(), valuenum.tolist(),
+                       units[item].tolist(), rng.choice(_FLAGS, n, p=_FLAG_FREQUENCIES).tolist()]
+            f.write('\n'.join(map(','.join, zip(*columns))))
+            f.write('\n')
+
+
+def _strings(values: np.ndarray) -> np.ndarray:
+    return np.array([str(value) for value in values.tolist()], dtype=object)
+
+
+def _write_diagnoses(rng: np.random.Generator, path: str, hpo_ids: np.ndarray,
+                     subjects: int, icd_codes: int, chunksize: int):
+    '''writes the diagnoses with their HPO features (like `data/DIAGNOSE_ICD_hpo.csv`).
+    Each ICD code has the same HPO features in all rows, most codes have none'''
+    codes = np.array([f'{i:04d}' if i < 6000 else f'V{i:04d}' for i in rng.permutation(10000)[:icd_codes]])
+    code_frequencies = _zipf(icd_codes)
+    code_features = np.array([
+        ';'.join(rng.choice(hpo_ids, rng.integers(1, 4), replace=False)) if rng.random() < 0.4 else ''
+        for _ in range(icd_codes)])
+    counts = 1 + rng.poisson(DIAGNOSES_PER_SUBJECT - 1, subjects)
+
+    row_id = 0
+    step = max(1, chunksize // DIAGNOSES_PER_SUBJECT)
+    with open(path, 'w', newline='') as f:
+        for start in range(0, subjects, step):
+            chunk_counts = counts[start:start + step]
+            subject = start + np.repeat(np.arange(len(chunk_counts)), chunk_counts)
+            n = len(subject)
+            seq_num = np.arange(n) - np.repeat(np.cumsum(chunk_counts) - chunk_counts, chunk_counts) + 1
+            code = rng.choice(icd_codes, n, p=code_frequencies)
+            pd.DataFrame({
+                'row_id': np.arange(row_id, row_id + n),
+                'subject_id': 10000 + subject,
+                'hadm_id': 100000 + 4 * subject + rng.integers(0, 4, n),
+                'seq_num': seq_num,
+                'icd9_code': codes[code],
+                'icd10_codes': '',
+                'hpo_features': code_features[code],
+            }).to_csv(f, header=start == 0, index=False)
+            row_id += n
@@ -1,7 +1,12 @@
 from .loader import LoadedData
 from .creator import HPODatasetCreator, ICDDatasetCreator, DatasetCreator
+from .similarity import SimilarityEngine
+from .dataset import CSRDataset, SparseInput
+from .cache import FeatureCache
+from .events import EventStore
 
 __all__ = [
     'LoadedData',
     'HPODatasetCreator', 'ICDDatasetCreator', 'DatasetCreator',
+    'SimilarityEngine', 'CSRDataset', 'SparseInput', 'FeatureCache', 'EventStore',
 ]
@@ -0,0 +1,189 @@
+import os
+from typing import Literal, Optional, Union
+import numpy as np
+import utils
+from utils.compact_hpo import CompactHPO
+from utils.compiled_hpo import decode_strings, encode_strings
+from utils.files import file_digest, read_json, string_digest, write_json
+from utils.hpo import HPO
+from .creator import DatasetCreator, HPODatasetCreator, ICDDatasetCreator
+from .loader import LoadedData
+
+# Each cached creator is stored as `<key>.npz` file of plain arrays, so it can be loaded without pickle:
+# - `subject_ids`: the subject of each row
+# - `feature_list`: the features, strings joined with line breaks and utf-8 encoded
+# - `indptr`, `indices`: the features of each subject as CSR structure, see `DatasetCreator`
+# The key is the digest of the input files, the loader and creator options and `CACHE_VERSION`.
+# The last access of an entry is its modification time, the least recently used entries are removed
+# once the cache grows beyond its size limit.
+
+CACHE_VERSION = 1
+'increased whenever the format of the cached files or the creation of the features changes'
+
+
+class FeatureCache:
+    '''Creates the `DatasetCreator`s of the HPO and the annotated labevents and diagnoses files,
+    like `HPODatasetCreator` and `ICDDatasetCreator`, and stores their features in `directory`.
+    As long as the input files and options stay the same, the features are loaded from there
+    and the files are not even parsed.
+
+    The input files are identified by the digest of their content. The digests are remembered
+    together with the size and modification time of each file, so unchanged files are not read again.
+    '''
+
+    def __init__(self, hpo_path: str, labevents_hpo_path: str, diagnoses_hpo_path: str,
+                 directory: str = 'data/feature_cache',
+                 max_bytes: int = 1 << 30,
+                 labevents_hpo_column_name: str = 'selected_hpo_features',
+                 diagnoses_hpo_column_name: str = 'hpo_features',
+                 diagnoses_icd_column_name: str = 'icd9_code',
+                 compact_hpo: bool = False,
+                 verbose: bool = False,
+                 ):
+        '''parameters:
+        - `directory`: where the features are stored
+        - `max_bytes`: size limit of the stored features, the least recently used are removed beyond it
+        - `verbose`: print each hit, miss and removed entry
+        - the other parameters are passed on to `LoadedData`
+        '''
+        self.hpo_path = hpo_path
+        self.labevents_hpo_path = labevents_hpo_path
+        self.diagnoses_hpo_path = diagnoses_hpo_path
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.compact_hpo = compact_hpo
+        self.verbose = verbose
+        self._column_names = (labevents_hpo_column_name,
+                              diagnoses_hpo_column_name, diagnoses_icd_column_name)
+        self.hits = 0
+        'number of creators loaded from the cache'
+        self.misses = 0
+        'number of creators that had to be created'
+        self.evictions = 0
+        'number of entries removed because the cache grew beyond `max_bytes`'
+        self._data: Optional[LoadedData] = None
+        self._hpo: Optional[Union[HPO, CompactHPO]] = None
+        self._input_digest: Optional[str] = None
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def data(self) -> LoadedData:
+        'the loaded input files, only loaded when needed'
+        if self._data is None:
+            self._data = LoadedData(self.hpo_path, self.labevents_hpo_path, self.diagnoses_hpo_path,
+                                    *self._column_names, compact_hpo=self.compact_hpo)
+            self._hpo = self._data.hpo
+        return self._data
+
+    @property
+    def hpo(self) -> Union[HPO, CompactHPO]:
+        'the HPO, loaded without the labevents and diagnoses'
+        if self._hpo is None:
+            self._hpo = utils.read_hpo_from_obo(
+                self.hpo_path, compact=self.compact_hpo)
+        return self._hpo
+
+    def hpo_creator(self, mode: Literal['labevents', 'diagnoses'],
+                    enable_parent_nodes: bool = False) -> DatasetCreator:
+        'the features of `HPODatasetCreator` with the given parameters'
+        return self._creator(
+            {'creator': 'hpo', 'mode': mode,
+                'enable_parent_nodes': enable_parent_nodes},
+            lambda: HPODatasetCreator(self.data, mode, enable_parent_nodes=enable_parent_nodes))
+
+    def icd_creator(self, batch: bool = False) -> DatasetCreator:
+        'the features of `ICDDatasetCreator` with the given parameters'
+        return self._creator({'creator': 'icd', 'batch': batch},
+                             lambda: ICDDatasetCreator(self.data, batch=batch))
+
+    def _creator(self, options: dict, create) -> DatasetCreator:
+        path = os.path.join(self.directory, f'{self._key(options)}.npz')
+        creator = self._load(path)
+        if creator is not None:
+            self.hits += 1
+            if self.verbose:
+                print(f'feature cache hit: {options}')
+            os.utime(path)  # marks the entry as recently used
+            return creator
+
+        self.misses += 1
+        if self.verbose:
+            print(f'feature cache miss: {options}')
+        creator = create()
+        tmp_path = f'{path}.tmp.npz'
+        np.savez(tmp_path,
+                 subject_ids=np.array(creator.subject_ids, dtype=np.int64),
+                 feature_list=encode_strings(creator.feature_list),
+                 indptr=creator.indptr, indices=creator.indices)
+        os.replace(tmp_path, path)
+        self._evict(keep=path)
+        return creator
+
+    def _load(self, path: str) -> Optional[DatasetCreator]:
+        try:
+            with np.load(path) as arrays:
+                subject_ids = arrays['subject_ids'].tolist()
+                feature_list = decode_strings(arrays['feature_list'])
+                indptr, indices = arrays['indptr'], arrays['indices']
+        except (OSError, KeyError, ValueError):
+            return None
+        return DatasetCreator.from_features(self.hpo, subject_ids, feature_list, indptr, indices)
+
+    def _key(self, options: dict) -> str:
+        if self._input_digest is None:
+            self._input_digest = string_digest(repr((
+                CACHE_VERSION,
+                [self._digest(path) for path in (
+                    self.hpo_path, self.labevents_hpo_path, self.diagnoses_hpo_path)],
+                self._column_names, self.compact_hpo,
+            )))
+        return string_digest(repr((self._input_digest, sorted(options.items()))))[:32]
+
+    def _digest(self, path: str) -> str:
+        'the digest of a file, or of all files of a directory (e.g. a columnar table)'
+        if not os.path.isdir(path):
+            return self._file_digest(path)
+        return string_digest(repr(
+            [(name, self._file_digest(os.path.join(path, name)))
+             for name in sorted(os.listdir(path)) if os.path.isfile(os.path.join(path, name))]))
+
+    def _file_digest(self, path: str) -> str:
+        'the digest of the file at `path`, remembered as long as its size and modification time stay the same'
+        digests_path = os.path.join(self.directory, 'digests.json')
+        digests = read_json(digests_path) or {}
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        known = digests.get(key)
+        if known is not None and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+            return known['digest']
+        digest = file_digest(path)
+        digests[key] = {'size': stat.st_size,
+                        'mtime_ns': stat.st_mtime_ns, 'digest': digest}
+        write_json(digests_path, digests)
+        return digest
+
+    def _evict(self, keep: Optional[str] = None):
+        'removes the least recently used entries until the cache is within `max_bytes`'
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.npz') and not name.endswith('.tmp.npz'):
+                stat = os.stat(path)
+                entries.append((stat.st_mtime_ns, stat.st_size, path))
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            os.remove(path)
+            size -= entry_size
+            self.evictions += 1
+            if self.verbose:
+                print(f'feature cache: removed {os.path.basename(path)}')
+
+    def clear(self):
+        'removes all cached features'
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz'):
+                os.remove(os.path.join(self.directory, name))
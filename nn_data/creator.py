@@ -1,37 +1,99 @@
-from typing import Iterable, Literal
-from utils.hpo import HPO
+from typing import Literal, Optional, Sequence
+import numpy as np
+import torch
+from utils import csr, instrument
+from .events import EventStore, Window
 from .loader import LoadedData
 
 
-def _one_hot_encoding(feature_list: list[str], features: set[str]) -> list[int]:
-    return [int(feature in features) for feature in feature_list]
-
-
-def _add_upwards_to_set(hpo: HPO, features: Iterable[str], s: set[str]):
-    'adds all parants of features to s'
-    for feature in features:
-        hpo.entries_by_id[feature].add_all_parents(s)
-
-
 class DatasetCreator:
     '''Creates data for model training based on an `LoadedData` object
+
+    The features of the subjects are stored as sparse matrix in CSR structure (see `utils.csr`):
+    row `i` belongs to subject `subject_ids[i]`, column `j` to feature `feature_list[j]`.
     '''
 
     def __init__(self, data: LoadedData):
         self.hpo = data.hpo
-        self._subjects: dict[int, set[str]] = {}
+        self.subject_ids: list[int] = data.subject_ids
+        'the subject of each row'
+        self._subject_index = data.subject_index
+        self.hadm_ids: Optional[list[int]] = None
+        'the admission of each row if the rows are admissions, see `HPODatasetCreator`'
         self.feature_list: list[str]
-        'for each subject a tuple (labevents, diagnoses)'
-
-    def _compute_feature_list(self):
-        all_present_features: set[str] = set()
-        for features in self._subjects.values():
-            all_present_features.update(features)
-        self.feature_list = [e for e in all_present_features]
+        'all features present in the data, sorted'
+        self.indptr: np.ndarray
+        self.indices: np.ndarray
+        'the positions in `feature_list` of the features of each subject as CSR structure'
+
+    @classmethod
+    def from_features(cls, hpo, subject_ids: list[int], feature_list: list[str],
+                      indptr: np.ndarray, indices: np.ndarray) -> 'DatasetCreator':
+        'creates a `DatasetCreator` from features created before, e.g. by `FeatureCache`'
+        creator = cls.__new__(cls)
+        creator.hpo = hpo
+        creator.subject_ids = subject_ids
+        creator._subject_index = {id: i for i, id in enumerate(subject_ids)}
+        creator.hadm_ids = None
+        creator.feature_list = feature_list
+        creator.indptr, creator.indices = indptr, indices
+        return creator
+
+    def _set_features(self, indptr: np.ndarray, indices: np.ndarray, names: list[str]):
+        '''sets the features of each subject from a CSR structure of positions in `names`.
+        Only the features present in the data end up in `feature_list`.
+        '''
+        present = csr.unique(indices).tolist()
+        self.feature_list = sorted({names[i] for i in present})
+        column = {feature: j for j, feature in enumerate(self.feature_list)}
+        columns = np.zeros(max(len(names), 1), dtype=np.int64)
+        columns[present] = [column[names[i]] for i in present]
+        self.indptr, self.indices = csr.from_pairs(
+            csr.row_ids(indptr), columns[indices], len(indptr) - 1, max(len(self.feature_list), 1))
+        instrument.count('subjects', len(self))
+        instrument.count('features', len(self.feature_list))
+        instrument.count('entries', len(self.indices))
+
+    def features(self, subject_id: int) -> set[str]:
+        'returns the features of the subject with id `subject_id`'
+        assert self.hadm_ids is None, 'the rows are admissions, use `row_features`'
+        return self.row_features(self._subject_index[subject_id])
+
+    def row_features(self, row: int) -> set[str]:
+        'returns the features of row `row`'
+        return {self.feature_list[j] for j in self.indices[self.indptr[row]:self.indptr[row + 1]].tolist()}
+
+    def for_subjects(self, subject_ids: list[int]) -> 'DatasetCreator':
+        '''returns a creator with the rows of the subjects with ids `subject_ids`, e.g. the targets
+        of the admission rows of another creator (its `subject_ids`)'''
+        assert self.hadm_ids is None, 'the rows are admissions'
+        rows = np.array([self._subject_index[id] for id in subject_ids], dtype=np.int64)
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.diff(self.indptr)[rows])
+        return DatasetCreator.from_features(
+            self.hpo, list(subject_ids), self.feature_list, indptr, csr.gather_rows(self.indptr, self.indices, rows))
+
+    def __len__(self) -> int:
+        return len(self.indptr) - 1
+
+    def sparse_data(self) -> torch.Tensor:
+        'data for model training as sparse CSR tensor'
+        return torch.sparse_csr_tensor(
+            torch.from_numpy(self.indptr), torch.from_numpy(
+                self.indices.astype(np.int64)),
+            torch.ones(len(self.indices)), size=(len(self), len(self.feature_list)),
+            check_invariants=False)
+
+    def dense(self, rows: Optional[Sequence[int]] = None) -> torch.Tensor:
+        'one-hot encoded features of the given `rows` (by default all) as dense tensor'
+        with instrument.timed('one_hot_seconds'):
+            rows = np.arange(len(self)) if rows is None else np.asarray(
+                rows, dtype=np.int64)
+            return torch.from_numpy(csr.to_dense(self.indptr, self.indices, rows, len(self.feature_list)))
 
     def data(self) -> list[list[int]]:
         'data for model training'
-        return [_one_hot_encoding(self.feature_list, features) for features in self._subjects.values()]
+        return self.dense().int().tolist()
 
     def combine(self, outputs: list[int], targets: list[int]):
         assert len(self.feature_list) == len(outputs) == len(targets)
@@ -45,27 +107,44 @@ class HPODatasetCreator(DatasetCreator):
     def __init__(self, data: LoadedData,
                  mode: Literal['labevents', 'diagnoses'],
                  enable_parent_nodes: bool = False,
+                 events: Optional[EventStore] = None,
+                 level: Literal['subject', 'admission'] = 'subject',
+                 window: Optional[Window] = None,
                  ):
         '''parameters:
         - `enable_parent_nodes`: activates all parent nodes in the inputs and outputs
+        - `events`: takes the labevents from an `EventStore` built from the same labevents,
+          which allows the `level` and `window` parameters
+        - `level`: one row per subject (in the order of `data.subject_ids`) or per admission,
+          `hadm_ids` is the admission of each row
+        - `window`: only uses the labevents within the hours `(start, end)` after the start of
+          each admission, e.g. `(0, 24)` for the first day
         '''
         super().__init__(data)
 
-        for subject_id, subject in data.subjects.items():
-            if mode == 'labevents':
-                activated_nodes: set[str] = subject.labevents_hpo.copy()
+        with instrument.stage('HPODatasetCreator', mode=mode, enable_parent_nodes=enable_parent_nodes,
+                              level=level, window=window):
+            if events is None:
+                assert level == 'subject' and window is None, 'admissions and windows need an `EventStore`'
+                table = data.labevents_hpo if mode == 'labevents' else data.diagnoses_hpo
             else:
-                activated_nodes: set[str] = subject.diagnoses_hpo.copy()
-
-            features = activated_nodes.copy()
+                assert mode == 'labevents', 'the `EventStore` contains the labevents'
+                assert events.hpo_ids == data.hpo_ids, 'the `EventStore` was built with another HPO'
+                table = events.features(level, data.subject_ids, window)
+                if level == 'admission':
+                    subject_ids, hadm_ids = events.rows(level, data.subject_ids)
+                    self.subject_ids, self.hadm_ids = subject_ids.tolist(), hadm_ids.tolist()
+                    self._subject_index = {}
+            indptr, indices = table.indptr, table.indices
             if enable_parent_nodes:
-                parents: set[str] = set()
-                _add_upwards_to_set(self.hpo, activated_nodes, parents)
-                features.update(parents)
-
-            self._subjects[subject_id] = features
-
-        self._compute_feature_list()
+                with instrument.timed('parent_nodes_seconds'):
+                    parent_indptr, parent_indices = self.hpo.ancestor_index.union_rows(
+                        indptr, indices)
+                    indptr, indices = csr.from_pairs(
+                        np.concatenate([csr.row_ids(indptr), csr.row_ids(parent_indptr)]),
+                        np.concatenate([indices, parent_indices]),
+                        len(table), len(table.names))
+            self._set_features(indptr, indices, table.names)
 
 
 class ICDDatasetCreator(DatasetCreator):
@@ -78,10 +157,12 @@ class ICDDatasetCreator(DatasetCreator):
         '''
         super().__init__(data)
 
-        for subject_id, subject in data.subjects.items():
-            features: set[str] = subject.diagnoses_icd.copy()
+        with instrument.stage('ICDDatasetCreator', batch=batch):
+            table = data.diagnoses_icd
+            names, indices = table.names, table.indices
             if batch:
-                features = {e[:3] for e in features}
-            self._subjects[subject_id] = features
-
-        self._compute_feature_list()
+                names = sorted({e[:3] for e in table.names})
+                position = {name: i for i, name in enumerate(names)}
+                indices = np.array([position[e[:3]] for e in table.names],
+                                   dtype=np.int64)[indices] if len(indices) else indices
+            self._set_features(table.indptr, indices, names)
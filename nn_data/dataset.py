@@ -0,0 +1,88 @@
+from typing import Union
+import numpy as np
+import torch
+from utils import csr
+from .creator import DatasetCreator
+
+
+class SparseInput:
+    '''a batch of multi-hot inputs given by their active columns, like the inputs of `nn.EmbeddingBag`:
+    the columns of sample `i` are `indices[offsets[i]:offsets[i+1]]`.
+    Layers like `nn_files.SparseLinear` process them at a cost that scales with the number of active columns.
+    '''
+
+    def __init__(self, indices: torch.Tensor, offsets: torch.Tensor, columns: int):
+        self.indices = indices
+        self.offsets = offsets
+        self.columns = columns
+        'the number of input features'
+
+    @classmethod
+    def from_csr(cls, indptr: np.ndarray, indices: np.ndarray, columns: int) -> 'SparseInput':
+        'creates the batch from a CSR structure without duplicates in the rows (see `utils.csr`)'
+        return cls(torch.from_numpy(indices.astype(np.int64)), torch.from_numpy(indptr.astype(np.int64)), columns)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def to(self, device: torch.device, non_blocking: bool = False) -> 'SparseInput':
+        return SparseInput(self.indices.to(device, non_blocking=non_blocking),
+                           self.offsets.to(device, non_blocking=non_blocking), self.columns)
+
+    def pin_memory(self) -> 'SparseInput':
+        'used by `torch.utils.data.DataLoader` with `pin_memory`'
+        return SparseInput(self.indices.pin_memory(), self.offsets.pin_memory(), self.columns)
+
+    def dense(self) -> torch.Tensor:
+        'the one-hot encoded inputs as dense tensor'
+        result = torch.zeros((len(self), self.columns),
+                             device=self.indices.device)
+        rows = torch.repeat_interleave(torch.arange(len(self), device=self.indices.device),
+                                       torch.diff(self.offsets))
+        result[rows, self.indices] = 1
+        return result
+
+
+class CSRDataset(torch.utils.data.Dataset):
+    '''Dataset of the inputs and targets of two `DatasetCreator`s created from the same `LoadedData`.
+
+    The features stay sparse, only the rows of the requested samples are converted to dense tensors.
+    With `sparse_inputs` the inputs are not converted: a sample is the tensor of the active input
+    columns and `collate` combines them into a `SparseInput`.
+    '''
+
+    def __init__(self, inputs: DatasetCreator, targets: DatasetCreator, sparse_inputs: bool = False):
+        assert inputs.subject_ids == targets.subject_ids, \
+            'the inputs and targets must contain the same subjects in the same order'
+        self.inputs = inputs
+        self.targets = targets
+        self.sparse_inputs = sparse_inputs
+
+    def __len__(self) -> int:
+        return len(self.inputs)
+
+    def __getitem__(self, index: int) -> tuple[torch.Tensor, torch.Tensor]:
+        return self.__getitems__([index])[0]
+
+    def __getitems__(self, indices: list[int]) -> list[tuple[torch.Tensor, torch.Tensor]]:
+        'converts all samples of a batch at once (used by `torch.utils.data.DataLoader`)'
+        targets = self.targets.dense(indices)
+        if not self.sparse_inputs:
+            return list(zip(self.inputs.dense(indices), targets))
+        rows = np.asarray(indices, dtype=np.int64)
+        columns = csr.gather_rows(
+            self.inputs.indptr, self.inputs.indices, rows).astype(np.int64)
+        splits = np.cumsum(np.diff(self.inputs.indptr)[rows])[:-1]
+        return list(zip(map(torch.from_numpy, np.split(columns, splits)), targets))
+
+    def collate(self, batch: list[tuple[torch.Tensor, torch.Tensor]]
+                ) -> tuple[Union[torch.Tensor, SparseInput], torch.Tensor]:
+        'combines the samples to a batch, to be used as `collate_fn` of a `torch.utils.data.DataLoader`'
+        if not self.sparse_inputs:
+            return torch.utils.data.default_collate(batch)
+        offsets = torch.zeros(len(batch) + 1, dtype=torch.int64)
+        offsets[1:] = torch.cumsum(torch.tensor(
+            [len(columns) for columns, _ in batch], dtype=torch.int64), 0)
+        indices = torch.cat([columns for columns, _ in batch]) if batch else torch.zeros(0, dtype=torch.int64)
+        return (SparseInput(indices, offsets, len(self.inputs.feature_list)),
+                torch.stack([target for _, target in batch]))
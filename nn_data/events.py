@@ -0,0 +1,256 @@
+from typing import Iterator, Literal, Optional, Sequence, Union
+import numpy as np
+import pandas as pd
+from utils import csr, instrument
+from utils.columnar import MISSING_INTEGER, ColumnarTable, is_columnar
+from utils.compact_hpo import CompactHPO
+from utils.compiled_hpo import decode_strings, encode_strings
+from utils.hpo import HPO
+from .loader import FeatureTable
+
+# The labevents are sorted by subject, admission and time and indexed in three levels:
+# - `subject_ids` (sorted): the admissions of subject `i` are `subject_indptr[i]:subject_indptr[i+1]`
+# - `hadm_ids` (sorted within each subject): the labevents of admission `j` are
+#   `admission_indptr[j]:admission_indptr[j+1]`, sorted by time. Labevents without admission are
+#   grouped as admission `MISSING_INTEGER` of their subject
+# - `times`: the charttime of each labevent in seconds since 1970
+# The features of labevent `k` are the HPO positions `value_indices[value_indptr[c]:value_indptr[c+1]]`
+# of its value `c = codes[k]`: each distinct `;` separated value is stored once.
+# Only the labevents with features are stored, `admission_starts` is the first labevent of each
+# admission including the ones without features.
+
+EVENT_STORE_VERSION = 1
+'increased whenever the format of the saved event stores changes'
+
+Window = tuple[float, float]
+'the hours `(start, end)` after the start of an admission, the start included and the end excluded'
+
+
+class EventStore:
+    '''the annotated labevents with their subject, admission (`hadm_id`), time and HPO features,
+    indexed so the labevents of a subject, an admission or a time window of an admission are a
+    range of rows found by binary search.
+
+    The HPO features are positions in `hpo_ids`, like in `LoadedData`.
+    Build it with `EventStore.build` and store it with `save`, loading it is much faster.
+    '''
+
+    def __init__(self, hpo_ids: list[str], subject_ids: np.ndarray, subject_indptr: np.ndarray,
+                 hadm_ids: np.ndarray, admission_starts: np.ndarray, admission_indptr: np.ndarray,
+                 times: np.ndarray, codes: np.ndarray, value_indptr: np.ndarray, value_indices: np.ndarray):
+        self.hpo_ids = hpo_ids
+        self.subject_ids = subject_ids
+        self.subject_indptr = subject_indptr
+        'the admissions of each subject'
+        self.hadm_ids = hadm_ids
+        'the `hadm_id` of each admission'
+        self.admission_starts = admission_starts
+        'the time of the first labevent of each admission'
+        self.admission_indptr = admission_indptr
+        'the labevents of each admission'
+        self.times = times
+        self.codes = codes
+        'the value of each labevent'
+        self.value_indptr = value_indptr
+        self.value_indices = value_indices
+        'the HPO positions of each value as CSR structure'
+        self._window_keys: Optional[tuple[np.ndarray, int]] = None
+
+    @classmethod
+    def build(cls, hpo: Union[HPO, CompactHPO], labevents_hpo_path: str,
+              labevents_hpo_column_name: str = 'selected_hpo_features',
+              chunksize: int = 1_000_000) -> 'EventStore':
+        '''reads the annotated labevents (a csv file or a columnar table, see `utils.columnar`)
+        in chunks of `chunksize` rows. Only the needed columns are read.'''
+        hpo_ids = list(hpo.entries_by_id)
+        position = {id: i for i, id in enumerate(hpo_ids)}
+        hpo_position = {id: position[proper_id] for id, proper_id in hpo.proper_id.items()}
+
+        dictionary: dict[str, int] = {}
+        'maps the values to their codes, in order of their first appearance'
+        subjects, hadms, times, codes, firsts = [], [], [], [], []
+        with instrument.stage('build event store', path=labevents_hpo_path):
+            for chunk_subjects, chunk_hadms, chunk_times, chunk_codes, uniques in _read_events(
+                    labevents_hpo_path, labevents_hpo_column_name, chunksize):
+                instrument.count('rows', len(chunk_subjects))
+                firsts.append(pd.DataFrame({'subject': chunk_subjects, 'hadm': chunk_hadms, 'time': chunk_times})
+                              .groupby(['subject', 'hadm'], sort=False).time.min())
+                mapping = np.array([dictionary.setdefault(value, len(dictionary)) for value in uniques],
+                                   dtype=np.int32)
+                # labevents without features are only needed for the admission starts
+                keep = (np.asarray(uniques, dtype=object) != '')[chunk_codes]
+                subjects.append(chunk_subjects[keep])
+                hadms.append(chunk_hadms[keep])
+                times.append(chunk_times[keep])
+                codes.append(mapping[chunk_codes[keep]])
+
+            subjects, hadms, times, codes = (
+                np.concatenate(arrays) if arrays else np.empty(0, dtype=dtype)
+                for arrays, dtype in [(subjects, np.int64), (hadms, np.int64), (times, np.int64), (codes, np.int32)])
+            order = np.lexsort((times, hadms, subjects))
+            subjects, hadms, times, codes = subjects[order], hadms[order], times[order], codes[order]
+
+            starts = pd.concat(firsts).groupby(level=[0, 1]).min() if firsts else \
+                pd.Series([], index=pd.MultiIndex.from_arrays([[], []]), dtype=np.int64)
+            admission_subjects = starts.index.get_level_values(0).to_numpy(np.int64)
+            admissions = starts.index.get_indexer(pd.MultiIndex.from_arrays([subjects, hadms]))
+            admission_indptr = np.zeros(len(starts) + 1, dtype=np.int64)
+            admission_indptr[1:] = np.cumsum(np.bincount(admissions, minlength=len(starts)))
+            subject_ids, subject_counts = np.unique(admission_subjects, return_counts=True)
+            subject_indptr = np.zeros(len(subject_ids) + 1, dtype=np.int64)
+            subject_indptr[1:] = np.cumsum(subject_counts)
+
+            # each distinct value is split only once
+            value_indptr, value_indices = csr.from_lists(
+                [[hpo_position[e] for e in value.split(';') if e != ''] for value in dictionary])
+            instrument.count('events', len(times))
+            instrument.count('admissions', len(starts))
+
+        return cls(hpo_ids, subject_ids, subject_indptr,
+                   starts.index.get_level_values(1).to_numpy(np.int64), starts.to_numpy(np.int64),
+                   admission_indptr, times, codes, value_indptr, value_indices)
+
+    def save(self, path: str):
+        'stores the event store as `.npz` file of plain arrays'
+        np.savez(path, version=np.array(EVENT_STORE_VERSION), hpo_ids=encode_strings(self.hpo_ids),
+                 subject_ids=self.subject_ids, subject_indptr=self.subject_indptr, hadm_ids=self.hadm_ids,
+                 admission_starts=self.admission_starts, admission_indptr=self.admission_indptr,
+                 times=self.times, codes=self.codes, value_indptr=self.value_indptr,
+                 value_indices=self.value_indices)
+
+    @classmethod
+    def load(cls, path: str) -> 'EventStore':
+        'loads an event store stored with `save`'
+        with np.load(path) as arrays:
+            assert arrays['version'] == EVENT_STORE_VERSION, \
+                f'{path} is an event store of version {arrays["version"]}, expected {EVENT_STORE_VERSION}'
+            return cls(decode_strings(arrays['hpo_ids']), *(arrays[name] for name in [
+                'subject_ids', 'subject_indptr', 'hadm_ids', 'admission_starts', 'admission_indptr',
+                'times', 'codes', 'value_indptr', 'value_indices']))
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    def admissions(self, subject_id: int) -> range:
+        'returns the positions of the admissions of the subject with id `subject_id`'
+        i = np.searchsorted(self.subject_ids, subject_id)
+        if i == len(self.subject_ids) or self.subject_ids[i] != subject_id:
+            return range(0)
+        return range(self.subject_indptr[i], self.subject_indptr[i + 1])
+
+    def event_range(self, admission: int, window: Optional[Window] = None) -> range:
+        'returns the positions of the labevents of the `admission` (a position), within the `window`'
+        starts, ends = self._event_ranges(np.array([admission]), window)
+        return range(starts[0], ends[0])
+
+    def rows(self, level: Literal['subject', 'admission'] = 'subject',
+             subject_ids: Optional[Sequence[int]] = None) -> tuple[np.ndarray, np.ndarray]:
+        '''returns the subject id and the `hadm_id` of each row of `features`,
+        the `hadm_id`s of subject rows are `MISSING_INTEGER`'''
+        admissions, rows, n_rows = self._select(level, subject_ids, None)
+        if level == 'subject':
+            subjects = self.subject_ids if subject_ids is None else np.asarray(subject_ids, dtype=np.int64)
+            return subjects, np.full(n_rows, MISSING_INTEGER, dtype=np.int64)
+        return np.repeat(self.subject_ids, np.diff(self.subject_indptr))[admissions], self.hadm_ids[admissions]
+
+    def features(self, level: Literal['subject', 'admission'] = 'subject',
+                 subject_ids: Optional[Sequence[int]] = None, window: Optional[Window] = None) -> FeatureTable:
+        '''returns the features of each subject (in the order of `subject_ids`, by default all subjects
+        of the store) or of each of their admissions, see `rows`.
+
+        With a `window` only the labevents within the window of each admission are used, and the
+        labevents without admission are left out. The labevents of each admission are found by
+        binary search, the other labevents are not touched.
+        '''
+        with instrument.stage('event store features', level=level, window=window):
+            admissions, rows, n_rows = self._select(level, subject_ids, window)
+            starts, ends = self._event_ranges(admissions, window)
+            events = csr.ranges(starts, ends)
+            codes = self.codes[events]
+            lengths = np.diff(self.value_indptr)[codes]
+            indptr, indices = csr.from_pairs(
+                np.repeat(np.repeat(rows, ends - starts), lengths),
+                csr.gather_rows(self.value_indptr, self.value_indices, codes),
+                n_rows, max(len(self.hpo_ids), 1))
+            instrument.count('rows', len(events))
+        return FeatureTable(indptr, indices, self.hpo_ids)
+
+    def _select(self, level: Literal['subject', 'admission'], subject_ids: Optional[Sequence[int]],
+                window: Optional[Window]) -> tuple[np.ndarray, np.ndarray, int]:
+        'returns the positions of the used admissions, the row of each of them and the number of rows'
+        assert level in ('subject', 'admission'), f'unknown level {level}'
+        if subject_ids is None:
+            subjects = np.arange(len(self.subject_ids))
+        else:
+            subject_ids = np.asarray(subject_ids, dtype=np.int64)
+            subjects = np.searchsorted(self.subject_ids, subject_ids)
+            found = subjects < len(self.subject_ids)
+            found[found] = self.subject_ids[subjects[found]] == subject_ids[found]
+            # subjects without labevents have no admissions
+            subjects = np.where(found, subjects, len(self.subject_ids))
+        subject_indptr = np.append(self.subject_indptr, self.subject_indptr[-1])
+        starts, ends = subject_indptr[subjects], subject_indptr[subjects + 1]
+        admissions = csr.ranges(starts, ends)
+        rows = np.repeat(np.arange(len(subjects)), ends - starts)
+        if level == 'admission' or window is not None:
+            # labevents without admission have no admission start
+            kept = self.hadm_ids[admissions] != MISSING_INTEGER
+            admissions, rows = admissions[kept], rows[kept]
+        if level == 'admission':
+            return admissions, np.arange(len(admissions)), len(admissions)
+        return admissions, rows, len(subjects)
+
+    def _event_ranges(self, admissions: np.ndarray, window: Optional[Window]) -> tuple[np.ndarray, np.ndarray]:
+        'returns the start and end positions of the labevents of the `admissions`, within the `window`'
+        starts, ends = self.admission_indptr[admissions], self.admission_indptr[admissions + 1]
+        if window is None:
+            return starts, ends
+        # the labevents are sorted by admission and their time since the admission start,
+        # so the windows of all admissions are found at once by binary search
+        keys, span = self._keys()
+        lower, upper = (np.clip(int(hours * 3600), 0, span) for hours in window)
+        return (np.searchsorted(keys, admissions * span + lower),
+                np.searchsorted(keys, admissions * span + max(lower, upper)))
+
+    def _keys(self) -> tuple[np.ndarray, int]:
+        '''`admission * span + seconds since the admission start` of each labevent (sorted) and `span`,
+        which is larger than the seconds since the admission start of all labevents'''
+        if self._window_keys is None:
+            admissions = csr.row_ids(self.admission_indptr)
+            offsets = self.times - self.admission_starts[admissions]
+            span = int(offsets.max()) + 1 if len(offsets) else 1
+            self._window_keys = admissions * span + offsets, span
+        return self._window_keys
+
+
+def _read_events(path: str, column: str, chunksize: int
+                 ) -> Iterator[tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, Sequence[str]]]:
+    '''yields the subject ids, `hadm_id`s (`MISSING_INTEGER` if missing), times and the codes of the
+    values of `column` of each chunk together with the values'''
+    if is_columnar(path):
+        table = ColumnarTable(path)
+        uniques = table.dictionary(column)
+        # each distinct time is parsed once
+        seconds = _seconds(table.dictionary('charttime'))
+        for start in range(0, len(table), chunksize):
+            stop = start + chunksize
+            yield (np.asarray(table.integers('subject_id')[start:stop]),
+                   np.asarray(table.integers('hadm_id')[start:stop]),
+                   seconds[table.codes('charttime')[start:stop]],
+                   np.asarray(table.codes(column)[start:stop]), uniques)
+    else:
+        with pd.read_csv(path, usecols=['subject_id', 'hadm_id', 'charttime', column], chunksize=chunksize,
+                         dtype={'charttime': str, column: str}) as reader:
+            for chunk in reader:
+                time_codes, times = pd.factorize(chunk.charttime)
+                codes, uniques = pd.factorize(chunk[column].fillna(''))
+                yield (chunk.subject_id.to_numpy(np.int64),
+                       chunk.hadm_id.fillna(MISSING_INTEGER).to_numpy(np.int64),
+                       _seconds(times)[time_codes], codes, uniques)
+
+
+def _seconds(times: Sequence[str]) -> np.ndarray:
+    'the seconds since 1970 of the times'
+    times = pd.to_datetime(pd.Index(times, dtype=object), format='ISO8601')
+    assert not times.isna().any(), 'the labevents must have a charttime'
+    return times.to_numpy().astype('datetime64[s]').astype(np.int64)
@@ -1,52 +1,244 @@
-from typing import Iterable
-import utils
+from collections.abc import Mapping
+from typing import Iterable, Iterator, Optional, Sequence
+import numpy as np
 import pandas as pd
+import utils
+from utils import csr, instrument
+from utils.columnar import ColumnarTable, is_columnar
+
+
+class FeatureTable:
+    '''the features of each subject as CSR structure (see `utils.csr`):
+    the features of row `i` are `names[j]` for each `j` in `indices[indptr[i]:indptr[i+1]]` (sorted)
+    '''
+
+    def __init__(self, indptr: np.ndarray, indices: np.ndarray, names: list[str]):
+        self.indptr = indptr
+        self.indices = indices
+        self.names = names
+        'the feature of each position'
+
+    def __len__(self) -> int:
+        return len(self.indptr) - 1
+
+    def row(self, i: int) -> np.ndarray:
+        'returns the positions in `names` of the features of row `i`'
+        return self.indices[self.indptr[i]:self.indptr[i + 1]]
+
+    def features(self, i: int) -> set[str]:
+        'returns the features of row `i`'
+        return {self.names[j] for j in self.row(i).tolist()}
 
 
 class Subject:
-    def __init__(self, id):
+    'view of the data of one subject of a `LoadedData` object'
+    __slots__ = ('id', '_data', '_row')
+
+    def __init__(self, id: int, data: 'LoadedData', row: int):
         self.id = id
-        self.labevents_hpo: set[str] = set()
-        self.diagnoses_hpo: set[str] = set()
-        self.diagnoses_icd: set[str] = set()
+        self._data = data
+        self._row = row
+
+    @property
+    def labevents_hpo(self) -> set[str]:
+        return self._data.labevents_hpo.features(self._row)
+
+    @property
+    def diagnoses_hpo(self) -> set[str]:
+        return self._data.diagnoses_hpo.features(self._row)
+
+    @property
+    def diagnoses_icd(self) -> set[str]:
+        return self._data.diagnoses_icd.features(self._row)
 
     def __repr__(self) -> str:
         return f'<Subject {self.id}>'
 
 
+class _SubjectsById(Mapping):
+    'maps the subject ids of a `LoadedData` object to `Subject` views'
+
+    def __init__(self, data: 'LoadedData'):
+        self._data = data
+
+    def __getitem__(self, id: int) -> Subject:
+        return Subject(id, self._data, self._data.subject_index[id])
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._data.subject_ids)
+
+    def __len__(self) -> int:
+        return len(self._data.subject_ids)
+
+
 class LoadedData:
     '''
     Loads the Human Phenotype Ontology, as well as the annotated labevents and diagnoses files.
     Groups the labevents and diagnoses data by subject id.
+
+    The features of the subjects are stored in `FeatureTable`s, one row per subject in the order
+    of `subject_ids`. The HPO features are positions in `hpo_ids`.
+
+    The labevents and diagnoses can be csv files or columnar tables (see `utils.columnar`),
+    only the needed columns are read. They are read in chunks and only the distinct
+    (subject, value) pairs are kept, so the memory usage does not grow with the number of events.
     '''
 
     def __init__(self, hpo_path: str, labevents_hpo_path: str, diagnoses_hpo_path: str,
                  labevents_hpo_column_name: str = 'selected_hpo_features',
                  diagnoses_hpo_column_name: str = 'hpo_features',
                  diagnoses_icd_column_name: str = 'icd9_code',
+                 compact_hpo: bool = False,
+                 chunksize: int = 1_000_000,
                  ):
-        self.hpo = utils.read_hpo_from_obo(hpo_path)
-        labevents_df = pd.read_csv(labevents_hpo_path).fillna('')
-        diagnoses_df = pd.read_csv(diagnoses_hpo_path).fillna('')
-
-        self.subjects: dict[int, Subject] = {}
-
-        for _, line in labevents_df.iterrows():
-            subject_id = line.subject_id
-            hpo_features = self.convert_hpo_to_proper_id(
-                line[labevents_hpo_column_name].split(';'))
-            subject = self.subjects.setdefault(subject_id, Subject(subject_id))
-            subject.labevents_hpo.update(hpo_features)
-
-        for _, line in diagnoses_df.iterrows():
-            subject_id = line.subject_id
-            hpo_features = self.convert_hpo_to_proper_id(
-                line[diagnoses_hpo_column_name].split(';'))
-            icd_features = line[diagnoses_icd_column_name].split(';')
-            subject = self.subjects.setdefault(subject_id, Subject(subject_id))
-            subject.diagnoses_hpo.update(hpo_features)
-            subject.diagnoses_icd.update(icd_features)
+        '''parameters:
+        - `compact_hpo`: loads the HPO as `utils.CompactHPO` instead of `utils.HPO`
+        - `chunksize`: number of rows read at once, it bounds the memory used for reading
+        '''
+        self.hpo = utils.read_hpo_from_obo(hpo_path, compact=compact_hpo)
+        self.hpo_ids: list[str] = list(self.hpo.entries_by_id)
+        'the HPO entries in the order of `hpo.ancestor_index`'
+        position = {id: i for i, id in enumerate(self.hpo_ids)}
+        self._hpo_position = {id: position[proper_id]
+                              for id, proper_id in self.hpo.proper_id.items()}
+        'maps all ids and alt_ids to the position of the correct id'
+
+        with instrument.stage('read labevents', path=labevents_hpo_path):
+            labevents_subjects, (labevents_hpo,) = _read_columns(
+                labevents_hpo_path, [labevents_hpo_column_name], chunksize)
+        with instrument.stage('read diagnoses', path=diagnoses_hpo_path):
+            diagnoses_subjects, (diagnoses_hpo, diagnoses_icd) = _read_columns(
+                diagnoses_hpo_path, [diagnoses_hpo_column_name, diagnoses_icd_column_name], chunksize)
+
+        # rows of the subjects in order of their first appearance
+        subject_ids = pd.unique(np.concatenate(
+            [labevents_subjects, diagnoses_subjects]))
+        self.subject_ids: list[int] = subject_ids.tolist()
+        self.subject_index = {id: i for i, id in enumerate(self.subject_ids)}
+        'maps the subject id to its row'
+        subject_rows = pd.Index(subject_ids)
+
+        with instrument.stage('group by subject'):
+            self.labevents_hpo = self._hpo_table(subject_rows, labevents_hpo)
+            self.diagnoses_hpo = self._hpo_table(subject_rows, diagnoses_hpo)
+            self.diagnoses_icd = self._table(
+                subject_rows, diagnoses_icd, skip_empty=False)
+            instrument.count('subjects', len(self.subject_ids))
+
+        self._subjects: Optional[_SubjectsById] = None
+
+    @property
+    def subjects(self) -> Mapping[int, Subject]:
+        'maps the subject id to a view of the data of the subject'
+        if self._subjects is None:
+            self._subjects = _SubjectsById(self)
+        return self._subjects
+
+    def _hpo_table(self, subject_rows: pd.Index, values: '_DistinctPairs') -> FeatureTable:
+        return self._table(subject_rows, values, names=self.hpo_ids, position=self._hpo_position)
+
+    def _table(self, subject_rows: pd.Index, values: '_DistinctPairs', skip_empty: bool = True,
+               names: Optional[list[str]] = None, position: Optional[dict[str, int]] = None,
+               ) -> FeatureTable:
+        '''groups the `;` separated values by subject, `subject_rows` maps the subject ids to rows.
+        Without `names` and `position`, the names are all occurring values, sorted.
+        '''
+        subjects, codes = values.pairs()
+        rows = subject_rows.get_indexer(subjects)
+        uniques = list(values.dictionary)
+
+        # each distinct value is split only once
+        lists = [value.split(';') for value in uniques]
+        if skip_empty:
+            lists = [[e for e in values if e != ''] for values in lists]
+        if names is None or position is None:
+            names = sorted({e for values in lists for e in values})
+            position = {name: i for i, name in enumerate(names)}
+        lists_indptr, lists_indices = csr.from_lists(
+            [[position[e] for e in values] for values in lists])
+
+        indptr, indices = csr.from_pairs(
+            np.repeat(rows, np.diff(lists_indptr)[codes]),
+            csr.gather_rows(lists_indptr, lists_indices, codes),
+            len(self.subject_ids), max(len(names), 1))
+        return FeatureTable(indptr, indices, names)
 
     def convert_hpo_to_proper_id(self, s: Iterable[str]):
         # change alt ids to the main id
         return {self.hpo.proper_id[e] for e in s if e != ''}
+
+
+class _DistinctPairs:
+    '''collects the distinct (subject id, value) pairs of a column that is read chunk by chunk.
+    The values are identified by their position in `dictionary`.
+    '''
+
+    def __init__(self):
+        self.dictionary: dict[str, int] = {}
+        'maps the values to their codes, in order of their first appearance'
+        self._subjects: list[np.ndarray] = []
+        self._codes: list[np.ndarray] = []
+        self._size = 0
+        self._compacted_size = 0
+
+    def add(self, subjects: np.ndarray, codes: np.ndarray, uniques: Sequence[str]):
+        '''adds the pairs of a chunk, its values are `uniques[codes]`'''
+        mapping = np.array([self.dictionary.setdefault(value, len(self.dictionary)) for value in uniques],
+                           dtype=np.int64)
+        pairs = pd.DataFrame({'subject': subjects, 'code': mapping[codes] if len(mapping) else codes}) \
+            .drop_duplicates()
+        self._subjects.append(pairs.subject.to_numpy())
+        self._codes.append(pairs.code.to_numpy())
+        self._size += len(pairs.index)
+        # the same pairs can appear in several chunks, they are removed once they make up half
+        if self._size > 2 * self._compacted_size:
+            self._compact()
+
+    def _compact(self):
+        pairs = pd.DataFrame({'subject': np.concatenate(self._subjects),
+                              'code': np.concatenate(self._codes)}).drop_duplicates()
+        self._subjects = [pairs.subject.to_numpy()]
+        self._codes = [pairs.code.to_numpy()]
+        self._size = self._compacted_size = len(pairs.index)
+
+    def pairs(self) -> tuple[np.ndarray, np.ndarray]:
+        '''returns the subject ids and the codes of the distinct pairs'''
+        if not self._subjects:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        self._compact()
+        return self._subjects[0], self._codes[0]
+
+
+def _read_columns(path: str, columns: list[str], chunksize: int) -> tuple[np.ndarray, list[_DistinctPairs]]:
+    '''reads the subject ids (distinct, in order of their first appearance) and the distinct
+    (subject id, value) pairs of the string `columns` from a csv file or a columnar table
+    (see `utils.columnar`) in chunks of `chunksize` rows. Other columns are not read.
+    '''
+    values = [_DistinctPairs() for _ in columns]
+    subjects: list[np.ndarray] = []
+    if is_columnar(path):
+        table = ColumnarTable(path)
+        dictionaries = [table.dictionary(column) for column in columns]
+        for start in range(0, len(table), chunksize):
+            chunk_subjects = np.asarray(
+                table.integers('subject_id')[start:start + chunksize])
+            instrument.count('rows', len(chunk_subjects))
+            with instrument.timed('distinct_seconds'):
+                subjects.append(pd.unique(chunk_subjects))
+                for column, dictionary, pairs in zip(columns, dictionaries, values):
+                    pairs.add(chunk_subjects, np.asarray(
+                        table.codes(column)[start:start + chunksize]), dictionary)
+    else:
+        with pd.read_csv(path, usecols=['subject_id', *columns], chunksize=chunksize,
+                         dtype={column: str for column in columns}) as reader:
+            for chunk in reader:
+                chunk_subjects = chunk.subject_id.to_numpy()
+                instrument.count('rows', len(chunk_subjects))
+                with instrument.timed('distinct_seconds'):
+                    subjects.append(pd.unique(chunk_subjects))
+                    for column, pairs in zip(columns, values):
+                        pairs.add(chunk_subjects,
+                                  *pd.factorize(chunk[column].fillna('')))
+    if not subjects:
+        return np.empty(0, dtype=np.int64), values
+    return pd.unique(np.concatenate(subjects)), values
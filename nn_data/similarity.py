@@ -0,0 +1,308 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, Literal, Optional, Union
+import numpy as np
+from utils import csr
+from .loader import LoadedData
+
+profile_type = Union[int, Iterable[str]]
+'a subject id or a set of HPO ids'
+
+BLOCK_ENTRIES = 1 << 21
+'the number of entries processed at once, bounds the temporary memory of building the matrices'
+
+
+class SimilarityEngine:
+    '''Compares subjects by the semantic similarity of their HPO features.
+
+    - the information content of a term is `-log(p)`, where `p` is the portion of subjects
+      annotated with the term or one of its descendants
+    - the similarity of two terms is the information content of their most informative common
+      ancestor (`resnik`) or that normalized by the information content of both terms (`lin`)
+    - the similarity of two subjects is the best-match-average of the similarities of their terms
+
+    The most informative common ancestor of every pair of terms used by the subjects is computed
+    once, so comparing subjects only needs lookups and vectorized reductions. `mica` and `similarity`
+    are dense matrices over these terms (`vocabulary`, not the whole HPO): they take
+    `8 * len(vocabulary)**2` bytes, e.g. 128 MB for 4000 terms. They are built in blocks of rows,
+    the temporary memory on top of them stays below about `32 * BLOCK_ENTRIES` bytes (64 MB).
+    '''
+
+    def __init__(self, data: LoadedData,
+                 mode: Literal['labevents', 'diagnoses'] = 'diagnoses',
+                 measure: Literal['resnik', 'lin'] = 'resnik',
+                 ):
+        index = data.hpo.ancestor_index
+        self.index = index
+        self.measure = measure
+        self.subject_ids: list[int] = data.subject_ids
+        self._subject_index = data.subject_index
+
+        # the terms of each subject as CSR structure of positions in the HPO
+        table = data.labevents_hpo if mode == 'labevents' else data.diagnoses_hpo
+        indptr, indices = table.indptr, table.indices
+
+        # information content from the annotations, propagated to the ancestors
+        ancestor_indptr, ancestor_indices = index.union_rows(indptr, indices)
+        # a term can also be an ancestor of another term of the same subject, so the
+        # (subject, term) pairs are made unique before counting
+        pairs = csr.unique(np.concatenate([
+            csr.row_ids(indptr) * len(index.ids) + indices,
+            csr.row_ids(ancestor_indptr) * len(index.ids) + ancestor_indices,
+        ]))
+        counts = np.bincount(pairs % len(index.ids), minlength=len(index.ids))
+        self.ic: np.ndarray = np.log(max(len(self.subject_ids), 1) /
+                                     np.maximum(counts, 1))
+        'information content of each term'
+
+        # terms used by the subjects
+        self.vocabulary: np.ndarray = csr.unique(indices)
+        'positions in the HPO of the terms used by the subjects'
+        self._vocabulary_index = {t: i for i,
+                                  t in enumerate(self.vocabulary.tolist())}
+        self.profile_indptr = indptr
+        self.profile_indices = np.searchsorted(
+            self.vocabulary, indices).astype(np.int32)
+        'the terms of each subject as CSR structure of positions in `vocabulary`'
+
+        # for each term the vocabulary terms it is an ancestor of (or is itself)
+        ancestor_lengths = np.diff(index.indptr)[self.vocabulary]
+        covering = np.concatenate([
+            csr.gather_rows(index.indptr, index.indices, self.vocabulary),
+            self.vocabulary,
+        ])
+        covered = np.concatenate([
+            np.repeat(np.arange(len(self.vocabulary)), ancestor_lengths),
+            np.arange(len(self.vocabulary)),
+        ])
+        order = np.argsort(covering, kind='stable')
+        self._covering_terms, starts = np.unique(
+            covering[order], return_index=True)
+        self._covered_indptr = np.append(starts, len(order))
+        self._covered_indices = covered[order].astype(np.int32)
+        'the vocabulary terms covered by each term of `_covering_terms`, as CSR structure'
+
+        self._root = int(np.flatnonzero(np.diff(index.indptr) == 0)[0])
+        # the terms ordered by information content (ties by position) and the rank of each term
+        self._by_ic = np.lexsort((np.arange(len(index.ids)), self.ic)).astype(np.int32)
+        self._ic_rank = np.empty(len(index.ids), dtype=np.int32)
+        self._ic_rank[self._by_ic] = np.arange(len(index.ids), dtype=np.int32)
+
+        self.mica: np.ndarray = self._mica_rows(self.vocabulary)
+        'most informative common ancestor (position in the HPO) of each pair of vocabulary terms'
+        self.similarity = np.empty(self.mica.shape, dtype=np.float32)
+        'similarity of each pair of vocabulary terms'
+        step = max(1, BLOCK_ENTRIES // max(len(self.vocabulary), 1))
+        for start in range(0, len(self.vocabulary), step):
+            self.similarity[start:start + step] = self._similarity(
+                self.mica[start:start + step], self.vocabulary[start:start + step])
+
+    def _mica_rows(self, terms: np.ndarray) -> np.ndarray:
+        '''for each of the `terms` (positions in the HPO) the most informative common ancestor
+        with each vocabulary term
+        '''
+        mica = np.empty((len(terms), len(self.vocabulary)), dtype=np.int32)
+        # all (term, ancestor or the term itself) pairs that cover some vocabulary term, by term
+        lengths = np.diff(self.index.indptr)[terms]
+        rows = np.concatenate(
+            [np.repeat(np.arange(len(terms)), lengths), np.arange(len(terms))])
+        ancestors = np.concatenate(
+            [csr.gather_rows(self.index.indptr, self.index.indices, terms), terms])
+        keep = np.isin(ancestors, self._covering_terms)
+        order = np.argsort(rows[keep], kind='stable')
+        rows, ancestors = rows[keep][order], ancestors[keep][order]
+        positions = np.searchsorted(self._covering_terms, ancestors)
+        covered = np.diff(self._covered_indptr)[positions]
+
+        # each pair expands to the vocabulary terms its ancestor covers, the rows are processed in
+        # blocks of about `BLOCK_ENTRIES` of these (row, ancestor, column) entries
+        row_starts = np.searchsorted(rows, np.arange(len(terms) + 1))
+        entries = np.append(0, np.cumsum(covered))[row_starts]
+        start = 0
+        while start < len(terms):
+            end = max(start + 1, int(np.searchsorted(
+                entries, entries[start] + BLOCK_ENTRIES, side='right')) - 1)
+            block = slice(row_starts[start], row_starts[end])
+            block_positions = positions[block]
+            lengths = covered[block]
+            columns = csr.gather_rows(
+                self._covered_indptr, self._covered_indices, block_positions)
+            # the maximum of the information content ranks is taken explicitly,
+            # fancy assignment would not guarantee which of the duplicate pairs wins
+            ranks = np.full((end - start) * len(self.vocabulary),
+                            self._ic_rank[self._root], dtype=np.int32)
+            np.maximum.at(ranks, np.repeat(rows[block] - start, lengths) * len(self.vocabulary) + columns,
+                          np.repeat(self._ic_rank[ancestors[block]], lengths))
+            mica[start:end] = self._by_ic[ranks].reshape(end - start, len(self.vocabulary))
+            start = end
+        return mica
+
+    def _similarity(self, mica: np.ndarray, terms: np.ndarray) -> np.ndarray:
+        'converts the `mica` of `terms` and the vocabulary terms to similarities'
+        resnik = self.ic[mica].astype(np.float32)
+        if self.measure == 'resnik':
+            return resnik
+        denominator = self.ic[terms][:, None] + \
+            self.ic[self.vocabulary][None, :]
+        same = terms[:, None] == self.vocabulary[None, :]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            lin = np.where(denominator > 0, 2 * resnik / denominator, same)
+        return lin.astype(np.float32)
+
+    def most_informative_common_ancestor(self, a: str, b: str) -> str:
+        'returns the id of the most informative common ancestor of the terms `a` and `b`'
+        i, j = self.index.index[a], self.index.index[b]
+        if j in self._vocabulary_index:
+            return self.index.ids[self._mica_rows(np.array([i]))[0, self._vocabulary_index[j]]]
+        common = np.intersect1d(np.append(self.index.ancestor_indices(i), i),
+                                np.append(self.index.ancestor_indices(j), j))
+        return self.index.ids[common[np.argmax(self.ic[common])]]
+
+    def term_similarity(self, a: str, b: str) -> float:
+        'returns the similarity of the terms `a` and `b`'
+        mica = self.index.index[self.most_informative_common_ancestor(a, b)]
+        if self.measure == 'resnik':
+            return float(self.ic[mica])
+        denominator = self.ic[self.index.index[a]] + self.ic[self.index.index[b]]
+        return float(2 * self.ic[mica] / denominator) if denominator > 0 else float(a == b)
+
+    def _term_rows(self, ids: Iterable[str]) -> np.ndarray:
+        'the similarities of the terms with the given `ids` to each vocabulary term'
+        terms = np.fromiter((self.index.index[id]
+                            for id in ids), dtype=np.int64)
+        in_vocabulary = np.isin(terms, self.vocabulary)
+        rows = np.empty((len(terms), len(self.vocabulary)), dtype=np.float32)
+        rows[in_vocabulary] = self.similarity[np.searchsorted(
+            self.vocabulary, terms[in_vocabulary])]
+        outside = terms[~in_vocabulary]
+        rows[~in_vocabulary] = self._similarity(
+            self._mica_rows(outside), outside)
+        return rows
+
+    def _query(self, profile: profile_type) -> np.ndarray:
+        'the similarities of the terms of `profile` to each vocabulary term'
+        if isinstance(profile, (int, np.integer)):
+            row = self._subject_index[profile]
+            return self.similarity[self.profile_indices[self.profile_indptr[row]:self.profile_indptr[row + 1]]]
+        return self._term_rows(sorted(set(profile)))
+
+    def patient_similarity(self, a: profile_type, b: profile_type) -> float:
+        'returns the best-match-average similarity of two subjects'
+        return float(self.cohort_similarity(a, [b])[0])
+
+    def cohort_similarity(self, profile: profile_type,
+                          subjects: Optional[Iterable[profile_type]] = None) -> np.ndarray:
+        '''returns the best-match-average similarity of `profile` to each of the `subjects`
+        (by default all subjects in `subject_ids`)
+        '''
+        if subjects is None:
+            indptr, indices = self.profile_indptr, self.profile_indices
+        else:
+            indptr, indices = self._profiles(subjects)
+        query = self._query(profile)
+        query_indptr = np.array([0, len(query)])
+        return _best_match_average(query_indptr, query, indptr, indices)[0]
+
+    def _profiles(self, subjects: Iterable[profile_type]) -> tuple[np.ndarray, np.ndarray]:
+        'the CSR structure with the terms of `subjects` as positions in the vocabulary'
+        rows = []
+        for subject in subjects:
+            if isinstance(subject, (int, np.integer)):
+                row = self._subject_index[subject]
+                rows.append(self.profile_indices[self.profile_indptr[row]:self.profile_indptr[row + 1]].tolist())
+            else:
+                terms = [self.index.index[id] for id in set(subject)]
+                assert all(t in self._vocabulary_index for t in terms), \
+                    'the subjects to compare to may only use terms used by the loaded subjects'
+                rows.append(sorted(self._vocabulary_index[t] for t in terms))
+        return csr.from_lists(rows)
+
+    def iter_all_pairs(self, block_size: int = 256, workers: int = 1) -> Iterator[tuple[int, np.ndarray]]:
+        '''yields the best-match-average similarities of all pairs of subjects in `subject_ids`
+        as blocks `(first_row, similarities)` of `block_size` rows.
+        With more than one worker, the blocks are computed in a process pool.
+        '''
+        starts = list(range(0, len(self.subject_ids), block_size))
+        arguments = (self.similarity, self.profile_indptr,
+                     self.profile_indices, block_size)
+        if workers > 1:
+            with ProcessPoolExecutor(workers, initializer=_init_pair_worker, initargs=arguments) as executor:
+                yield from zip(starts, executor.map(_pair_block, starts))
+        else:
+            _init_pair_worker(*arguments)
+            for start in starts:
+                yield start, _pair_block(start)
+
+    def all_pairs(self, block_size: int = 256, workers: int = 1) -> np.ndarray:
+        'returns the best-match-average similarities of all pairs of subjects in `subject_ids`'
+        result = np.empty(
+            (len(self.subject_ids), len(self.subject_ids)), dtype=np.float32)
+        for start, block in self.iter_all_pairs(block_size, workers):
+            result[start:start + len(block)] = block
+        return result
+
+
+def _best_match_average(query_indptr: np.ndarray, query: np.ndarray,
+                        indptr: np.ndarray, indices: np.ndarray,
+                        max_elements: int = 2**24) -> np.ndarray:
+    '''best-match-average similarity of each query to each subject.
+
+    - `query_indptr`, `query`: the rows of the similarity matrix for the terms of each query,
+      `query[query_indptr[q]:query_indptr[q+1]]` belong to query `q`
+    - `indptr`, `indices`: the terms of the subjects as positions in the vocabulary
+
+    The subjects are processed in chunks of at most `max_elements` gathered similarities.
+    '''
+    result = np.zeros((len(query_indptr) - 1, len(indptr) - 1),
+                      dtype=np.float32)
+    query_lengths = np.diff(query_indptr)
+    queries = np.flatnonzero(query_lengths)
+    lengths = np.diff(indptr)
+    if len(queries) == 0 or len(query) == 0:
+        return result
+    query_starts = query_indptr[queries]
+
+    subjects = np.flatnonzero(lengths)
+    chunk_entries = max(1, max_elements // len(query))
+    first = 0
+    while first < len(subjects):
+        # take subjects until the gathered similarities would exceed `max_elements`
+        ends = np.cumsum(lengths[subjects[first:]])
+        last = first + max(1, int(np.searchsorted(ends, chunk_entries, side='right')))
+        chunk = subjects[first:last]
+        chunk_lengths = lengths[chunk]
+        chunk_starts = np.cumsum(chunk_lengths) - chunk_lengths
+        columns = csr.gather_rows(indptr, indices, chunk)
+        similarities = query[:, columns]  # (query terms, subject terms)
+
+        # for each query term the best match within each subject
+        best_in_subject = np.maximum.reduceat(
+            similarities, chunk_starts, axis=1)
+        forward = np.add.reduceat(best_in_subject, query_starts, axis=0) / \
+            query_lengths[queries][:, None]
+        # for each subject term the best match within each query
+        best_in_query = np.maximum.reduceat(
+            similarities, query_starts, axis=0)
+        backward = np.add.reduceat(best_in_query, chunk_starts, axis=1) / \
+            chunk_lengths[None, :]
+        result[np.ix_(queries, chunk)] = (forward + backward) / 2
+        first = last
+    return result
+
+
+_pair_arguments: Optional[tuple] = None
+'the arguments of a worker process computing all pairs, see `_init_pair_worker`'
+
+
+def _init_pair_worker(similarity: np.ndarray, indptr: np.ndarray, indices: np.ndarray, block_size: int):
+    global _pair_arguments
+    _pair_arguments = (similarity, indptr, indices, block_size)
+
+
+def _pair_block(start: int) -> np.ndarray:
+    'computes the similarities of the subjects `start` to `start + block_size` to all subjects'
+    assert _pair_arguments is not None
+    similarity, indptr, indices, block_size = _pair_arguments
+    end = min(start + block_size, len(indptr) - 1)
+    query_indptr = indptr[start:end + 1] - indptr[start]
+    query = similarity[indices[indptr[start]:indptr[end]]]
+    return _best_match_average(query_indptr, query, indptr, indices)
@@ -1,5 +1,11 @@
 from .autoencoder import Autoencoder
-from .training import training, split_dataset, test
+from .training import training, split_dataset, test, accuracy, TrainingHistory
 from .fcn_model import FCNModel
+from .inference import Predictor
+from .compression import quantize, prune, compare_models
+from .sparse import SparseLinear
+from .sweep import DEFAULT_PARAMETERS, grid, random_trials, run_sweep
 
-__all__ = ['Autoencoder', 'training', 'FCNModel', 'split_dataset', 'test']
+__all__ = ['Autoencoder', 'training', 'FCNModel', 'split_dataset', 'test', 'accuracy', 'TrainingHistory', 'Predictor',
+           'quantize', 'prune', 'compare_models', 'SparseLinear',
+           'DEFAULT_PARAMETERS', 'grid', 'random_trials', 'run_sweep']
@@ -1,4 +1,5 @@
 import torch.nn as nn
+from .sparse import SparseLinear
 
 
 class Autoencoder(nn.Module):
@@ -6,9 +7,10 @@ class Autoencoder(nn.Module):
     This class forms the architecture of the autoencoder. The latent size which is an input
     of the init function describes the dimension of the innermost layer.
     After Training the output of this first encoder part will serve as input for the following FCN
+    With `sparse_input` the first layer is a `SparseLinear`, which also accepts `nn_data.SparseInput`s
     """
 
-    def __init__(self, input_size, hidden_size, latent_size):
+    def __init__(self, input_size, hidden_size, latent_size, sparse_input: bool = False):
         super().__init__()
 
         # define encoder and decoder Parameters
@@ -18,7 +20,8 @@ class Autoencoder(nn.Module):
         self.output_size = input_size
 
         # architecture and initialization of encoder
-        l1 = nn.Linear(self.input_size, self.hidden_size)
+        l1 = (SparseLinear if sparse_input else nn.Linear)(
+            self.input_size, self.hidden_size)
         nn.init.xavier_uniform_(l1.weight)
         l2 = nn.Linear(self.hidden_size, self.latent_size)
         nn.init.xavier_uniform_(l2.weight)
@@ -0,0 +1,130 @@
+import copy
+import io
+import time
+import warnings
+from typing import Callable, Optional
+import numpy as np
+import torch
+import torch.nn as nn
+from .training import split_dataset_type
+
+
+def quantize(model: nn.Module) -> nn.Module:
+    '''returns a copy of `model` for CPU inference whose `nn.Linear` layers use int8 weights.
+    The activations are quantized dynamically, batch by batch.
+    '''
+    model = copy.deepcopy(model).cpu().eval()
+    with warnings.catch_warnings():
+        # eager mode quantization is deprecated in favour of torchao, which is not a dependency
+        warnings.simplefilter('ignore', DeprecationWarning)
+        warnings.simplefilter('ignore', UserWarning)
+        return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def prune(model: nn.Module, amount: float) -> nn.Module:
+    '''returns a copy of `model` with the fraction `amount` of the hidden units removed
+    between consecutive `nn.Linear` layers of each `nn.Sequential` (e.g. `FCNModel.NN`).
+
+    The units with the smallest incoming and outgoing weights are removed, so the layers become
+    smaller and faster. A removed unit is replaced by its output for zero incoming weights,
+    which is added to the bias of the following layer.
+    '''
+    assert 0 <= amount < 1, 'the amount must be in [0, 1)'
+    model = copy.deepcopy(model).cpu().eval()
+    for sequential in [m for m in model.modules() if isinstance(m, nn.Sequential)]:
+        layers = list(sequential)
+        positions = [i for i, layer in enumerate(layers)
+                     if isinstance(layer, nn.Linear)]
+        for a, b in zip(positions, positions[1:]):
+            # the modules between the layers are activations and dropout
+            between = nn.Sequential(*layers[a + 1:b])
+            layers[a], layers[b] = _remove_units(
+                layers[a], between, layers[b], amount)
+        for i, layer in enumerate(layers):
+            sequential[i] = layer
+    return model
+
+
+def _remove_units(first: nn.Linear, between: nn.Module, second: nn.Linear, amount: float
+                  ) -> tuple[nn.Linear, nn.Linear]:
+    'removes the fraction `amount` of the outputs of `first`, which are the inputs of `second`'
+    kept_units = max(1, round(first.out_features * (1 - amount)))
+    scores = first.weight.norm(dim=1) * second.weight.norm(dim=0)
+    keep = torch.zeros(first.out_features, dtype=torch.bool)
+    keep[torch.topk(scores, kept_units).indices] = True
+
+    with torch.no_grad():
+        bias = first.bias if first.bias is not None else torch.zeros(
+            first.out_features)
+        removed_output = between(bias[~keep])
+        new_first = nn.Linear(first.in_features, kept_units,
+                              bias=first.bias is not None)
+        new_first.weight.copy_(first.weight[keep])
+        if first.bias is not None:
+            new_first.bias.copy_(first.bias[keep])
+        new_second = nn.Linear(kept_units, second.out_features)
+        new_second.weight.copy_(second.weight[:, keep])
+        new_second.bias.copy_(second.weight[:, ~keep] @ removed_output +
+                              (second.bias if second.bias is not None else 0))
+    return new_first, new_second
+
+
+def model_size(model: nn.Module) -> int:
+    'returns the size of the stored parameters of `model` in bytes'
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def compare_models(
+    models: dict[str, nn.Module],
+    dataset_split: split_dataset_type,
+    calc_accuracy: Optional[Callable] = None,
+    batch_size: int = 1024,
+) -> dict[str, dict[str, float]]:
+    '''compares the `models` (e.g. a model and its `quantize`d and `prune`d variants) on the
+    test data from `dataset_split`, on the CPU.
+
+    Reports the accuracy (if `calc_accuracy` is not `None`), the maximal difference of the outputs
+    to the first model, the inference time per subject and the size of the parameters.
+    Like in `training`, `calc_accuracy` gets the outputs and targets of a batch as tensors.
+    '''
+    _, _, test_loader = dataset_split
+    loader = torch.utils.data.DataLoader(
+        test_loader.dataset, batch_size=batch_size, shuffle=False, collate_fn=test_loader.collate_fn)
+    batches = [(inputs.to(torch.device('cpu')), targets.cpu().numpy())
+               for inputs, targets in loader]
+    subjects = sum(len(targets) for _, targets in batches)
+
+    results = {}
+    reference = None
+    for name, model in models.items():
+        model = copy.deepcopy(model).cpu().eval()
+        with torch.inference_mode():
+            if batches:
+                model(batches[0][0])  # warm-up
+            start = time.perf_counter()
+            outputs = [model(inputs).numpy() for inputs, _ in batches]
+            seconds = time.perf_counter() - start
+
+        result = {
+            'ms_per_subject': 1000 * seconds / max(subjects, 1),
+            'size_mb': model_size(model) / 1e6,
+        }
+        if reference is None:
+            reference = outputs
+        result['max_difference'] = max((float(np.abs(output - ref).max()) for output, ref in zip(outputs, reference)),
+                                       default=0.0)
+        if calc_accuracy:
+            result['accuracy'] = float(np.mean(
+                [float(calc_accuracy(torch.from_numpy(output), torch.from_numpy(targets)))
+                 for output, (_, targets) in zip(outputs, batches)]))
+        results[name] = result
+
+    columns = ['accuracy', 'max_difference', 'ms_per_subject', 'size_mb']
+    columns = [column for column in columns if column in next(iter(results.values()), {})]
+    width = max([len(name) for name in results] + [5])
+    print(' '.join([f'{"model":<{width}}'] + [f'{column:>14}' for column in columns]))
+    for name, result in results.items():
+        print(' '.join([f'{name:<{width}}'] + [f'{result[column]:>14.4f}' for column in columns]))
+    return results
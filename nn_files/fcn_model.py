@@ -1,6 +1,7 @@
 from typing import Optional
 import torch.nn as nn
 from .autoencoder import Autoencoder
+from .sparse import SparseLinear
 
 
 class FCNModel(nn.Module):
@@ -8,6 +9,8 @@ class FCNModel(nn.Module):
     Structure for Fully Connected Network Model
     The pretrained Autoencoder is an optional input, separation in the code makes it possible
     to use different architectures, depending on if a pretrained encoder is in place or not
+    With `sparse_input` the first layer is a `SparseLinear`, which also accepts `nn_data.SparseInput`s.
+    If an Autoencoder is given, its encoder is the first layer instead
     """
 
     def __init__(
@@ -16,6 +19,7 @@ class FCNModel(nn.Module):
         enlarging_factor: float,
         autoencoder: Optional[Autoencoder] = None,
         dropOutRatio: float = 0,
+        sparse_input: bool = False,
     ):
         super().__init__()
 
@@ -55,7 +59,8 @@ class FCNModel(nn.Module):
             self.encoder = None
 
             # architecture and initialization of the FCN
-            l1 = nn.Linear(self.input_size, self.hidden_size)
+            l1 = (SparseLinear if sparse_input else nn.Linear)(
+                self.input_size, self.hidden_size)
             nn.init.xavier_uniform_(l1.weight)
             d1 = nn.Dropout(p=dropOutRatio)
             l2 = nn.Linear(self.hidden_size, self.hidden_size)
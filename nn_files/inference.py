@@ -0,0 +1,191 @@
+import copy
+import json
+import warnings
+from typing import Iterable, Iterator, Optional, Union
+import numpy as np
+import torch
+import torch.nn as nn
+from nn_data.creator import DatasetCreator
+from nn_data.dataset import SparseInput
+from nn_runtime.model import FEATURES_FILE, RUNTIME_VERSION
+from utils import csr
+from utils.compact_hpo import CompactHPO
+from utils.hpo import HPO
+from .sparse import SparseLinear
+
+
+class Predictor:
+    '''Scores many subjects at once with a trained model, e.g. `FCNModel` with or without encoder.
+
+    The features of each subject are given as set of ids (e.g. the HPO ids of the labevents).
+    They are encoded against the `input_features` the model was trained with, unknown ids are ignored.
+    The subjects are scored in batches of `batch_size`, only one batch is a dense tensor at a time.
+    Models with a `SparseLinear` layer get the batches as `nn_data.SparseInput`s instead.
+    '''
+
+    def __init__(self, model: nn.Module, input_features: list[str], output_features: list[str],
+                 hpo: Optional[Union[HPO, CompactHPO]] = None,
+                 enable_parent_nodes: bool = False,
+                 batch_size: int = 4096,
+                 num_threads: Optional[int] = None,
+                 device: torch.device = torch.device('cpu'),
+                 ):
+        '''parameters:
+        - `input_features`, `output_features`: the `feature_list`s of the input and target `DatasetCreator`s
+        - `hpo`: maps alt ids to the proper ids, needed for `enable_parent_nodes`
+        - `enable_parent_nodes`: activates all parent nodes of the inputs, like `HPODatasetCreator`
+        - `num_threads`: number of threads used by torch, by default the current setting
+        '''
+        assert hpo is not None or not enable_parent_nodes, \
+            'the parent nodes need the HPO'
+        self.model = model
+        self.input_features = input_features
+        self.output_features = output_features
+        self.hpo = hpo
+        self.enable_parent_nodes = enable_parent_nodes
+        self.batch_size = batch_size
+        self.num_threads = num_threads
+        self.device = device
+        self._sparse_input = any(isinstance(module, SparseLinear)
+                                 for module in model.modules())
+
+        self._input_position = {feature: i for i, feature in enumerate(input_features)}
+        'maps the input features to their columns'
+        if hpo is not None:
+            # the proper id of an alt id is the feature
+            self._input_position.update({id: self._input_position[proper_id] for id, proper_id in hpo.proper_id.items()
+                                         if proper_id in self._input_position})
+        if enable_parent_nodes:
+            ancestor_index = hpo.ancestor_index
+            self._hpo_position = {id: ancestor_index.index[proper_id]
+                                  for id, proper_id in hpo.proper_id.items()}
+            'maps all ids and alt_ids to the position of the correct id in `hpo.ancestor_index`'
+            # the columns of each entry and its ancestors, only the ones that are input features
+            entries = np.arange(len(ancestor_index.ids))
+            hpo_columns = np.array([self._input_position.get(id, -1) for id in ancestor_index.ids],
+                                   dtype=np.int64)
+            rows = np.concatenate([entries, csr.row_ids(ancestor_index.indptr)])
+            columns = hpo_columns[np.concatenate(
+                [entries, ancestor_index.indices])]
+            self._closure_indptr, self._closure_indices = csr.from_pairs(
+                rows[columns >= 0], columns[columns >= 0], len(entries), max(len(input_features), 1))
+            'the columns of the input features among each HPO entry and its ancestors as CSR structure'
+
+    @classmethod
+    def from_creators(cls, model: nn.Module, input_creator: DatasetCreator, target_creator: DatasetCreator,
+                      **kwargs) -> 'Predictor':
+        'creates a `Predictor` for a model trained with the data of `input_creator` and `target_creator`'
+        return cls(model, input_creator.feature_list, target_creator.feature_list, hpo=input_creator.hpo, **kwargs)
+
+    def encode(self, feature_sets: Iterable[Iterable[str]]) -> tuple[np.ndarray, np.ndarray]:
+        'returns the columns of the features of each subject as CSR structure (see `utils.csr`)'
+        feature_sets = list(feature_sets)
+        rows, columns = self._entries(feature_sets)
+        return csr.from_pairs(rows, columns, len(feature_sets), max(len(self.input_features), 1))
+
+    def _entries(self, feature_sets: list[Iterable[str]]) -> tuple[np.ndarray, np.ndarray]:
+        'returns the (row, column) pairs of the features of each subject, possibly with duplicates'
+        if not self.enable_parent_nodes:
+            position = self._input_position
+            indptr, indices = csr.from_lists(
+                [[position[id] for id in ids if id in position] for ids in feature_sets])
+            return csr.row_ids(indptr), indices
+
+        position = self._hpo_position
+        indptr, indices = csr.from_lists(
+            [[position[id] for id in ids if id in position] for ids in feature_sets])
+        rows = np.repeat(csr.row_ids(indptr), np.diff(
+            self._closure_indptr)[indices])
+        return rows, csr.gather_rows(self._closure_indptr, self._closure_indices, indices)
+
+    def iter_scores(self, feature_sets: Iterable[Iterable[str]]) -> Iterator[np.ndarray]:
+        'yields the model outputs of each batch of subjects, one row per subject and column per output feature'
+        for batch in _batches(feature_sets, self.batch_size):
+            rows, columns = self._entries(batch)
+            if self._sparse_input:
+                indptr, indices = csr.from_pairs(
+                    rows, columns, len(batch), max(len(self.input_features), 1))
+                yield self._forward(SparseInput.from_csr(indptr, indices, len(self.input_features)))
+            else:
+                inputs = np.zeros(
+                    (len(batch), len(self.input_features)), dtype=np.float32)
+                inputs[rows, columns] = 1
+                yield self._forward(torch.from_numpy(inputs))
+
+    def _forward(self, inputs: Union[torch.Tensor, SparseInput]) -> np.ndarray:
+        'runs the model in evaluation mode, the settings of torch and the model are restored afterwards'
+        threads = torch.get_num_threads()
+        training = self.model.training
+        if self.num_threads is not None:
+            torch.set_num_threads(self.num_threads)
+        self.model.eval()
+        try:
+            with torch.inference_mode():
+                return self.model(inputs.to(self.device)).cpu().numpy()
+        finally:
+            self.model.train(training)
+            torch.set_num_threads(threads)
+
+    def scores(self, feature_sets: Iterable[Iterable[str]]) -> np.ndarray:
+        'returns the model outputs, one row per subject and column per output feature'
+        batches = list(self.iter_scores(feature_sets))
+        if not batches:
+            return np.zeros((0, len(self.output_features)), dtype=np.float32)
+        return np.concatenate(batches)
+
+    def top_k(self, feature_sets: Iterable[Iterable[str]], k: int = 10) -> list[list[tuple[str, float]]]:
+        'returns the `k` output features with the highest scores and their scores for each subject'
+        result = []
+        for scores in self.iter_scores(feature_sets):
+            scores = torch.from_numpy(scores)
+            values, columns = torch.topk(scores, min(k, scores.shape[1]), dim=1)
+            result.extend([[(self.output_features[j], v) for j, v in zip(row_columns, row_values)]
+                           for row_columns, row_values in zip(columns.tolist(), values.tolist())])
+        return result
+
+    def export(self, path: str):
+        '''exports the model together with the encoding of the features as TorchScript file.
+        It can be loaded with `nn_runtime.RuntimeModel`, which needs only torch and numpy.
+        '''
+        if self.enable_parent_nodes:
+            ids = list(self._hpo_position)
+            rows = np.array(list(self._hpo_position.values()), dtype=np.int64)
+            lengths = np.diff(self._closure_indptr)[rows]
+            indices = csr.gather_rows(
+                self._closure_indptr, self._closure_indices, rows)
+        else:
+            ids = list(self._input_position)
+            lengths = np.ones(len(ids), dtype=np.int64)
+            indices = np.array(list(self._input_position.values()), dtype=np.int64)
+        # ids without input columns are left out, like unknown ids they activate nothing
+        ids = [id for id, length in zip(ids, lengths.tolist()) if length > 0]
+        indptr = np.concatenate([[0], np.cumsum(lengths[lengths > 0])])
+        features = {
+            'version': RUNTIME_VERSION,
+            'input_features': self.input_features,
+            'output_features': self.output_features,
+            'ids': ids,
+            'indptr': indptr.tolist(),
+            'indices': indices.tolist(),
+        }
+
+        model = copy.deepcopy(self.model).cpu().eval()
+        with warnings.catch_warnings(), torch.no_grad():
+            # TorchScript is deprecated in favour of `torch.export`, whose files take seconds to load
+            warnings.simplefilter('ignore', FutureWarning)
+            module = torch.jit.freeze(torch.jit.trace(
+                model, torch.zeros((1, len(self.input_features)))))
+            torch.jit.save(module, path, _extra_files={
+                           FEATURES_FILE: json.dumps(features)})
+
+
+def _batches(items: Iterable, size: int) -> Iterator[list]:
+    'splits `items` into lists of `size` items'
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
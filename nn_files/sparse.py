@@ -0,0 +1,44 @@
+import math
+from typing import Union
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from nn_data.dataset import SparseInput
+
+
+class SparseLinear(nn.Module):
+    '''`nn.Linear` that also accepts `SparseInput`s, e.g. as first layer for multi-hot HPO features.
+
+    For a `SparseInput` the outputs are the sums of the weight columns of the active inputs,
+    like `nn.EmbeddingBag` in sum mode, so the cost scales with the number of active inputs instead
+    of the number of input features. Dense inputs are processed like by `nn.Linear`.
+
+    `weight` and `bias` are the ones of `nn.Linear`, so the weights of both are interchangeable.
+    The weight is stored transposed, one contiguous row per input feature.
+    '''
+
+    def __init__(self, in_features: int, out_features: int, bias: bool = True):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.weight = nn.Parameter(torch.empty(in_features, out_features).t())
+        if bias:
+            self.bias = nn.Parameter(torch.empty(out_features))
+        else:
+            self.register_parameter('bias', None)
+
+        # same initialization as `nn.Linear`
+        nn.init.kaiming_uniform_(self.weight, a=math.sqrt(5))
+        if self.bias is not None:
+            bound = 1 / math.sqrt(in_features) if in_features > 0 else 0
+            nn.init.uniform_(self.bias, -bound, bound)
+
+    def forward(self, x: Union[torch.Tensor, SparseInput]) -> torch.Tensor:
+        if not isinstance(x, SparseInput):
+            return F.linear(x, self.weight, self.bias)
+        output = F.embedding_bag(x.indices, self.weight.t(), x.offsets,
+                                 mode='sum', include_last_offset=True)
+        return output if self.bias is None else output + self.bias
+
+    def extra_repr(self) -> str:
+        return f'in_features={self.in_features}, out_features={self.out_features}, bias={self.bias is not None}'
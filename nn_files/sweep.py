@@ -0,0 +1,203 @@
+import concurrent.futures
+import csv
+import itertools
+import os
+import random
+import time
+from typing import Any, Optional
+import torch
+import torch.nn as nn
+from nn_data.cache import FeatureCache
+from nn_data.creator import DatasetCreator
+from nn_data.dataset import CSRDataset
+from .autoencoder import Autoencoder
+from .fcn_model import FCNModel
+from .training import accuracy, split_dataset, training
+
+DEFAULT_PARAMETERS: dict[str, Any] = {
+    'use_ICD': False,
+    'enable_parent_nodes_hpo_input': False,
+    'enable_parent_nodes_hpo_target': False,
+    'sparse_input': False,
+    'use_autoencoder': True,
+    'batch_size_AE': 8,
+    'num_epochs_AE': 60,
+    'learning_rate_AE': 1e-2,
+    'beta_AE': (0.9, 0.999),
+    'reduction_factor_hidden': 0.7,
+    'reduction_factor_latent': 0.5,
+    'batch_size': 8,
+    'num_epochs': 20,
+    'learning_rate': 1e-4,
+    'betas': (0.9, 0.999),
+    'enlarging_factor_NN': 1.4,
+    'dropOutRatio': 0.0,
+    'patience': None,
+    'seed': 0,
+}
+'''the default parameters of a trial, those of the project notebook when the sweep was added.
+The notebook passes its current parameters to `run_sweep`, which take precedence'''
+
+
+def grid(space: dict[str, list]) -> list[dict[str, Any]]:
+    'returns a trial for every combination of the values in `space`'
+    return [dict(zip(space, values)) for values in itertools.product(*space.values())]
+
+
+def random_trials(space: dict[str, list], n: int, seed: int = 0) -> list[dict[str, Any]]:
+    'returns `n` trials with values chosen at random from `space`'
+    rng = random.Random(seed)
+    return [{name: rng.choice(values) for name, values in space.items()} for _ in range(n)]
+
+
+def run_sweep(
+    cache: FeatureCache,
+    trials: list[dict[str, Any]],
+    results_path: str = 'data/sweep_results.csv',
+    workers: Optional[int] = None,
+    threads_per_worker: int = 1,
+    parameters: Optional[dict[str, Any]] = None,
+) -> list[dict[str, Any]]:
+    '''trains the models of the project notebook for each of the `trials`, parameters missing in a
+    trial are taken from `parameters` (e.g. those of the notebook) and then from `DEFAULT_PARAMETERS`.
+
+    The features are created once (see `FeatureCache`) and shared with the `workers` processes
+    through shared memory. Each worker uses `threads_per_worker` threads.
+    The results are written to `results_path` as csv table whenever a trial finishes: the parameters
+    of the trial, the validation loss and accuracy of the last and the best epoch, the number of epochs
+    and the wall-clock time. A trial that fails has its error in the `error` column.
+    '''
+    if workers is None:
+        workers = max(1, (os.cpu_count() or 1) // threads_per_worker)
+    trial_parameters = [{**DEFAULT_PARAMETERS, **(parameters or {}), **trial} for trial in trials]
+    unknown = set().union(*trial_parameters) - set(DEFAULT_PARAMETERS)
+    assert not unknown, f'unknown parameters: {sorted(unknown)}'
+
+    features = {}
+    for p in trial_parameters:
+        for key in (_input_key(p), _target_key(p)):
+            if key not in features:
+                features[key] = _share(_create(cache, key))
+
+    results: list[Optional[dict[str, Any]]] = [None] * len(trials)
+    context = torch.multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(
+            workers, mp_context=context, initializer=_init_worker,
+            initargs=(features, threads_per_worker)) as executor:
+        # the shared tensors are passed to the workers without copying the features
+        futures = {executor.submit(_run_trial, p): i
+                   for i, p in enumerate(trial_parameters)}
+        for future in concurrent.futures.as_completed(futures):
+            i = futures[future]
+            results[i] = {'trial': i, **trials[i], **future.result()}
+            if results[i]['error']:
+                print(f'trial {i} failed: {results[i]["error"]}')
+            else:
+                print(f'trial {i}: validation loss {results[i]["val_loss"]:.4f}, '
+                      f'accuracy {results[i]["val_acc"]:.4f} ({results[i]["seconds"]:.1f}s)')
+            _write_results(results_path, trials, results)
+    return results
+
+
+def _input_key(parameters: dict[str, Any]) -> tuple:
+    return ('hpo', 'labevents', parameters['enable_parent_nodes_hpo_input'])
+
+
+def _target_key(parameters: dict[str, Any]) -> tuple:
+    if parameters['use_ICD']:
+        return ('icd', True)
+    return ('hpo', 'diagnoses', parameters['enable_parent_nodes_hpo_target'])
+
+
+def _create(cache: FeatureCache, key: tuple) -> DatasetCreator:
+    if key[0] == 'icd':
+        return cache.icd_creator(batch=key[1])
+    return cache.hpo_creator(key[1], enable_parent_nodes=key[2])
+
+
+def _share(creator: DatasetCreator) -> tuple:
+    'the features of `creator`, the arrays in shared memory'
+    return (creator.subject_ids, creator.feature_list,
+            torch.from_numpy(creator.indptr).share_memory_(),
+            torch.from_numpy(creator.indices).share_memory_())
+
+
+_creators: dict[tuple, DatasetCreator] = {}
+'the creators of the worker processes, see `_init_worker`'
+
+
+def _init_worker(features: dict[tuple, tuple], threads: int):
+    torch.set_num_threads(threads)
+    for key, (subject_ids, feature_list, indptr, indices) in features.items():
+        _creators[key] = DatasetCreator.from_features(
+            None, subject_ids, feature_list, indptr.numpy(), indices.numpy())
+
+
+def _run_trial(p: dict[str, Any]) -> dict[str, Any]:
+    'trains the autoencoder (if enabled) and the model like the project notebook, with all parameters `p`'
+    try:
+        start = time.perf_counter()
+        torch.manual_seed(p['seed'])
+        device = torch.device('cpu')
+        inputs = _creators[_input_key(p)]
+        targets = _creators[_target_key(p)]
+        input_size = len(inputs.feature_list)
+        target_size = len(targets.feature_list)
+
+        AE = None
+        input_size_NN = input_size
+        if p['use_autoencoder']:
+            AE = Autoencoder(input_size, int(input_size * p['reduction_factor_hidden']),
+                             int(input_size * p['reduction_factor_latent']), sparse_input=p['sparse_input'])
+            training(
+                AE, device,
+                split_dataset(p['batch_size_AE'], CSRDataset(inputs, inputs, sparse_inputs=p['sparse_input']),
+                              seed=p['seed']),
+                nn.MSELoss(), torch.optim.Adam(AE.parameters(), lr=p['learning_rate_AE'], betas=p['beta_AE']),
+                p['num_epochs_AE'], patience=p['patience'], restore_best=p['patience'] is not None,
+                verbose=False,
+            )
+            input_size_NN = AE.latent_size
+
+        hidden_size_NN = int(max(input_size_NN, target_size)
+                             * p['enlarging_factor_NN'])
+        model = FCNModel(input_size_NN, hidden_size_NN, target_size, p['enlarging_factor_NN'], AE,
+                         dropOutRatio=p['dropOutRatio'], sparse_input=p['sparse_input'])
+        history = training(
+            model, device,
+            split_dataset(p['batch_size'], CSRDataset(inputs, targets, sparse_inputs=p['sparse_input']),
+                          seed=p['seed']),
+            nn.CrossEntropyLoss(), torch.optim.Adam(
+                model.parameters(), lr=p['learning_rate'], betas=p['betas']),
+            p['num_epochs'], calc_accuracy=accuracy, patience=p['patience'], restore_best=p['patience'] is not None,
+            verbose=False,
+        )
+        best = history.best_epoch
+        return {
+            'val_loss': history.val_loss[-1],
+            'val_acc': history.val_acc[-1],
+            'best_val_loss': history.val_loss[best],
+            'best_val_acc': history.val_acc[best],
+            'epochs': len(history.val_loss),
+            'seconds': time.perf_counter() - start,
+            'error': '',
+        }
+    except Exception as e:
+        return {'error': f'{type(e).__name__}: {e}'}
+
+
+def _write_results(path: str, trials: list[dict[str, Any]], results: list[Optional[dict[str, Any]]]):
+    'writes the finished `results` as csv table. The file is replaced at once, so it is never half written'
+    parameters = list(dict.fromkeys(
+        name for trial in trials for name in trial))
+    columns = ['trial', *parameters, 'val_loss', 'val_acc', 'best_val_loss', 'best_val_acc',
+               'epochs', 'seconds', 'error']
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, columns, restval='')
+        writer.writeheader()
+        writer.writerows(result for result in results if result is not None)
+    os.replace(tmp_path, path)
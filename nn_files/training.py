@@ -1,8 +1,13 @@
+import copy
+import os
+import random
 from typing import Callable, Optional
 import torch
 import torch.nn as nn
 import numpy as np
 from nn_data.creator import DatasetCreator
+from utils import instrument
+from utils.files import string_digest
 from .plots import plot_loss_accuracy, plot_test_output
 import tqdm
 
@@ -13,25 +18,64 @@ split_dataset_type = tuple[torch.utils.data.DataLoader,
 def split_dataset(
     batch_size: int,
     dataset: torch.utils.data.dataset.TensorDataset,
+    collate_fn: Optional[Callable] = None,
+    num_workers: int = 0,
+    pin_memory: bool = False,
+    seed: Optional[int] = None,
 ) -> split_dataset_type:
     '''split dataset into training, validation and test
-    with the ratios (0.7, 0.2, 0.1)'''
+    with the ratios (0.7, 0.2, 0.1)
+
+    `collate_fn` combines the samples to batches, by default `dataset.collate` if the dataset has one
+    (e.g. `nn_data.CSRDataset`).
+    `num_workers` processes prepare the batches, `pin_memory` speeds up the copies to the GPU.
+    With a `seed` the split is always the same, e.g. to resume a training from a checkpoint'''
+    if collate_fn is None:
+        collate_fn = getattr(dataset, 'collate', None)
     train_size = int(len(dataset)*0.7)
     val_size = int(len(dataset)*0.2)
     test_size = len(dataset) - (train_size + val_size)
 
+    generator = torch.Generator().manual_seed(
+        seed) if seed is not None else None
     train_set, val_set, test_set = torch.utils.data.random_split(
-        dataset, [train_size, val_size, test_size])
-
-    train_loader = torch.utils.data.DataLoader(
-        train_set, batch_size=batch_size, shuffle=True)
-    val_loader = torch.utils.data.DataLoader(
-        val_set, batch_size=batch_size, shuffle=False)
-    test_loader = torch.utils.data.DataLoader(
-        test_set, batch_size=1, shuffle=False)
+        dataset, [train_size, val_size, test_size], generator=generator)
+
+    def loader(dataset, batch_size, shuffle):
+        return torch.utils.data.DataLoader(
+            dataset, batch_size=batch_size, shuffle=shuffle, collate_fn=collate_fn,
+            num_workers=num_workers, pin_memory=pin_memory, persistent_workers=num_workers > 0)
+
+    train_loader = loader(train_set, batch_size, shuffle=True)
+    val_loader = loader(val_set, batch_size, shuffle=False)
+    test_loader = loader(test_set, 1, shuffle=False)
     return train_loader, val_loader, test_loader
 
 
+def accuracy(output: torch.Tensor, target: torch.Tensor) -> torch.Tensor:
+    '''the portion of the active target features that are predicted, averaged over the batch.
+    Used as `calc_accuracy` by the project notebook and the sweep'''
+    number_of_features = target.sum(axis=1)
+    correctly_identified = (target * output).sum(axis=1)
+    # + .00001 avoids divisions by zero
+    return (correctly_identified / (number_of_features + .00001)).mean()
+
+
+class TrainingHistory:
+    'the mean loss and accuracy of the batches of each epoch'
+
+    def __init__(self):
+        self.train_loss: list[float] = []
+        self.val_loss: list[float] = []
+        self.train_acc: list[float] = []
+        self.val_acc: list[float] = []
+        'empty without `calc_accuracy`'
+        self.best_epoch = -1
+        'the epoch with the lowest validation loss, -1 before the first epoch'
+        self.stopped_early = False
+        'whether the training was stopped because the validation loss did not improve'
+
+
 def training(
     model: nn.Module,
     device: torch.device,
@@ -40,60 +84,202 @@ def training(
     optimizer: torch.optim.Optimizer,
     num_epochs: int,
     calc_accuracy: Optional[Callable] = None,
-):
+    compile: bool = False,
+    patience: Optional[int] = None,
+    restore_best: bool = False,
+    checkpoint_path: Optional[str] = None,
+    checkpoint_every: int = 1,
+    verbose: bool = True,
+) -> TrainingHistory:
     '''trains the `model` using the training and validation dataset from `dataset_split`.
 
-    After training is done the loss will be shown in a plot.
+    The progress is shown and after training is done the loss will be shown in a plot,
+    unless `verbose` is `False`.
 
     if `calc_accuracy` function is not `None` the accuracy will be calculated and plotted as well.
+    It gets the outputs and targets of a batch as tensors on the `device` and the loss and accuracy
+    are summed up there, they are copied to the host only once per epoch.
+
+    if `compile` is `True` the model is compiled with `torch.compile`.
+
+    The weights of the epoch with the lowest validation loss are kept, with `restore_best` they are
+    loaded into the `model` at the end. With `patience` the training stops early once the validation
+    loss did not improve for `patience` epochs.
+
+    With `checkpoint_path` the model, optimizer, history, best weights and random number generators
+    are saved there every `checkpoint_every` epochs. If the file exists, the training resumes from it.
+    A checkpoint of another model, optimizer, optimizer settings or loss is ignored and replaced, it has
+    to be removed (or another path used) when only the data changes.
     '''
     train_loader, val_loader, _ = dataset_split
+    step_model = torch.compile(model) if compile else model
+
+    history = TrainingHistory()
+    best_state: Optional[dict] = None
+    fingerprint = _fingerprint(model, optimizer, loss_func)
+    if checkpoint_path is not None and os.path.exists(checkpoint_path):
+        resumed = _load_checkpoint(checkpoint_path, model, optimizer, fingerprint)
+        if resumed is None:
+            if verbose:
+                print(f'starting over, {checkpoint_path} was saved for another model or optimizer')
+        else:
+            history, best_state = resumed
+            if verbose:
+                print(f'resuming after epoch {len(history.train_loss)} from {checkpoint_path}')
+
+    first_epoch = len(history.train_loss)
+    last_epoch = first_epoch if history.stopped_early else max(
+        num_epochs, first_epoch)
+    for epoch in tqdm.tqdm(range(first_epoch, last_epoch), initial=first_epoch, total=last_epoch,
+                           disable=not verbose):
+        model.train()
+        with instrument.stage('training epoch', epoch=epoch + 1):
+            train_metrics = _run_epoch(
+                step_model, device, train_loader, loss_func, calc_accuracy, optimizer)
+
+        # Validation after an epoch, without gradients
+        model.eval()
+        with instrument.stage('validation', epoch=epoch + 1), torch.no_grad():
+            val_metrics = _run_epoch(
+                step_model, device, val_loader, loss_func, calc_accuracy)
+
+        # a single copy to the host per epoch
+        values = torch.stack(train_metrics + val_metrics).tolist()
+        train_values = values[:len(train_metrics)]
+        val_values = values[len(train_metrics):]
+        history.train_loss.append(train_values[0])
+        history.val_loss.append(val_values[0])
+        if calc_accuracy:
+            history.train_acc.append(train_values[1])
+            history.val_acc.append(val_values[1])
+
+        if history.best_epoch < 0 or val_values[0] < history.val_loss[history.best_epoch]:
+            history.best_epoch = epoch
+            best_state = {key: value.detach().to('cpu', copy=True)
+                          for key, value in model.state_dict().items()}
+        elif patience is not None and epoch - history.best_epoch >= patience:
+            history.stopped_early = True
+
+        if checkpoint_path is not None and \
+                ((epoch + 1) % checkpoint_every == 0 or epoch + 1 == last_epoch or history.stopped_early):
+            _save_checkpoint(checkpoint_path, model,
+                             optimizer, history, best_state, fingerprint)
+        if history.stopped_early:
+            if verbose:
+                print(f'stopped early after epoch {epoch + 1}, '
+                      f'the validation loss did not improve since epoch {history.best_epoch + 1}')
+            break
+
+    # put model back into training mode
+    model.train()
+    if restore_best and best_state is not None:
+        model.load_state_dict(best_state)
+    if verbose:
+        plot_loss_accuracy(history.train_loss, history.val_loss,
+                           history.train_acc, history.val_acc)
+    return history
+
+
+def _fingerprint(model: nn.Module, optimizer: torch.optim.Optimizer, loss_func: nn.Module) -> str:
+    'identifies the architecture of `model`, the `optimizer` with its settings and the `loss_func`'
+    return string_digest(repr((
+        repr(model),
+        [(name, tuple(value.shape), str(value.dtype)) for name, value in model.state_dict().items()],
+        type(optimizer).__name__,
+        [{key: value for key, value in group.items() if key != 'params'}
+         for group in optimizer.param_groups],
+        repr(loss_func),
+    )))
+
 
-    val_loss_history = []
-    val_acc_history = []
-    train_loss_history = []
-    train_acc_history = []
-    for _ in tqdm.tqdm(range(num_epochs)):
-        train_loss_epoch = []
-        train_acc_epoch = []
-        for inputs, targets in train_loader:
-            inputs, targets = inputs.to(device), targets.to(device)
+def _save_checkpoint(path: str, model: nn.Module, optimizer: torch.optim.Optimizer,
+                     history: TrainingHistory, best_state: Optional[dict], fingerprint: str):
+    'saves the state of the training to `path`. The file is replaced at once, so it is never half written'
+    checkpoint = {
+        'fingerprint': fingerprint,
+        'model': model.state_dict(),
+        'optimizer': optimizer.state_dict(),
+        'history': vars(history),
+        'best_model': best_state,
+        'rng': {
+            'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+            'numpy': np.random.get_state(),
+            'random': random.getstate(),
+        },
+    }
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    torch.save(checkpoint, tmp_path)
+    os.replace(tmp_path, path)
 
+
+def _load_checkpoint(path: str, model: nn.Module, optimizer: torch.optim.Optimizer, fingerprint: str
+                     ) -> Optional[tuple[TrainingHistory, Optional[dict]]]:
+    '''restores the state of the training saved by `_save_checkpoint`, returns the history and the best weights.
+    Returns `None` without changing anything if the checkpoint has another `fingerprint`'''
+    # the checkpoint contains the numpy and python random states, which are not plain tensors
+    checkpoint = torch.load(path, map_location='cpu', weights_only=False)
+    if checkpoint.get('fingerprint') != fingerprint:
+        return None
+    model.load_state_dict(checkpoint['model'])
+    optimizer.load_state_dict(checkpoint['optimizer'])
+    history = TrainingHistory()
+    vars(history).update(copy.deepcopy(checkpoint['history']))
+
+    rng = checkpoint['rng']
+    torch.set_rng_state(rng['torch'])
+    if torch.cuda.is_available() and rng['cuda']:
+        torch.cuda.set_rng_state_all(rng['cuda'])
+    np.random.set_state(rng['numpy'])
+    random.setstate(rng['random'])
+    return history, checkpoint['best_model']
+
+
+def _run_epoch(
+    model: nn.Module,
+    device: torch.device,
+    loader: torch.utils.data.DataLoader,
+    loss_func: nn.Module,
+    calc_accuracy: Optional[Callable] = None,
+    optimizer: Optional[torch.optim.Optimizer] = None,
+) -> list[torch.Tensor]:
+    '''runs the `model` on all batches of `loader`, with an `optimizer` it is trained as well.
+    Returns the mean loss and (with `calc_accuracy`) accuracy of the batches, as tensors on `device`
+    '''
+    loss_sum = torch.zeros((), device=device)
+    acc_sum = torch.zeros((), device=device)
+    batches = 0
+    for inputs, targets in loader:
+        inputs = inputs.to(device, non_blocking=loader.pin_memory)
+        targets = targets.to(device, non_blocking=loader.pin_memory)
+
+        if optimizer:
             optimizer.zero_grad()
-            outputs = model(inputs)
-            loss = loss_func(outputs, targets)
+        outputs = model(inputs)
+        loss = loss_func(outputs, targets)
+        if optimizer:
             loss.backward()
             optimizer.step()
 
-            train_loss_epoch.append(loss.cpu().detach().numpy())
-            if calc_accuracy:
-                train_acc_epoch.append(calc_accuracy(
-                    outputs.cpu().detach().numpy(), targets.cpu().detach().numpy()))
-
-        # Validation after an epoch
-        model.eval()
-        val_loss_epoch = []
-        val_acc_epoch = []
-        for inputs, targets in val_loader:
-            inputs, targets = inputs.to(device), targets.to(device)
-
-            outputs = model(inputs)
-            loss = loss_func(outputs, targets)
-            val_loss_epoch.append(loss.detach().cpu().numpy())
-            if calc_accuracy:
-                val_acc_epoch.append(calc_accuracy(
-                    outputs.cpu().detach().numpy(), targets.cpu().detach().numpy()))
-
-        train_loss_history.append(np.mean(train_loss_epoch))
-        val_loss_history.append(np.mean(val_loss_epoch))
+        loss_sum += loss.detach()
         if calc_accuracy:
-            train_acc_history.append(np.mean(train_acc_epoch))
-            val_acc_history.append(np.mean(val_acc_epoch))
+            acc_sum += calc_accuracy(outputs.detach(), targets)
+        batches += 1
+        instrument.count('samples', len(targets))
+        instrument.count('batches')
 
-        # put model back into training mode
-        model.train()
-    plot_loss_accuracy(train_loss_history, val_loss_history,
-                       train_acc_history, val_acc_history)
+    if instrument.enabled() and device.type == 'cuda':
+        # the recorded time includes the queued kernels
+        torch.cuda.synchronize(device)
+
+    # without batches the means are nan, like the mean of an empty list
+    metrics = [loss_sum / batches if batches else torch.full((), np.nan, device=device)]
+    if calc_accuracy:
+        metrics.append(acc_sum / batches if batches else torch.full((), np.nan, device=device))
+    return metrics
 
 
 def test(
@@ -109,6 +295,9 @@ def test(
 ):
     '''tests the `model` using the test data from `dataset_split`.
 
+    `calc_accuracy` gets the outputs and targets of a batch as tensors on the `device`, like in `training`.
+    `print_real_effect` gets those of the last batch as numpy arrays.
+
     if `plot_outputs` is `True` a single example from the test run will be plotted.
     '''
     _, _, test_loader = dataset_split
@@ -118,12 +307,13 @@ def test(
     for inputs, targets in test_loader:
         inputs, targets = inputs.to(device), targets.to(device)
 
-        outputs = model(inputs)
-
-        outputs, targets = outputs.cpu().detach().numpy(), targets.cpu().detach().numpy()
+        with torch.no_grad():
+            outputs = model(inputs)
 
         if calc_accuracy:
-            test_acc.append(calc_accuracy(outputs, targets))
+            test_acc.append(float(calc_accuracy(outputs, targets)))
+
+        outputs, targets = outputs.cpu().detach().numpy(), targets.cpu().detach().numpy()
 
     if calc_accuracy:
         test_acc = np.mean(test_acc)
@@ -0,0 +1,3 @@
+from .model import RuntimeModel
+
+__all__ = ['RuntimeModel']
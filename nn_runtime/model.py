@@ -0,0 +1,104 @@
+import json
+import warnings
+from typing import Iterable, Iterator, Optional
+import numpy as np
+import torch
+
+# An exported model is a TorchScript file (see `nn_files.Predictor.export`) with the extra file
+# `features.json`:
+# - `version`: `RUNTIME_VERSION`
+# - `input_features`, `output_features`: the `feature_list`s the model was trained with
+# - `ids`, `indptr`, `indices`: the input columns activated by each id as CSR structure,
+#   the columns of `ids[i]` are `indices[indptr[i]:indptr[i+1]]`. Besides the input features
+#   these are their alt ids and, if parent nodes are enabled, all HPO ids with the columns
+#   of the id and its ancestors.
+# This module only needs torch and numpy, so the model can be served without the research code.
+
+RUNTIME_VERSION = 1
+'increased whenever the format of the exported models changes'
+FEATURES_FILE = 'features.json'
+'name of the extra file of the TorchScript file'
+
+
+class RuntimeModel:
+    '''a model exported by `nn_files.Predictor.export`, scores subjects given as sets of ids'''
+
+    def __init__(self, path: str, batch_size: int = 4096, num_threads: Optional[int] = None):
+        '''parameters:
+        - `num_threads`: number of threads used by torch, by default the current setting
+        '''
+        extra_files = {FEATURES_FILE: ''}
+        with warnings.catch_warnings():
+            # TorchScript is deprecated in favour of `torch.export`, whose files take seconds to load
+            warnings.simplefilter('ignore', FutureWarning)
+            self.module = torch.jit.load(
+                path, map_location='cpu', _extra_files=extra_files)
+        features = json.loads(extra_files[FEATURES_FILE])
+        assert features['version'] == RUNTIME_VERSION, \
+            f'{path} has version {features["version"]}, expected {RUNTIME_VERSION}'
+        self.input_features: list[str] = features['input_features']
+        self.output_features: list[str] = features['output_features']
+        self._index = {id: i for i, id in enumerate(features['ids'])}
+        'maps the ids to their row of `_indptr`'
+        self._indptr = np.array(features['indptr'], dtype=np.int64)
+        self._indices = np.array(features['indices'], dtype=np.int64)
+        self.batch_size = batch_size
+        self.num_threads = num_threads
+
+    def encode(self, feature_sets: list[Iterable[str]]) -> np.ndarray:
+        'returns the inputs of the subjects as dense matrix, unknown ids are ignored'
+        index = self._index
+        positions = [[index[id] for id in ids if id in index]
+                     for ids in feature_sets]
+        lengths = [len(row) for row in positions]
+        positions = np.fromiter((p for row in positions for p in row),
+                                dtype=np.int64, count=sum(lengths))
+        starts = self._indptr[positions]
+        counts = self._indptr[positions + 1] - starts
+        # position of each column = start of its row + its position within the row
+        shifts = np.repeat(starts - (np.cumsum(counts) - counts), counts)
+        columns = self._indices[shifts + np.arange(len(shifts))]
+        rows = np.repeat(np.repeat(np.arange(len(feature_sets)), lengths), counts)
+
+        inputs = np.zeros(
+            (len(feature_sets), len(self.input_features)), dtype=np.float32)
+        inputs[rows, columns] = 1
+        return inputs
+
+    def iter_scores(self, feature_sets: Iterable[Iterable[str]]) -> Iterator[np.ndarray]:
+        'yields the model outputs of each batch of subjects, one row per subject and column per output feature'
+        batch = []
+        for ids in feature_sets:
+            batch.append(ids)
+            if len(batch) == self.batch_size:
+                yield self._forward(self.encode(batch))
+                batch = []
+        if batch:
+            yield self._forward(self.encode(batch))
+
+    def _forward(self, inputs: np.ndarray) -> np.ndarray:
+        threads = torch.get_num_threads()
+        if self.num_threads is not None:
+            torch.set_num_threads(self.num_threads)
+        try:
+            with torch.inference_mode():
+                return self.module(torch.from_numpy(inputs)).numpy()
+        finally:
+            torch.set_num_threads(threads)
+
+    def scores(self, feature_sets: Iterable[Iterable[str]]) -> np.ndarray:
+        'returns the model outputs, one row per subject and column per output feature'
+        batches = list(self.iter_scores(feature_sets))
+        if not batches:
+            return np.zeros((0, len(self.output_features)), dtype=np.float32)
+        return np.concatenate(batches)
+
+    def top_k(self, feature_sets: Iterable[Iterable[str]], k: int = 10) -> list[list[tuple[str, float]]]:
+        'returns the `k` output features with the highest scores and their scores for each subject'
+        result = []
+        for scores in self.iter_scores(feature_sets):
+            values, columns = torch.topk(torch.from_numpy(
+                scores), min(k, scores.shape[1]), dim=1)
+            result.extend([[(self.output_features[j], v) for j, v in zip(row_columns, row_values)]
+                           for row_columns, row_values in zip(columns.tolist(), values.tolist())])
+        return result
@@ -0,0 +1,134 @@
+import gzip
+import hashlib
+import http.server
+import os
+import socket
+import threading
+import pytest
+from utils import ingest
+from utils.files import read_json
+
+# a local stand-in for the download servers: it supports ETags, If-None-Match and range requests
+# with If-Range, and can drop the connection in the middle of a response
+
+FILES = {
+    '/a.txt': os.urandom(1_000_000),
+    # random bytes do not compress, so some chunks arrive before the connection breaks
+    '/b.gz': gzip.compress(os.urandom(1_000_000)) + gzip.compress(b'second member\n'),
+}
+
+
+class _Server(http.server.ThreadingHTTPServer):
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _Handler)
+        self.drop: set[str] = set()
+        'the paths whose next response breaks off after a third of the body'
+        self.requests: list[dict[str, str]] = []
+        'the headers of all requests'
+
+    def url(self, path: str) -> str:
+        return f'http://127.0.0.1:{self.server_port}{path}'
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        body = FILES[self.path]
+        etag = f'"{hashlib.sha256(body).hexdigest()[:16]}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        start = 0
+        if 'Range' in self.headers and self.headers.get('If-Range') == etag:
+            start = int(self.headers['Range'].split('=')[1].split('-')[0])
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(body) - 1}/{len(body)}')
+        else:
+            self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body) - start))
+        self.end_headers()
+        if self.path in self.server.drop:
+            self.server.drop.discard(self.path)
+            self.wfile.write(body[start:start + (len(body) - start) // 3])
+            self.wfile.flush()
+            self.close_connection = True
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return
+        self.wfile.write(body[start:])
+
+
+@pytest.fixture
+def server():
+    server = _Server()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _leftovers(directory) -> list[str]:
+    return [name for name in os.listdir(directory) if name.endswith(('.part', '.part.json', '.tmp'))]
+
+
+def test_resume_interrupted_download(server, tmp_path):
+    source = ingest.Source(str(tmp_path / 'a.txt'), server.url('/a.txt'),
+                           sha256=hashlib.sha256(FILES['/a.txt']).hexdigest())
+    manifest = str(tmp_path / 'manifest.json')
+    server.drop.add('/a.txt')
+    report = ingest.download([source], manifest, retries=0)
+    assert list(report.failed) == [source.path]
+    assert 0 < os.path.getsize(f'{source.path}.part') < len(FILES['/a.txt'])
+
+    report = ingest.download([source], manifest)
+    assert report.downloaded == [source.path] and report.resumed_bytes > 0
+    assert server.requests[-1]['Range'] == f'bytes={report.resumed_bytes}-'
+    with open(source.path, 'rb') as f:
+        assert f.read() == FILES['/a.txt']
+    assert _leftovers(tmp_path) == []
+
+
+def test_skip_unchanged(server, tmp_path):
+    source = ingest.Source(str(tmp_path / 'a.txt'), server.url('/a.txt'))
+    manifest = str(tmp_path / 'manifest.json')
+    ingest.download([source], manifest)
+
+    report = ingest.download([source], manifest)
+    assert report.skipped == [source.path] and len(server.requests) == 1
+
+    report = ingest.download([source], manifest, refresh=True)
+    assert report.skipped == [source.path]
+    assert server.requests[-1]['If-None-Match'] == read_json(manifest)[source.path]['etag']
+
+
+def test_gzip_with_broken_connection(server, tmp_path):
+    source = ingest.Source(str(tmp_path / 'b.txt'), server.url('/b.gz'), extract=True)
+    server.drop.add('/b.gz')
+    report = ingest.download([source], str(tmp_path / 'manifest.json'))
+    assert report.downloaded == [source.path] and report.resumed_bytes > 0
+    with open(source.path, 'rb') as f:
+        assert f.read() == gzip.decompress(FILES['/b.gz'])
+    assert _leftovers(tmp_path) == []
+
+
+def test_checksum_mismatch(server, tmp_path):
+    manifest = str(tmp_path / 'manifest.json')
+    source = ingest.Source(str(tmp_path / 'a.txt'), server.url('/a.txt'))
+    ingest.download([source], manifest)
+    entry = read_json(manifest)[source.path]
+
+    source.sha256 = '0' * 64
+    report = ingest.download([source], manifest)
+    assert report.failed[source.path].startswith(ingest.ChecksumError.__name__)
+    with open(source.path, 'rb') as f:
+        assert f.read() == FILES['/a.txt']
+    assert read_json(manifest)[source.path] == entry
+    assert _leftovers(tmp_path) == []
@@ -1,12 +1,19 @@
 from .hpo import HPO, HPOEntry
+from .compact_hpo import CompactHPO, CompactHPOEntry
 from .obo import read_hpo_from_obo
-from .viz import make_graph_to_depth, make_graph_2
-from .to_hpo import add_hpo_information
+from .viz import make_graph_to_depth, make_graph_2, Subgraph, extract_subgraph, extract_subgraphs, patient_graphs, \
+    render_graphs
+from .to_hpo import add_hpo_information, AnnotationReport
+from .columnar import ColumnarTable, ColumnarWriter
 from .design import *
+from .ingest import ChecksumError, Source, IngestReport, download
+from . import instrument
 
 __all__ = [
-    'HPO', 'HPOEntry', 'read_hpo_from_obo',
-    'make_graph_to_depth', 'make_graph_2',
-    'add_hpo_information',
+    'HPO', 'HPOEntry', 'CompactHPO', 'CompactHPOEntry', 'read_hpo_from_obo',
+    'make_graph_to_depth', 'make_graph_2', 'Subgraph', 'extract_subgraph', 'extract_subgraphs', 'patient_graphs',
+    'render_graphs',
+    'add_hpo_information', 'AnnotationReport', 'ColumnarTable', 'ColumnarWriter',
+    'ChecksumError', 'Source', 'IngestReport', 'download', 'instrument',
     'INTENSE_BLUE', 'LIGHT_BLUE', 'BASIC_BLUE', 'BASIC_GREY', 'FONT',
 ]
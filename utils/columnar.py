@@ -0,0 +1,185 @@
+import json
+import os
+from typing import Iterable, Optional
+import numpy as np
+import pandas as pd
+from .files import read_json, write_json
+
+# A table is stored as directory with one file per column and a `meta.json` file:
+# - integer columns: `<i>.int64`, the raw little-endian int64 values.
+#   Missing values are stored as `MISSING_INTEGER`
+# - string columns are dictionary encoded: `<i>.codes`, the raw little-endian int32 position
+#   of each value in `<i>.dictionary.json`, a json list of the distinct values
+# - `meta.json`: the version, the number of rows and the name and kind of each column
+# The column files can be memory-mapped, e.g. by several worker processes at once.
+
+COLUMNAR_VERSION = 1
+'increased whenever the format of the columnar tables changes'
+MISSING_INTEGER = -1
+'stored for missing values of integer columns'
+
+_DTYPES = {'integer': np.dtype('<i8'), 'string': np.dtype('<i4')}
+_SUFFIXES = {'integer': 'int64', 'string': 'codes'}
+
+
+def is_columnar(path: str) -> bool:
+    'checks whether `path` is a table written by `ColumnarWriter`'
+    return os.path.isfile(os.path.join(path, 'meta.json'))
+
+
+class ColumnarWriter:
+    '''writes a table chunk by chunk to the directory `path`, see the format above.
+    The table is complete once `close` is called.
+    '''
+
+    def __init__(self, path: str, integer_columns: Iterable[str] = (), rows: Optional[int] = None):
+        '''parameters:
+        - `integer_columns`: the columns stored as integers, all other columns are stored as strings
+        - `rows`: appends to the existing table at `path`, after its first `rows` rows.
+        Rows written after them (e.g. by an interrupted writer) are dropped.
+        '''
+        self.path = path
+        self.integer_columns = set(integer_columns)
+        self.columns: Optional[list[str]] = None
+        self.kinds: list[str] = []
+        self.rows = 0
+        self._files = []
+        self._dictionaries: list[dict[str, int]] = []
+        os.makedirs(path, exist_ok=True)
+        if rows is None:
+            # the table is incomplete until `close` writes the meta data again
+            if os.path.exists(os.path.join(path, 'meta.json')):
+                os.remove(os.path.join(path, 'meta.json'))
+        else:
+            table = ColumnarTable(path)
+            assert rows <= len(table), \
+                f'cannot append after row {rows}, the table has only {len(table)} rows'
+            self._open(table.columns, table.kinds, 'r+b')
+            for i, file in enumerate(self._files):
+                file.truncate(rows * _DTYPES[self.kinds[i]].itemsize)
+                file.seek(0, os.SEEK_END)
+            self._dictionaries = [{value: code for code, value in enumerate(table.dictionary(column))}
+                                  if kind == 'string' else {} for column, kind in zip(table.columns, table.kinds)]
+            self.rows = rows
+
+    def _open(self, columns: list[str], kinds: list[str], mode: str):
+        self.columns, self.kinds = columns, kinds
+        self._files = [open(self._column_path(i, kind), mode)
+                       for i, kind in enumerate(kinds)]
+        self._dictionaries = [{} for _ in columns]
+
+    def _column_path(self, i: int, kind: str) -> str:
+        return os.path.join(self.path, f'{i}.{_SUFFIXES[kind]}')
+
+    def write(self, chunk: pd.DataFrame):
+        'appends the rows of `chunk`, its columns must be the same for every chunk'
+        columns = [str(column) for column in chunk.columns]
+        if self.columns is None:
+            self._open(columns, ['integer' if column in self.integer_columns else 'string'
+                                 for column in columns], 'wb')
+        assert columns == self.columns, f'expected the columns {self.columns}, got {columns}'
+        for i, kind in enumerate(self.kinds):
+            values = chunk.iloc[:, i]
+            if kind == 'integer':
+                values = pd.to_numeric(values.replace('', np.nan))
+                data = values.fillna(MISSING_INTEGER).to_numpy(_DTYPES[kind])
+            else:
+                codes, uniques = pd.factorize(values.fillna(''))
+                data = self._encode(i, uniques)[codes]
+            self._files[i].write(data.tobytes())
+        self.rows += len(chunk.index)
+
+    def _encode(self, i: int, values: Iterable[str]) -> np.ndarray:
+        'returns the codes of `values` in the dictionary of column `i`, adding the new values'
+        dictionary = self._dictionaries[i]
+        return np.array([dictionary.setdefault(value, len(dictionary)) for value in values],
+                        dtype=_DTYPES['string'])
+
+    def extend(self, table: 'ColumnarTable'):
+        'appends all rows of `table`, which must have the same columns'
+        if self.columns is None:
+            self._open(table.columns, table.kinds, 'wb')
+        assert table.columns == self.columns and table.kinds == self.kinds, \
+            f'expected the columns {self.columns}, got {table.columns}'
+        for i, (column, kind) in enumerate(zip(self.columns, self.kinds)):
+            if kind == 'integer':
+                data = table.integers(column)
+            else:
+                data = self._encode(i, table.dictionary(column))[
+                    table.codes(column)]
+            self._files[i].write(np.ascontiguousarray(data).tobytes())
+        self.rows += len(table)
+
+    def close(self):
+        'writes the dictionaries and the meta data'
+        if self.columns is None:
+            self._open([], [], 'wb')
+        for file in self._files:
+            file.close()
+        for i, kind in enumerate(self.kinds):
+            if kind == 'string':
+                write_json(os.path.join(self.path, f'{i}.dictionary.json'),
+                           list(self._dictionaries[i]))
+        write_json(os.path.join(self.path, 'meta.json'), {
+            'version': COLUMNAR_VERSION,
+            'rows': self.rows,
+            'columns': [{'name': column, 'kind': kind} for column, kind in zip(self.columns, self.kinds)],
+        })
+
+    def __enter__(self) -> 'ColumnarWriter':
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+class ColumnarTable:
+    '''a table written by `ColumnarWriter`. The columns are memory-mapped when accessed'''
+
+    def __init__(self, path: str):
+        self.path = path
+        meta = read_json(os.path.join(path, 'meta.json'))
+        assert meta is not None, f'{path} is not a columnar table'
+        assert meta['version'] == COLUMNAR_VERSION, \
+            f'{path} has version {meta["version"]}, expected {COLUMNAR_VERSION}'
+        self.rows: int = meta['rows']
+        self.columns: list[str] = [column['name']
+                                   for column in meta['columns']]
+        self.kinds: list[str] = [column['kind'] for column in meta['columns']]
+
+    def __len__(self) -> int:
+        return self.rows
+
+    def _column(self, column: str, kind: str) -> np.ndarray:
+        i = self.columns.index(column)
+        assert self.kinds[i] == kind, f'column {column} is not an {kind} column'
+        if self.rows == 0:
+            return np.empty(0, dtype=_DTYPES[kind])
+        return np.memmap(os.path.join(self.path, f'{i}.{_SUFFIXES[kind]}'),
+                         dtype=_DTYPES[kind], mode='r', shape=(self.rows,))
+
+    def integers(self, column: str) -> np.ndarray:
+        'the values of an integer column, memory-mapped'
+        return self._column(column, 'integer')
+
+    def codes(self, column: str) -> np.ndarray:
+        'the positions in `dictionary(column)` of the values of a string column, memory-mapped'
+        return self._column(column, 'string')
+
+    def dictionary(self, column: str) -> list[str]:
+        'the distinct values of a string column'
+        with open(os.path.join(self.path, f'{self.columns.index(column)}.dictionary.json')) as f:
+            return json.load(f)
+
+    def to_pandas(self, columns: Optional[list[str]] = None) -> pd.DataFrame:
+        '''reads the `columns` (by default all) into a data frame.
+        String columns become categoricals, so the values are not copied for every row.
+        '''
+        data = {}
+        for column in self.columns if columns is None else columns:
+            if self.kinds[self.columns.index(column)] == 'integer':
+                data[column] = np.asarray(self.integers(column))
+            else:
+                data[column] = pd.Categorical.from_codes(
+                    np.asarray(self.codes(column)), categories=self.dictionary(column))
+        return pd.DataFrame(data)
@@ -0,0 +1,161 @@
+import json
+from collections.abc import Mapping
+from typing import Iterable, Iterator, Optional
+import numpy as np
+from . import csr
+from .closure import AncestorIndex
+from .compiled_hpo import decode_strings
+
+
+class CompactHPOEntry:
+    '''view of an entry of a `CompactHPO`.
+    Provides the same attributes as `HPOEntry`, but does not store any data itself.
+    '''
+    __slots__ = ('_hpo', '_index')
+
+    def __init__(self, hpo: 'CompactHPO', index: int):
+        self._hpo = hpo
+        self._index = index
+
+    @property
+    def id(self) -> str:
+        return self._hpo.ids[self._index]
+
+    @property
+    def name(self) -> str:
+        return self._hpo.names[self._index]
+
+    @property
+    def other_tags(self) -> dict[str, list[str]]:
+        return self._hpo.other_tags(self._index)
+
+    @property
+    def _parents(self) -> list['CompactHPOEntry']:
+        return self._hpo._entries(self._hpo.parent_indices[
+            self._hpo.parent_indptr[self._index]:self._hpo.parent_indptr[self._index + 1]])
+
+    @property
+    def _children(self) -> list['CompactHPOEntry']:
+        return self._hpo._entries(self._hpo.child_indices[
+            self._hpo.child_indptr[self._index]:self._hpo.child_indptr[self._index + 1]])
+
+    def add_all_parents(self, s: set[str]):
+        'adds the ids of all ancestors to `s`'
+        s.update(self._hpo.ancestor_index.ancestors([self.id]))
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, CompactHPOEntry) and \
+            self._hpo is other._hpo and self._index == other._index
+
+    def __hash__(self) -> int:
+        return hash((id(self._hpo), self._index))
+
+    def __repr__(self) -> str:
+        return f'<Entry {self.id} "{self.name}">'
+
+
+class _EntriesById(Mapping):
+    'maps the ids of a `CompactHPO` to `CompactHPOEntry` views'
+
+    def __init__(self, hpo: 'CompactHPO'):
+        self._hpo = hpo
+
+    def __getitem__(self, id: str) -> CompactHPOEntry:
+        return CompactHPOEntry(self._hpo, self._hpo.index[id])
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._hpo.ids)
+
+    def __len__(self) -> int:
+        return len(self._hpo.ids)
+
+
+class CompactHPO:
+    '''contains the human phenotype ontology, stored in arrays instead of one object per entry.
+
+    Each entry is identified by its position in `ids`.
+    The parents and children are stored as CSR structures (see `utils.csr`),
+    the tags we do not (yet) care about are only decoded when they are accessed.
+
+    `entries_by_id`, `proper_id` and `root` behave like the ones of `HPO`.
+    '''
+
+    def __init__(self, arrays):
+        '''`arrays`: the arrays of a compiled HPO, see `utils.compiled_hpo.compile_hpo`'''
+        self.ids: list[str] = decode_strings(arrays['ids'])
+        self.names: list[str] = decode_strings(arrays['names'])
+        self.index = {id: i for i, id in enumerate(self.ids)}
+        'maps the id to the position of the entry'
+
+        self.parent_indptr: np.ndarray = arrays['parent_indptr']
+        self.parent_indices: np.ndarray = arrays['parent_indices']
+        self.child_indptr, self.child_indices = csr.transpose(
+            self.parent_indptr, self.parent_indices, len(self.ids))
+
+        self._other_tags: bytes = arrays['other_tags'].tobytes()
+        self._other_tags_offsets: np.ndarray = arrays['other_tags_offsets']
+
+        self.proper_id = dict(zip(self.ids, self.ids))
+        'maps alt_id to the correct id'
+        self.proper_id.update(zip(decode_strings(arrays['alt_ids']),
+                                  [self.ids[i] for i in arrays['alt_targets'].tolist()]))
+
+        self.entries_by_id = _EntriesById(self)
+        roots = np.flatnonzero(np.diff(self.parent_indptr) == 0)
+        assert len(
+            roots) == 1, f'{len(roots)} entries with 0 parents found: {self._entries(roots)}'
+        self.root = CompactHPOEntry(self, int(roots[0]))
+        self._ancestor_index: Optional[AncestorIndex] = None
+
+    @property
+    def ancestor_index(self) -> AncestorIndex:
+        'the transitive closure of the parents, built on first access'
+        if self._ancestor_index is None:
+            self._ancestor_index = AncestorIndex(
+                self.ids, self.parent_indptr, self.parent_indices)
+        return self._ancestor_index
+
+    def is_ancestor(self, ancestor: str, id: str) -> bool:
+        'checks whether `ancestor` is an ancestor of `id`'
+        return self.ancestor_index.is_ancestor(ancestor, id)
+
+    def _entries(self, indices: Iterable[int]) -> list[CompactHPOEntry]:
+        return [CompactHPOEntry(self, i) for i in np.asarray(indices).tolist()]
+
+    def other_tags(self, i: int) -> dict[str, list[str]]:
+        'decodes the tags of entry `i` we do not (yet) care about'
+        start = self._other_tags_offsets[i]
+        end = self._other_tags_offsets[i + 1] - 1
+        return json.loads(self._other_tags[start:end])
+
+    def indices(self, ids: Iterable[str]) -> np.ndarray:
+        'returns the positions of the entries with the given `ids`'
+        return np.fromiter((self.index[id] for id in ids), dtype=np.int64)
+
+    def _closure(self, indptr: np.ndarray, indices: np.ndarray, start: np.ndarray) -> np.ndarray:
+        'breadth-first search from the entries `start` along the CSR structure'
+        reached = np.zeros(len(self.ids), dtype=bool)
+        frontier = np.unique(start)
+        while len(frontier):
+            next = csr.gather_rows(indptr, indices, frontier)
+            next = np.unique(next[~reached[next]])
+            reached[next] = True
+            frontier = next
+        return np.flatnonzero(reached)
+
+    def ancestor_indices(self, indices: np.ndarray) -> np.ndarray:
+        'returns the positions of all ancestors of the entries at `indices`, sorted'
+        return self._closure(self.parent_indptr, self.parent_indices, indices)
+
+    def descendant_indices(self, indices: np.ndarray) -> np.ndarray:
+        'returns the positions of all descendants of the entries at `indices`, sorted'
+        return self._closure(self.child_indptr, self.child_indices, indices)
+
+    def ancestors(self, ids: Iterable[str]) -> set[str]:
+        'returns the ids of all ancestors of the entries with the given `ids`'
+        return {self.ids[i] for i in self.ancestor_indices(self.indices(ids)).tolist()}
+
+    def descendants(self, ids: Iterable[str]) -> set[str]:
+        'returns the ids of all descendants of the entries with the given `ids`'
+        return {self.ids[i] for i in self.descendant_indices(self.indices(ids)).tolist()}
+
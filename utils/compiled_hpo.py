@@ -0,0 +1,141 @@
+import gc
+import glob
+import json
+import os
+from contextlib import contextmanager
+from typing import Optional
+import numpy as np
+from .hpo import HPO, HPOEntry
+
+# A parsed HPO is stored as `.npz` file of plain arrays, so it can be loaded without pickle:
+# - `ids`, `names`: all entries, strings joined with line breaks and utf-8 encoded
+# - `parent_indptr`, `parent_indices`: the parents of entry `i` are
+#   `parent_indices[parent_indptr[i]:parent_indptr[i+1]]`
+# - `alt_ids`, `alt_targets`: alt_id `alt_ids[j]` belongs to entry `alt_targets[j]`
+# - `other_tags`: json encoded list with the `other_tags` of each entry. The `other_tags` of entry `i`
+#   are the json object in the bytes `other_tags[other_tags_offsets[i]:other_tags_offsets[i+1]-1]`
+
+COMPILED_VERSION = 3
+'increased whenever the format of the compiled files changes'
+
+
+def encode_strings(strings: list[str]) -> np.ndarray:
+    assert not any('\n' in s for s in strings)
+    return np.frombuffer('\n'.join(strings).encode(), dtype=np.uint8)
+
+
+def decode_strings(array: np.ndarray) -> list[str]:
+    text = array.tobytes().decode()
+    return text.split('\n') if text else []
+
+
+@contextmanager
+def paused_gc():
+    '''pauses the garbage collector while many long-lived objects are created,
+    it would walk all objects created so far again and again'''
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _encode_json_list(values: list) -> tuple[np.ndarray, np.ndarray]:
+    '''encodes `values` as json list and returns it together with the byte offsets of the values.
+    value `i` ends one byte (the following comma or bracket) before value `i+1` starts.
+    '''
+    parts = [json.dumps(value).encode() for value in values]
+    offsets = np.ones(len(parts) + 1, dtype=np.int64)  # skip the opening bracket
+    offsets[1:] += np.cumsum([len(part) + 1 for part in parts], dtype=np.int64)
+    return np.frombuffer(b'[' + b','.join(parts) + b']', dtype=np.uint8), offsets
+
+
+def compile_hpo(hpo: HPO, digest: str) -> dict[str, np.ndarray]:
+    'converts `hpo` to arrays. `digest` identifies the .obo file `hpo` was read from'
+    entries = list(hpo.entries_by_id.values())
+    index = {entry.id: i for i, entry in enumerate(entries)}
+
+    parent_indptr = np.zeros(len(entries) + 1, dtype=np.int32)
+    parent_indptr[1:] = np.cumsum([len(entry._parents) for entry in entries])
+    parent_indices = np.array([index[parent.id] for entry in entries for parent in entry._parents],
+                              dtype=np.int32)
+
+    alt_ids = [alt_id for alt_id, id in hpo.proper_id.items() if alt_id != id]
+    alt_targets = np.array([index[hpo.proper_id[alt_id]] for alt_id in alt_ids],
+                           dtype=np.int32)
+
+    other_tags, other_tags_offsets = _encode_json_list(
+        [entry.other_tags for entry in entries])
+    return {
+        'version': np.array(COMPILED_VERSION),
+        'digest': np.array(digest),
+        'ids': encode_strings([entry.id for entry in entries]),
+        'names': encode_strings([entry.name for entry in entries]),
+        'parent_indptr': parent_indptr,
+        'parent_indices': parent_indices,
+        'alt_ids': encode_strings(alt_ids),
+        'alt_targets': alt_targets,
+        'other_tags': other_tags,
+        'other_tags_offsets': other_tags_offsets,
+    }
+
+
+def hpo_from_compiled(arrays) -> HPO:
+    '''builds the `HPO` from the arrays created by `compile_hpo`.
+    The `other_tags` of each entry are only decoded when they are accessed'''
+    ids = decode_strings(arrays['ids'])
+    names = decode_strings(arrays['names'])
+    other_tags_bytes = arrays['other_tags'].tobytes()
+    offsets = arrays['other_tags_offsets'].tolist()
+    other_tags = [other_tags_bytes[start:end - 1] for start, end in zip(offsets, offsets[1:])]
+    parent_indices = arrays['parent_indices'].tolist()
+    child_indices = np.repeat(np.arange(len(ids)), np.diff(arrays['parent_indptr'])).tolist()
+
+    proper_id = dict(zip(ids, ids))
+    proper_id.update(zip(decode_strings(arrays['alt_ids']),
+                         [ids[i] for i in arrays['alt_targets'].tolist()]))
+
+    # the arrays come from a valid HPO, so the entries are connected without any checks
+    with paused_gc():
+        entries = [HPOEntry(id, name, tags)
+                   for id, name, tags in zip(ids, names, other_tags)]
+        for child, parent in zip(child_indices, parent_indices):
+            entries[child]._parents.append(entries[parent])
+            entries[parent]._children.append(entries[child])
+    return HPO.from_connected_entries(entries, proper_id)
+
+
+def compiled_path(obo_path: str, digest: str, cache_dir: Optional[str] = None) -> str:
+    '''returns the path of the compiled version of the .obo file at `obo_path` with content `digest`.
+    By default it is stored next to the .obo file.
+    '''
+    directory = cache_dir if cache_dir is not None else os.path.dirname(obo_path)
+    return os.path.join(directory, f'{os.path.basename(obo_path)}.{digest[:16]}.npz')
+
+
+def save_compiled(path: str, arrays: dict[str, np.ndarray]):
+    '''stores the `arrays` of a compiled HPO at `path`, see `compile_hpo`.
+    Compiled files of older versions of the same .obo file are removed.
+    '''
+    tmp_path = f'{path}.tmp.npz'
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+    prefix = path[:-len('0123456789abcdef.npz')]
+    for old_path in glob.glob(glob.escape(prefix) + '?' * 16 + '.npz'):
+        if old_path != path:
+            os.remove(old_path)
+
+
+def load_compiled(path: str, digest: str) -> Optional[dict[str, np.ndarray]]:
+    '''loads the arrays of the compiled HPO stored at `path`.
+    Returns `None` if there is no compiled file for the .obo file with content `digest`.
+    '''
+    try:
+        with np.load(path) as arrays:
+            if int(arrays['version']) != COMPILED_VERSION or str(arrays['digest']) != digest:
+                return None
+            return dict(arrays)
+    except (OSError, KeyError, ValueError):
+        return None
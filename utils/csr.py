@@ -0,0 +1,76 @@
+import itertools
+from typing import Collection, Iterable
+import numpy as np
+
+# Helpers for compressed sparse row (CSR) structures:
+# row `i` of `(indptr, indices)` is `indices[indptr[i]:indptr[i+1]]`
+
+
+def from_lists(rows: Iterable[Collection[int]]) -> tuple[np.ndarray, np.ndarray]:
+    'builds the CSR structure with the given `rows`'
+    rows = list(rows)
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(row) for row in rows])
+    indices = np.fromiter(itertools.chain.from_iterable(rows),
+                          dtype=np.int32, count=indptr[-1])
+    return indptr, indices
+
+
+def unique(values: np.ndarray) -> np.ndarray:
+    'returns the sorted distinct `values`. On large integer arrays sorting is faster than `np.unique`'
+    values = np.sort(values)
+    if len(values) == 0:
+        return values
+    return values[np.concatenate([[True], values[1:] != values[:-1]])]
+
+
+def from_pairs(rows: np.ndarray, columns: np.ndarray, n_rows: int, n_columns: int) -> tuple[np.ndarray, np.ndarray]:
+    'builds the CSR structure with an entry for each `(row, column)` pair. The rows are sorted and without duplicates'
+    # sorting the pairs removes the duplicates within each row
+    pairs = unique(np.asarray(rows, dtype=np.int64) * n_columns + columns)
+    indptr = np.zeros(n_rows + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(pairs // n_columns, minlength=n_rows))
+    return indptr, (pairs % n_columns).astype(np.int32)
+
+
+def sort_rows(indptr: np.ndarray, indices: np.ndarray) -> np.ndarray:
+    'returns `indices` with the entries of each row sorted'
+    return indices[np.lexsort((indices, row_ids(indptr)))]
+
+
+def row_ids(indptr: np.ndarray) -> np.ndarray:
+    'returns the row of every entry of the CSR structure'
+    return np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+
+
+def gather_rows(indptr: np.ndarray, indices: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    'returns the concatenated `indices` of `rows`'
+    rows = np.asarray(rows, dtype=np.int64)
+    return indices[ranges(indptr[rows], indptr[rows + 1])]
+
+
+def ranges(starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    'returns the concatenated positions `starts[i]:ends[i]`'
+    starts = np.asarray(starts, dtype=np.int64)
+    lengths = np.asarray(ends, dtype=np.int64) - starts
+    # position of each entry = start of its range + its position within the range
+    shifts = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    return shifts + np.arange(len(shifts))
+
+
+def to_dense(indptr: np.ndarray, indices: np.ndarray, rows: np.ndarray, columns: int,
+             dtype=np.float32) -> np.ndarray:
+    'returns the `rows` as dense matrix with `columns` columns, with ones at the entries'
+    rows = np.asarray(rows, dtype=np.int64)
+    result = np.zeros((len(rows), columns), dtype=dtype)
+    result[np.repeat(np.arange(len(rows)), np.diff(indptr)[rows]),
+           gather_rows(indptr, indices, rows)] = 1
+    return result
+
+
+def transpose(indptr: np.ndarray, indices: np.ndarray, columns: int) -> tuple[np.ndarray, np.ndarray]:
+    'transposes the CSR structure. The entries of each new row keep the order of the old rows'
+    order = np.argsort(indices, kind='stable')
+    t_indptr = np.zeros(columns + 1, dtype=np.int64)
+    t_indptr[1:] = np.cumsum(np.bincount(indices, minlength=columns))
+    return t_indptr, row_ids(indptr)[order].astype(indices.dtype)
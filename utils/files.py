@@ -0,0 +1,46 @@
+import hashlib
+import json
+import os
+from typing import Any, Optional
+
+
+def file_digest(path: str, algorithm: str = 'sha256') -> str:
+    'returns the hex digest of the content of the file at `path`'
+    return range_digest(path, 0, os.path.getsize(path), algorithm)
+
+
+def range_digest(path: str, start: int, end: int, algorithm: str = 'sha256') -> str:
+    'returns the hex digest of the bytes `[start, end)` of the file at `path`'
+    h = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            block = f.read(min(remaining, 1 << 20))
+            if not block:
+                break
+            h.update(block)
+            remaining -= len(block)
+    return h.hexdigest()
+
+
+def string_digest(text: str, algorithm: str = 'sha256') -> str:
+    'returns the hex digest of the utf-8 encoded `text`'
+    return hashlib.new(algorithm, text.encode()).hexdigest()
+
+
+def read_json(path: str) -> Optional[Any]:
+    'reads the json file at `path`, returns `None` if it does not exist or is broken'
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_json(path: str, data: Any):
+    'writes `data` to `path`. The file is replaced at once, so it is never half written'
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=1)
+    os.replace(tmp_path, path)
@@ -1,19 +1,37 @@
+import json
+from typing import Optional, Union
+import numpy as np
+from .closure import AncestorIndex
+
+
 class HPOEntry:
     'represents an entry of the human phenotype ontology.'
+    __slots__ = ('id', 'name', '_other_tags', '_parents', '_children')
 
     def __init__(self,
                  id: str, name: str,
-                 other_tags: dict[str, list[str]]):
+                 other_tags: Union[dict[str, list[str]], bytes]):
+        '''`other_tags` can also be the json encoded tags, they are decoded on first access'''
         self.id = id
         'the ID of the entry. example: "HP:0000118"'
         self.name = name
         'the name of the entry example "Phenotypic abnormality"'
-        self.other_tags = other_tags
-        'contains all the data for this entry from the .obo file we do not (yet) care about'
+        self._other_tags = other_tags
 
         self._parents: list[HPOEntry] = []
         self._children: list[HPOEntry] = []
 
+    @property
+    def other_tags(self) -> dict[str, list[str]]:
+        'contains all the data for this entry from the .obo file we do not (yet) care about'
+        if isinstance(self._other_tags, bytes):
+            self._other_tags = json.loads(self._other_tags)
+        return self._other_tags
+
+    @other_tags.setter
+    def other_tags(self, other_tags: dict[str, list[str]]):
+        self._other_tags = other_tags
+
     def add_parent(self, parent: "HPOEntry"):
         assert self not in parent._children and parent not in self._parents
         self._parents.append(parent)
@@ -23,9 +41,15 @@ class HPOEntry:
         return f'<Entry {self.id} "{self.name}">'
 
     def add_all_parents(self, s: set[str]):
-        for parent in self._parents:
-            s.add(parent.id)
-            parent.add_all_parents(s)
+        'adds the ids of all ancestors to `s`. Each ancestor is visited only once'
+        visited: set[str] = set()
+        stack = list(self._parents)
+        while stack:
+            parent = stack.pop()
+            if parent.id not in visited:
+                visited.add(parent.id)
+                stack.extend(parent._parents)
+        s.update(visited)
 
 
 augmented_entry = tuple[HPOEntry, list[str], list[str]]
@@ -54,3 +78,37 @@ class HPO:
         assert len(
             roots) == 1, f'{len(roots)} entries with 0 parents found: {roots}'
         self.root = roots[0]
+        self._ancestor_index: Optional[AncestorIndex] = None
+
+    @classmethod
+    def from_connected_entries(cls, entries: list[HPOEntry], proper_id: dict[str, str]) -> 'HPO':
+        '''creates the HPO from entries whose parents and children are connected already.
+        `proper_id` maps all ids and alt_ids to the correct id.
+        '''
+        hpo = cls.__new__(cls)
+        hpo.entries_by_id = {e.id: e for e in entries}
+        hpo.proper_id = proper_id
+        roots = [e for e in entries if len(e._parents) == 0]
+        assert len(
+            roots) == 1, f'{len(roots)} entries with 0 parents found: {roots}'
+        hpo.root = roots[0]
+        hpo._ancestor_index = None
+        return hpo
+
+    @property
+    def ancestor_index(self) -> AncestorIndex:
+        'the transitive closure of the parents, built on first access'
+        if self._ancestor_index is None:
+            entries = list(self.entries_by_id.values())
+            index = {entry.id: i for i, entry in enumerate(entries)}
+            parent_indptr = np.zeros(len(entries) + 1, dtype=np.int64)
+            parent_indptr[1:] = np.cumsum([len(e._parents) for e in entries])
+            parent_indices = np.array([index[p.id] for e in entries for p in e._parents],
+                                      dtype=np.int32)
+            self._ancestor_index = AncestorIndex(
+                [entry.id for entry in entries], parent_indptr, parent_indices)
+        return self._ancestor_index
+
+    def is_ancestor(self, ancestor: str, id: str) -> bool:
+        'checks whether `ancestor` is an ancestor of `id`'
+        return self.ancestor_index.is_ancestor(ancestor, id)
@@ -0,0 +1,309 @@
+import hashlib
+import os
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Optional
+import requests
+import tqdm
+from . import instrument
+from .files import read_json, write_json
+
+# Downloads the source files of the project (see `setup.ipynb`).
+#
+# The files are streamed to disk in chunks, gzip files are decompressed while they are downloaded.
+# The raw bytes are kept in `<path>.part` until a file is complete, so an interrupted download is
+# resumed with a range request. The manifest stores the checksum, size and HTTP validators of each
+# downloaded file, files that did not change since are not downloaded again.
+
+
+class ChecksumError(ValueError):
+    'a downloaded file does not have the expected checksum'
+
+
+class Source:
+    'a file to download from `url` to `path`'
+
+    def __init__(self, path: str, url: str, extract: bool = False, sha256: Optional[str] = None):
+        self.path = path
+        self.url = url
+        self.extract = extract
+        'whether the downloaded file is gzip compressed and `path` is the decompressed file'
+        self.sha256 = sha256
+        'the expected checksum of the file at `path`, not checked if `None`'
+
+    def __repr__(self) -> str:
+        return f'<Source {self.path} from {self.url}>'
+
+
+class IngestReport:
+    'the outcome of `download`'
+
+    def __init__(self):
+        self.downloaded: list[str] = []
+        'the paths of the downloaded files'
+        self.skipped: list[str] = []
+        'the paths of the files that did not change'
+        self.failed: dict[str, str] = {}
+        'the error of each file that could not be downloaded'
+        self.received_bytes = 0
+        self.resumed_bytes = 0
+        'the bytes of partial downloads that did not need to be downloaded again'
+
+    def __repr__(self) -> str:
+        return (f'<IngestReport downloaded={len(self.downloaded)} skipped={len(self.skipped)} '
+                f'failed={len(self.failed)}>')
+
+    def __str__(self) -> str:
+        return '\n'.join([
+            f'downloaded {len(self.downloaded)} files ({self.received_bytes / 2**20:.1f} MB, '
+            f'{self.resumed_bytes / 2**20:.1f} MB resumed)',
+            f'skipped {len(self.skipped)} unchanged files',
+            *(f'failed {path}: {error}' for path, error in self.failed.items()),
+        ])
+
+
+def download(
+    sources: Iterable[Source],
+    manifest_path: str = 'data/ingest_manifest.json',
+    workers: int = 4,
+    refresh: bool = False,
+    retries: int = 3,
+    chunk_size: int = 1 << 16,
+    timeout: float = 60,
+) -> IngestReport:
+    '''downloads the `sources`, `workers` of them at the same time.
+
+    A file is skipped if it is unchanged since it was downloaded, according to `manifest_path`.
+    With `refresh` the server is asked whether the file changed instead (using its ETag or
+    Last-Modified). A broken connection is resumed up to `retries` times, an interrupted download
+    is resumed by the next call. A download whose checksum does not match `Source.sha256` fails with
+    a `ChecksumError`: it is removed, while the file at `Source.path` and its manifest entry stay as
+    they were. The files that fail do not stop the others, they are listed in the returned report.
+    '''
+    sources = list(sources)
+    assert len({os.path.abspath(source.path) for source in sources}) == len(sources), \
+        'the sources must have different paths'
+    manifest = _Manifest(manifest_path)
+    report = IngestReport()
+    progress = tqdm.tqdm(unit='B', unit_scale=True, unit_divisor=1024, desc='downloading')
+
+    def run(source: Source):
+        try:
+            with instrument.stage('download', path=source.path):
+                _download(source, manifest, report, progress, refresh, retries, chunk_size, timeout)
+        except Exception as e:
+            with manifest.lock:
+                report.failed[source.path] = f'{type(e).__name__}: {e}'
+            tqdm.tqdm.write(f'Failed {source.path}: {type(e).__name__}: {e}')
+
+    with progress, ThreadPoolExecutor(max(1, workers)) as executor:
+        # the threads mostly wait for the network and the disk
+        list(executor.map(run, sources))
+    return report
+
+
+class _Manifest:
+    'the downloaded files by path, written after every file so an interrupted run keeps its progress'
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: dict[str, dict] = read_json(path) or {}
+        self.lock = threading.Lock()
+        'guards the manifest and the report, shared by the threads of `download`'
+
+    def get(self, path: str) -> Optional[dict]:
+        with self.lock:
+            return self.entries.get(path)
+
+    def set(self, path: str, entry: dict):
+        with self.lock:
+            self.entries[path] = entry
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            write_json(self.path, self.entries)
+
+
+def _unchanged(source: Source, entry: Optional[dict]) -> bool:
+    'whether the file at `source.path` is the one described by its manifest `entry`'
+    if entry is None or entry['url'] != source.url or entry['extract'] != source.extract:
+        return False
+    if source.sha256 is not None and entry['sha256'] != source.sha256:
+        return False
+    try:
+        stat = os.stat(source.path)
+    except OSError:
+        return False
+    return stat.st_size == entry['size'] and stat.st_mtime_ns == entry['mtime_ns']
+
+
+def _download(source: Source, manifest: _Manifest, report: IngestReport, progress: tqdm.tqdm,
+              refresh: bool, retries: int, chunk_size: int, timeout: float):
+    entry = manifest.get(source.path)
+    unchanged = _unchanged(source, entry)
+    if unchanged and not refresh:
+        with manifest.lock:
+            report.skipped.append(source.path)
+        return
+
+    directory = os.path.dirname(source.path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    part_path = f'{source.path}.part'
+    with requests.Session() as session:
+        for attempt in range(retries + 1):
+            try:
+                response = _request(session, source, entry if unchanged else None, part_path, timeout)
+                break
+            except requests.ConnectionError:
+                if attempt == retries:
+                    raise
+        if response is None:
+            with manifest.lock:
+                report.skipped.append(source.path)
+            return
+        for attempt in range(retries + 1):
+            try:
+                digest, validators = _stream(source, response, part_path, manifest, report, progress, chunk_size)
+                break
+            except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError):
+                # the next request resumes from the end of the part file
+                if attempt == retries:
+                    raise
+                response = _request(session, source, None, part_path, timeout)
+
+    stat = os.stat(source.path)
+    manifest.set(source.path, {
+        'url': source.url, 'extract': source.extract, 'sha256': digest,
+        'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, **validators,
+    })
+    with manifest.lock:
+        report.downloaded.append(source.path)
+    tqdm.tqdm.write(f'Downloaded {source.path}')
+
+
+def _request(session: requests.Session, source: Source, entry: Optional[dict], part_path: str,
+             timeout: float) -> Optional[requests.Response]:
+    '''starts the download of `source`, resuming the part file if the server allows it.
+    With the manifest `entry` of an unchanged file, returns `None` if the server has the same file.'''
+    # the range of a compressed transfer would not match the bytes of the part file
+    headers = {'Accept-Encoding': 'identity'}
+    part = read_json(f'{part_path}.json')
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    validator = None
+    if part is not None and part['url'] == source.url:
+        validator = part.get('etag') or part.get('last_modified')
+    if offset > 0 and validator is not None:
+        headers['Range'] = f'bytes={offset}-'
+        # the server sends the whole file instead if it changed since the part was downloaded
+        headers['If-Range'] = validator
+    elif entry is not None:
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+    response = session.get(source.url, headers=headers, stream=True, timeout=timeout)
+    if response.status_code == 304:
+        response.close()
+        return None
+    if response.status_code == 416:
+        # the part file does not fit the file on the server anymore
+        response.close()
+        _remove_part(part_path)
+        return _request(session, source, entry, part_path, timeout)
+    response.raise_for_status()
+    return response
+
+
+def _stream(source: Source, response: requests.Response, part_path: str, manifest: _Manifest,
+            report: IngestReport, progress: tqdm.tqdm, chunk_size: int) -> tuple[str, dict]:
+    '''writes the body of `response` to the part file, and the (decompressed) file to `source.path`
+    if its checksum matches. Returns the checksum of the file and the validators of the response'''
+    validators = {name: response.headers[header] for name, header in
+                  [('etag', 'ETag'), ('last_modified', 'Last-Modified')] if header in response.headers}
+    offset = 0
+    if response.status_code == 206:
+        offset = int(response.headers['Content-Range'].split()[1].split('-')[0])
+        assert offset == os.path.getsize(part_path), f'unexpected range {response.headers["Content-Range"]}'
+    else:
+        write_json(f'{part_path}.json', {'url': source.url, **validators})
+    with manifest.lock:
+        report.resumed_bytes += offset
+
+    h = hashlib.sha256()
+    gunzip = _Gunzip() if source.extract else None
+    tmp_path = f'{source.path}.tmp'
+    with response, open(part_path, 'r+b' if offset else 'wb') as part, \
+            (open(tmp_path, 'wb') if gunzip else _NoFile()) as out:
+        # the decompression and the checksum start from the beginning of the part file
+        while part.tell() < offset:
+            block = part.read(min(chunk_size, offset - part.tell()))
+            _consume(block, h, gunzip, out)
+        part.truncate(offset)
+        for block in response.iter_content(chunk_size):
+            part.write(block)
+            _consume(block, h, gunzip, out)
+            progress.update(len(block))
+            with manifest.lock:
+                report.received_bytes += len(block)
+        assert gunzip is None or gunzip.finished, f'{source.url} is not a complete gzip file'
+
+    digest = h.hexdigest()
+    if source.sha256 is not None and digest != source.sha256:
+        # resuming the same bytes would not help, the next call downloads the file again
+        _remove_part(part_path)
+        if gunzip:
+            os.remove(tmp_path)
+        raise ChecksumError(f'the checksum of {source.url} is {digest}, expected {source.sha256}')
+    if gunzip:
+        os.replace(tmp_path, source.path)
+        os.remove(part_path)
+    else:
+        os.replace(part_path, source.path)
+    os.remove(f'{part_path}.json')
+    return digest, validators
+
+
+def _consume(block: bytes, h, gunzip: Optional['_Gunzip'], out):
+    'hashes the (decompressed) `block` and writes it to `out` if the file is decompressed'
+    if gunzip:
+        block = gunzip.feed(block)
+        out.write(block)
+    h.update(block)
+
+
+def _remove_part(part_path: str):
+    for path in [part_path, f'{part_path}.json']:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class _Gunzip:
+    'decompresses a gzip stream in chunks, including files of several gzip members'
+
+    def __init__(self):
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def feed(self, data: bytes) -> bytes:
+        out = [self._decompressor.decompress(data)]
+        while self._decompressor.eof and self._decompressor.unused_data:
+            data = self._decompressor.unused_data
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            out.append(self._decompressor.decompress(data))
+        return b''.join(out)
+
+    @property
+    def finished(self) -> bool:
+        return self._decompressor.eof
+
+
+class _NoFile:
+    'used instead of the decompressed file if the file is not compressed'
+
+    def __enter__(self) -> '_NoFile':
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
@@ -0,0 +1,318 @@
+import contextlib
+import json
+import os
+import threading
+import time
+from typing import Any, Iterator, Optional
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# Lightweight instrumentation of the stages of the pipeline.
+#
+# The modules of the pipeline wrap their stages in `stage(...)` and report the number of
+# processed rows, features or samples with `count(...)`. Nothing is recorded (and almost
+# nothing is done) unless a `Recorder` is enabled:
+#
+#     with utils.instrument.recording() as recorder:
+#         data = nn_data.LoadedData(...)
+#     recorder.print_summary()
+#     recorder.to_chrome_trace('trace.json')  # open in chrome://tracing or https://ui.perfetto.dev
+
+
+THROUGHPUT_COUNTS = ('rows', 'samples', 'batches')
+'the counts whose rates are reported, the other counts are sizes or seconds'
+
+
+class Stage:
+    'a stage of the pipeline, recorded by a `Recorder`'
+
+    def __init__(self, recorder: 'Recorder', name: str, args: dict[str, Any]):
+        self.recorder = recorder
+        self.name = name
+        self.args = args
+        'describes the stage, e.g. the path of the read file'
+        self.counts: dict[str, float] = {}
+        'the numbers of processed rows, features, samples, ... and seconds spent in `timed` parts'
+        self.parent: Optional[Stage] = None
+        self.start = 0.0
+        'the start in seconds since the recorder was enabled'
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        'the CPU time of the process, including all its threads'
+        self.start_rss_mb: Optional[float] = None
+        'the resident memory of the process at the start of the stage'
+        self.peak_rss_mb: Optional[float] = None
+        '''the highest resident memory of the process during the stage, `None` where it is unknown
+        (without `/proc/self/clear_refs` only a stage that raises the peak of the process knows it)'''
+        self.thread = threading.get_ident()
+        self._cpu_start = 0.0
+        self._start_peak: Optional[float] = None
+
+    @property
+    def peak_rss_growth_mb(self) -> Optional[float]:
+        'how far the resident memory rose above its value at the start of the stage'
+        if self.peak_rss_mb is None or self.start_rss_mb is None:
+            return None
+        return max(0.0, self.peak_rss_mb - self.start_rss_mb)
+
+    def __enter__(self) -> 'Stage':
+        self.parent = self.recorder._current()
+        self.recorder._stack().append(self)
+        self.recorder._start_memory(self)
+        self._cpu_start = time.process_time()
+        self.start = time.perf_counter() - self.recorder.origin
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wall_seconds = time.perf_counter() - self.recorder.origin - self.start
+        self.cpu_seconds = time.process_time() - self._cpu_start
+        self.recorder._stack().pop()
+        with self.recorder._lock:
+            self.recorder._end_memory(self)
+            self.recorder.stages.append(self)
+
+    def count(self, name: str, value: float = 1):
+        'adds `value` to the count `name`'
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    @property
+    def depth(self) -> int:
+        return 0 if self.parent is None else self.parent.depth + 1
+
+    def rates(self) -> dict[str, float]:
+        'the `THROUGHPUT_COUNTS` per second of wall time, e.g. `samples_per_second`'
+        return {f'{name}_per_second': self.counts[name] / self.wall_seconds for name in THROUGHPUT_COUNTS
+                if name in self.counts and self.wall_seconds > 0}
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            'name': self.name,
+            'parent': None if self.parent is None else self.parent.name,
+            'depth': self.depth,
+            'args': self.args,
+            'start': self.start,
+            'wall_seconds': self.wall_seconds,
+            'cpu_seconds': self.cpu_seconds,
+            'start_rss_mb': self.start_rss_mb,
+            'peak_rss_mb': self.peak_rss_mb,
+            'peak_rss_growth_mb': self.peak_rss_growth_mb,
+            'counts': self.counts,
+            'rates': self.rates(),
+        }
+
+
+class Recorder:
+    'records the stages of the pipeline while it is enabled, see `enable` and `recording`'
+
+    def __init__(self):
+        self.stages: list[Stage] = []
+        'the finished stages, in the order they finished'
+        self.origin = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._open: list[Stage] = []
+        'the open stages of all threads, they share the peak memory of the process'
+
+    def _stack(self) -> list[Stage]:
+        'the open stages of the current thread'
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _current(self) -> Optional[Stage]:
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    def _start_memory(self, stage: Stage):
+        '''records the memory at the start of `stage`. The peak of the process is reset where possible,
+        so the open stages first take the peak so far'''
+        with self._lock:
+            peak = _peak_rss_mb()
+            for other in self._open:
+                if other.peak_rss_mb is not None and peak is not None:
+                    other.peak_rss_mb = max(other.peak_rss_mb, peak)
+            stage.start_rss_mb = _rss_mb()
+            if _reset_peak_rss():
+                stage.peak_rss_mb = stage.start_rss_mb
+            else:
+                stage._start_peak = peak
+            self._open.append(stage)
+
+    def _end_memory(self, stage: Stage):
+        'records the peak memory during `stage`, called with `_lock` held'
+        self._open.remove(stage)
+        peak = _peak_rss_mb()
+        if peak is None:
+            stage.peak_rss_mb = None
+        elif stage._start_peak is None:
+            stage.peak_rss_mb = peak if stage.peak_rss_mb is None else max(stage.peak_rss_mb, peak)
+        else:
+            # the peak could not be reset: it belongs to the stage only if the stage raised it
+            stage.peak_rss_mb = peak if peak > stage._start_peak else None
+        if stage.start_rss_mb is None and stage._start_peak is not None:
+            # no current memory without /proc, the growth of the peak is the best estimate
+            stage.start_rss_mb = stage._start_peak
+
+    def to_json(self, path: Optional[str] = None) -> list[dict[str, Any]]:
+        'returns the stages in the order they started, and writes them to `path` as json'
+        result = [stage.to_dict() for stage in sorted(self.stages, key=lambda stage: stage.start)]
+        if path is not None:
+            with open(path, 'w') as f:
+                json.dump(result, f, indent=1)
+        return result
+
+    def to_chrome_trace(self, path: Optional[str] = None) -> dict[str, Any]:
+        '''returns the stages in the Chrome trace event format, and writes them to `path`.
+        The file can be opened in `chrome://tracing` or https://ui.perfetto.dev'''
+        pid = os.getpid()
+        trace = {'displayTimeUnit': 'ms', 'traceEvents': [{
+            'name': stage.name, 'ph': 'X', 'pid': pid, 'tid': stage.thread,
+            'ts': stage.start * 1e6, 'dur': stage.wall_seconds * 1e6,
+            'args': {**stage.args, **stage.counts, **stage.rates(),
+                     'cpu_seconds': stage.cpu_seconds, 'start_rss_mb': stage.start_rss_mb,
+                     'peak_rss_mb': stage.peak_rss_mb, 'peak_rss_growth_mb': stage.peak_rss_growth_mb},
+        } for stage in self.stages]}
+        if path is not None:
+            with open(path, 'w') as f:
+                json.dump(trace, f)
+        return trace
+
+    def print_summary(self):
+        '''prints the time, memory and counts of each stage, nested stages are indented.
+        `peak +MB` is how far the resident memory rose above `start MB` during the stage'''
+        print(f'{"stage":<36}{"wall s":>10}{"cpu s":>10}{"start MB":>10}{"peak +MB":>10}  counts')
+        for stage in sorted(self.stages, key=lambda stage: stage.start):
+            counts = ', '.join(f'{name}={value:.4g}' for name, value in {**stage.counts, **stage.rates()}.items())
+            start = '-' if stage.start_rss_mb is None else f'{stage.start_rss_mb:.1f}'
+            growth = '-' if stage.peak_rss_growth_mb is None else f'{stage.peak_rss_growth_mb:.1f}'
+            print(f'{"  " * stage.depth + stage.name:<36}{stage.wall_seconds:>10.3f}'
+                  f'{stage.cpu_seconds:>10.3f}{start:>10}{growth:>10}  {counts}')
+
+
+class _NoStage:
+    'used instead of a `Stage` while no recorder is enabled, it does nothing'
+
+    def __enter__(self) -> '_NoStage':
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def count(self, name: str, value: float = 1):
+        pass
+
+
+_NO_STAGE = _NoStage()
+
+_recorder: Optional[Recorder] = None
+'the enabled recorder'
+
+
+def enable() -> Recorder:
+    'starts recording the stages with a new `Recorder` and returns it'
+    global _recorder
+    _recorder = Recorder()
+    return _recorder
+
+
+def disable() -> Optional[Recorder]:
+    'stops recording and returns the recorder that was enabled'
+    global _recorder
+    recorder, _recorder = _recorder, None
+    return recorder
+
+
+def enabled() -> bool:
+    return _recorder is not None
+
+
+@contextlib.contextmanager
+def recording() -> Iterator[Recorder]:
+    'records the stages of the code in the `with` block, the previous recorder is restored afterwards'
+    global _recorder
+    previous = _recorder
+    recorder = enable()
+    try:
+        yield recorder
+    finally:
+        _recorder = previous
+
+
+def stage(name: str, **args: Any):
+    '''a context manager that records the code in the `with` block as stage `name`.
+    `args` describe the stage, e.g. the read file. Stages can be nested.'''
+    if _recorder is None:
+        return _NO_STAGE
+    return Stage(_recorder, name, args)
+
+
+def count(name: str, value: float = 1):
+    'adds `value` to the count `name` (e.g. `rows`) of the innermost stage'
+    if _recorder is None:
+        return
+    current = _recorder._current()
+    if current is not None:
+        current.count(name, value)
+
+
+@contextlib.contextmanager
+def _timed(name: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        count(name, time.perf_counter() - start)
+
+
+def timed(name: str):
+    '''a context manager that adds the seconds spent in the `with` block to the count `name`
+    (e.g. `one_hot_seconds`) of the innermost stage, for parts that run too often for a stage'''
+    if _recorder is None:
+        return _NO_STAGE
+    return _timed(name)
+
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+_can_reset_peak = True
+'whether `/proc/self/clear_refs` resets the peak memory, set to False after the first failure'
+
+
+def _rss_mb() -> Optional[float]:
+    'the resident memory of the process, `None` where `/proc` is not available'
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE / 2**20
+    except OSError:
+        return None
+
+
+def _reset_peak_rss() -> bool:
+    'resets the peak resident memory of the process to the current one (Linux only), returns whether it did'
+    global _can_reset_peak
+    if _can_reset_peak:
+        try:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+        except OSError:
+            _can_reset_peak = False
+    return _can_reset_peak
+
+
+def _peak_rss_mb() -> Optional[float]:
+    'the highest resident memory of the process since the last `_reset_peak_rss`, or since it started'
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2**20 if os.uname().sysname == 'Darwin' else peak / 2**10
@@ -1,31 +1,62 @@
 
+import re
+import warnings
 from io import TextIOWrapper
-from typing import Optional
+from typing import Collection, Iterable, Iterator, Optional, TextIO, Union
 from .hpo import HPO, HPOEntry, augmented_entry
+from .compact_hpo import CompactHPO
+from .compiled_hpo import compile_hpo, compiled_path, hpo_from_compiled, load_compiled, paused_gc, save_compiled
+from .files import file_digest
+from . import instrument
 
 # file format spec: http://owlcollab.github.io/oboformat/doc/GO.format.obo-1_2.html#S.1.5
 
-# this function is not yet called. it would be used for definition or comment tags
+ENTRY_TAGS = ('id', 'name', 'is_a', 'alt_id', 'is_obsolete')
+'the tags needed to build the HPO graph'
 
+CHUNK_SIZE = 1 << 20
+'the number of characters read from an .obo file at once'
 
-def unescape_text(text: str):
+_QUOTED_TAGS = ('def', 'synonym')
+'the tags whose values are quoted strings, they can contain ` !` and ` {`'
+
+_ESCAPES = {'n': '\n', 't': '\t', 'W': ' '}
+_ESCAPE = re.compile(r'\\(.)', re.S)
+# the value ends at an unescaped ` {` (trailing modifiers) or ` !` (comment) outside of quotes
+_VALUE = re.compile(r'(?:[^\\"{!]+|\\.|"(?:[^"\\]+|\\.)*"?|(?<!\s)[{!])*', re.S)
+_TRAILER = re.compile(r'\s*(?:\{(?:\\.|"(?:\\.|[^"\\])*"|[^\\"}])*\}?)?\s*(?:!\s?(.*))?', re.S)
+
+
+def unescape_text(text: str) -> str:
     'transforms escaped characters back to their proper form.'
-    res = ''
-    escape = False
-    for ch in text:
-        if escape:
-            if ch == 'n':
-                res += '\n'
-            elif ch == '"':
-                res += '"'
-            else:
-                print(f'escape character {ch} not known')
-            escape = False
-        elif ch == '\\':
-            escape = True
-        else:
-            res += ch
-    return res
+    if '\\' not in text:
+        return text
+    if '\\\\' not in text:
+        # each backslash starts an escape, the most common one is replaced without the regex
+        text = text.replace('\\"', '"')
+        if '\\' not in text:
+            return text
+    return _ESCAPE.sub(lambda m: _ESCAPES.get(m.group(1), m.group(1)), text)
+
+
+def parse_tag_value(tag: str, rest: str) -> tuple[str, str, str]:
+    '''splits the part `<value> {<trailing modifiers>} ! <comment>` of a tag-value line
+    into a tuple of `(<tag>, <value>, <comment>)`. The value stays escaped.
+    '''
+    if ' !' not in rest and ' {' not in rest:
+        return tag, rest, ''
+    if '\\' not in rest and '"' not in rest:
+        # no escapes or quotes that could hide the separators
+        comment = ''
+        if ' !' in rest:
+            rest, comment = rest.split(' !', 1)
+            comment = comment[1:] if comment.startswith(' ') else comment
+        if ' {' in rest:
+            rest, _ = rest.split(' {', 1)
+        return tag, rest.rstrip(), comment
+    end = _VALUE.match(rest).end()
+    comment = _TRAILER.match(rest, end).group(1) or ''
+    return tag, rest[:end].rstrip(), comment
 
 
 def parse_tag_value_line(line: str) -> tuple[str, str, str]:
@@ -39,27 +70,7 @@ def parse_tag_value_line(line: str) -> tuple[str, str, str]:
 
     tag, rest = line.split(': ', 1)
     assert '\\' not in tag, f'tag connot contain escape characters'
-
-    comment = ''
-    if ' ! ' in line:
-        rest, comment = rest.split(' ! ', 1)
-
-    # filter out trailing modifiers, as we don't care about them
-    if ' {' in line:
-        rest, _ = rest.split(' {', 1)
-    return tag, rest, comment
-
-
-def get_next_line_from_file(f: TextIOWrapper) -> Optional[str]:
-    'reads a line from `f`. Skips empty lines and comments. Returns `None` on EOF'
-    while True:
-        line = f.readline()
-        if line == '':
-            return None
-        line = line[:-1]
-        if line == '' or line.startswith('!'):
-            continue
-        return line
+    return parse_tag_value(tag, rest)
 
 
 def build_entry_from_tags(tags: dict[str, list[str]]) -> Optional[augmented_entry]:
@@ -69,7 +80,7 @@ def build_entry_from_tags(tags: dict[str, list[str]]) -> Optional[augmented_entr
     assert len(tags.get('id', [])) == 1 and len(tags.get('name', [])
                                                 ) == 1, 'each entry must contain `id` and `name`'
     id = tags.pop('id', [])[0]
-    name = tags.pop('name', [])[0]
+    name = unescape_text(tags.pop('name', [])[0])
     # todo: maybe 'alt_id' and 'replaced_by' are interessting
     parent_ids = tags.pop('is_a', [])
     if 'is_obsolete' in tags:
@@ -80,39 +91,116 @@ def build_entry_from_tags(tags: dict[str, list[str]]) -> Optional[augmented_entr
     return entry, parent_ids, alt_ids
 
 
-def get_entries_from_file(f: TextIOWrapper) -> list[augmented_entry]:
-    # parse header
+def _stanza_chunks(f: TextIO) -> Iterator[str]:
+    '''reads the opened .obo file `f` in chunks of about `CHUNK_SIZE` characters.
+    Each chunk ends at the end of a stanza, all but the first start with its `[` header line.
+    '''
+    pending = ''
     while True:
-        line = get_next_line_from_file(f)
-        if line is None:  # EOF found
-            return []
-        if line.startswith('['):  # reached first entry
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
             break
+        text = pending + chunk
+        end = text.rfind('\n[')
+        if end < 0:
+            pending = text
+            continue
+        yield text[:end]
+        pending = text[end + 1:]
+    if pending:
+        yield pending
 
-    # list of entries to be connected later
-    entries: list[augmented_entry] = []
-    while True:
-        assert line == '[Term]', "hp.obo contains only [Term] stanzas"
-
-        # store all the tags for this entry.
-        # each tag can appear multiple times, so we need a list for each entry.
-        tags = {}
-        while True:
-            line = get_next_line_from_file(f)
-            if line is None:
-                return entries
-            if line.startswith('['):
-                e = build_entry_from_tags(tags)
-                if e:
-                    entries.append(e)
-                break  # next term found
-
-            tag, value, _ = parse_tag_value_line(line)
-            tags.setdefault(tag, []).append(value)
-
-
-def read_hpo_from_obo(path: str) -> HPO:
-    'reads the file at `path` and build the HPO graph from it'
-    with open(path) as f:
-        entries = get_entries_from_file(f)
-    return HPO(entries)
+
+def iter_stanzas(f: TextIO, tags: Optional[Collection[str]] = None) -> Iterator[tuple[str, dict[str, list[str]]]]:
+    '''yields `(<stanza type>, <tags>)` for each stanza (`[Term]`, `[Typedef]`, ...) of the opened
+    .obo file `f`, while reading it.
+    Each tag can appear multiple times, so `<tags>` contains a list of values for each tag.
+
+    if `tags` is given, only these tags are parsed, all other lines are skipped.
+    '''
+    prefixes = tuple(f'{tag}: ' for tag in tags) if tags is not None else None
+    for chunk in _stanza_chunks(f):
+        stanzas = chunk.split('\n[')
+        if stanzas[0].startswith('['):
+            stanzas[0] = stanzas[0][1:]
+        else:
+            del stanzas[0]  # the header of the file
+        for stanza in stanzas:
+            lines = stanza.split('\n')
+            stanza_tags: dict[str, list[str]] = {}
+            for line in lines[1:]:
+                if prefixes is not None and not line.startswith(prefixes):
+                    continue
+                tag, separator, value = line.partition(': ')
+                if not separator or tag.startswith('!'):
+                    continue
+                if ' !' in value or ' {' in value:
+                    if tag in _QUOTED_TAGS or '\\' in value or '"' in value:
+                        value = parse_tag_value(tag, value)[1]
+                    else:
+                        value = value.split(' !', 1)[0].split(' {', 1)[0].rstrip()
+                if tag in stanza_tags:
+                    stanza_tags[tag].append(value)
+                else:
+                    stanza_tags[tag] = [value]
+            yield lines[0].split(']', 1)[0], stanza_tags
+
+
+def _entries(stanzas: Iterable[tuple[str, dict[str, list[str]]]]) -> Iterator[augmented_entry]:
+    for stanza, tags in stanzas:
+        if stanza == 'Term':
+            entry = build_entry_from_tags(tags)
+            if entry:
+                yield entry
+
+
+def iter_entries(path: str, tags: Optional[Collection[str]] = None) -> Iterator[augmented_entry]:
+    '''yields the entries of all `[Term]` stanzas of the .obo file at `path` that are not obsolete,
+    while reading the file.
+
+    if `tags` is given, only these tags are parsed (see `ENTRY_TAGS` for the tags needed to build the graph).
+    '''
+    with open(path, encoding='utf-8') as f:
+        yield from _entries(iter_stanzas(f, tags))
+
+
+def get_entries_from_file(f: TextIOWrapper) -> list[augmented_entry]:
+    'returns the entries of all `[Term]` stanzas of the opened .obo file `f` that are not obsolete'
+    with paused_gc():
+        return list(_entries(iter_stanzas(f)))
+
+
+def read_hpo_from_obo(path: str, use_compiled: bool = True, cache_dir: Optional[str] = None,
+                      compact: bool = False) -> Union[HPO, CompactHPO]:
+    '''reads the file at `path` and build the HPO graph from it.
+
+    if `use_compiled` is `True`, the parsed HPO is stored in a compiled file next to `path`
+    (or in `cache_dir`), keyed by the digest of the content of `path`.
+    As long as `path` does not change, the compiled file is loaded instead of parsing `path` again.
+
+    if `compact` is `True`, returns a `CompactHPO` instead of an `HPO`. It is loaded from the compiled
+    file fastest, its entries are views of arrays that are only created when they are accessed.
+    '''
+    if not use_compiled:
+        with instrument.stage('parse obo', path=path):
+            # the garbage collector would walk all entries created so far again and again
+            with paused_gc():
+                hpo = HPO(list(iter_entries(path)))
+            instrument.count('entries', len(hpo.entries_by_id))
+            return CompactHPO(compile_hpo(hpo, '')) if compact else hpo
+
+    digest = file_digest(path)
+    compiled = compiled_path(path, digest, cache_dir)
+    with instrument.stage('load compiled hpo', path=compiled):
+        arrays = load_compiled(compiled, digest)
+    if arrays is None:
+        hpo = read_hpo_from_obo(path, use_compiled=False)
+        arrays = compile_hpo(hpo, digest)
+        try:
+            save_compiled(compiled, arrays)
+        except OSError as e:
+            warnings.warn(f'could not store compiled HPO: {e}', stacklevel=2)
+        if not compact:
+            return hpo
+    with instrument.stage('build hpo', compact=compact):
+        return CompactHPO(arrays) if compact else hpo_from_compiled(arrays)
@@ -1,5 +1,13 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import Literal, Optional, Union
+import io
+import os
+import shutil
 import pandas as pd  # used for reading, modifying and writing csv files
 import tqdm  # used for making a progess bar
+from .columnar import ColumnarTable, ColumnarWriter, is_columnar
+from .files import file_digest, range_digest, read_json, write_json
+from . import instrument
 
 # Adapted from:
 # to_hpo.py (Made by Alexander Weiss alexander.weiss@mail.de)
@@ -11,6 +19,21 @@ import tqdm  # used for making a progess bar
 NEG = ['neg', '0-']
 POS = ['pos', '1+', '2+', '3+']
 
+# kinds of values found in the `value` column of the labevents
+QUANTITATIVE = 'quantitative'
+ORDINAL = 'ordinal'
+UNKNOWN = 'unknown'
+
+HPO_COLUMNS = ['selected_hpo_features',
+               'not_selected_hpo_features', 'unknown_hpo_features']
+'columns added to the labevents by `add_hpo_information`'
+
+INTEGER_COLUMNS = ['row_id', 'subject_id', 'hadm_id', 'itemid']
+'columns of the labevents stored as integers in the columnar output format'
+
+output = Union[io.TextIOBase, ColumnarWriter]
+'type alias: the annotated labevents are written to a csv file or a columnar table'
+
 
 def is_number(text: str) -> bool:
     try:
@@ -20,12 +43,420 @@ def is_number(text: str) -> bool:
         return False
 
 
+def value_kind(value: str) -> str:
+    'classifies a lowercase labevent value as `QUANTITATIVE`, `ORDINAL` or `UNKNOWN`'
+    if value == '' or is_number(value):
+        return QUANTITATIVE
+    if value in NEG or value in POS:
+        return ORDINAL
+    return UNKNOWN
+
+
+class AnnotationReport:
+    'keeps track of the problems found while annotating the labevents'
+
+    def __init__(self):
+        self.lines = 0
+        'number of labevents processed'
+        self.missing_loinc: set[int] = set()
+        'itemids without a loinc code'
+        self.missing_annotation: set[str] = set()
+        'loinc codes without an annotation'
+        self.unknown_flags: set[str] = set()
+        self.unknown_values: set[str] = set()
+        self.rebuilt = False
+        'whether an incremental call annotated all labevents instead of only the appended ones'
+
+    def update(self, other: 'AnnotationReport'):
+        'merges the problems found in `other` into this report'
+        self.lines += other.lines
+        self.missing_loinc.update(other.missing_loinc)
+        self.missing_annotation.update(other.missing_annotation)
+        self.unknown_flags.update(other.unknown_flags)
+        self.unknown_values.update(other.unknown_values)
+
+    def __repr__(self) -> str:
+        return (f'<AnnotationReport lines={self.lines} '
+                f'missing_loinc={len(self.missing_loinc)} '
+                f'missing_annotation={len(self.missing_annotation)}>')
+
+    def __str__(self) -> str:
+        return '\n'.join([
+            f'missing loinc id for {len(self.missing_loinc)} items',
+            f'missing annoation for {len(self.missing_annotation)} loinc ids',
+            f'unknown_flags={self.unknown_flags}',
+            f'unknown_values={self.unknown_values}',
+            *(['annotated all labevents'] if self.rebuilt else []),
+        ])
+
+
+def _annotate(annotation: dict[str, str], kind: str, flag: str, positive: bool) -> tuple[str, str, str, bool]:
+    '''applies the annotation of a loinc code to a labevent.
+    `positive` tells whether an `ORDINAL` value is one of `POS`.
+
+    returns the `;`-joined selected, not selected and unknown features,
+    as well as whether `flag` is unknown.
+    '''
+    selected: list[str] = []
+    not_selected: list[str] = []
+    unassigned = annotation.copy()
+    unknown_flag = False
+    if kind == QUANTITATIVE:
+        if flag == '':
+            # normal
+            if 'L' in unassigned:
+                not_selected.append(unassigned.pop('L'))
+            if 'N' in unassigned:
+                not_selected.append(unassigned.pop('N'))
+            if 'H' in unassigned:
+                not_selected.append(unassigned.pop('H'))
+        elif flag == 'abnormal':
+            # abnormal does not say anything about high or low
+            if 'N' in unassigned:
+                selected.append(unassigned.pop('N'))
+        else:
+            unknown_flag = True
+    elif kind == ORDINAL:
+        if 'NEG' in unassigned and 'POS' in unassigned:
+            if positive:
+                selected.append(unassigned.pop('POS'))
+            else:  # value in NEG
+                not_selected.append(unassigned.pop('NEG'))
+    unknown = [e for e in unassigned.values() if (
+        e not in selected) and (e not in not_selected)]
+    return ";".join(selected), ";".join(not_selected), ";".join(unknown), unknown_flag
+
+
+def read_itemid_to_loinc(labitems_path: str) -> dict[int, str]:
+    'reads the loinc code for each item from `D_LABITEMS.csv`'
+    labitems_df = pd.read_csv(labitems_path,
+                              usecols=['itemid', 'loinc_code'],
+                              dtype={'loinc_code': str}).fillna('')
+    labitems_df = labitems_df[labitems_df.loinc_code != '']
+    return dict(zip(labitems_df.itemid, labitems_df.loinc_code))
+
+
+def read_loinc_to_hpo(anno_path: str) -> dict[str, dict[str, str]]:
+    '''for each loinc code reads the outcome to HPO mapping.
+
+    Example: `loinc_to_hpo['2345-7'] = {'L': 'HP:0001943', 'N': 'HP:0011015', 'H': 'HP:0003074'}`
+    '''
+    anno_df = pd.read_csv(anno_path, sep='\t',
+                          usecols=['loincId', 'outcome', 'hpoTermId'],
+                          dtype=str).fillna('')
+    loinc_to_hpo: dict[str, dict[str, str]] = {}
+    for loinc_id, outcome, hpo_term_id in zip(anno_df.loincId, anno_df.outcome, anno_df.hpoTermId):
+        loinc_to_hpo.setdefault(loinc_id, {})[outcome] = hpo_term_id
+    return loinc_to_hpo
+
+
+class Annotator:
+    '''Annotates chunks of labevents with HPO features.
+
+    The outcome only depends on the itemid, the kind of the value, the flag and
+    (for ordinal values) the sign. It is computed once for every distinct combination
+    and joined onto the rows of a chunk.
+    '''
+
+    def __init__(self, itemid_to_loinc: dict[int, str], loinc_to_hpo: dict[str, dict[str, str]]):
+        self.itemid_to_loinc = itemid_to_loinc
+        self.loinc_to_hpo = loinc_to_hpo
+        self._outcomes: dict[tuple[int, str, str, bool], tuple[str, str, str, bool]] = {}
+        'cache: (itemid, kind, flag, positive) -> (selected, not_selected, unknown, unknown_flag)'
+
+    def _outcome(self, itemid: int, kind: str, flag: str, positive: bool) -> tuple[str, str, str, bool]:
+        key = (itemid, kind, flag, positive)
+        outcome = self._outcomes.get(key)
+        if outcome is None:
+            annotation = self.loinc_to_hpo.get(
+                self.itemid_to_loinc.get(itemid, ''))
+            if annotation is None:
+                outcome = ('', '', '', False)
+            else:
+                outcome = _annotate(annotation, kind, flag, positive)
+            self._outcomes[key] = outcome
+        return outcome
+
+    def annotate(self, chunk: pd.DataFrame, report: AnnotationReport) -> pd.DataFrame:
+        '''adds the `HPO_COLUMNS` to `chunk` (labevents read with `dtype=str`)
+        and records the problems in `report`.
+        '''
+        chunk = chunk.fillna('')
+        report.lines += len(chunk.index)
+
+        itemids = chunk.itemid.astype(int).to_numpy()
+        values = chunk.value.str.lower()
+        distinct_values = values.unique()
+        kinds = dict(zip(distinct_values, map(value_kind, distinct_values)))
+        keys = pd.DataFrame({
+            'itemid': itemids,
+            'kind': values.map(kinds).to_numpy(),
+            'flag': chunk.flag.to_numpy(),
+            'positive': values.isin(POS).to_numpy(),
+        })
+
+        loinc = pd.Series(itemids).map(self.itemid_to_loinc)
+        has_loinc = loinc.notna().to_numpy()
+        has_annotation = loinc.isin(list(self.loinc_to_hpo)).to_numpy()
+        report.missing_loinc.update(pd.unique(itemids[~has_loinc]).tolist())
+        report.missing_annotation.update(
+            loinc[has_loinc & ~has_annotation].unique().tolist())
+        unknown_value = has_annotation & (keys.kind == UNKNOWN).to_numpy()
+        report.unknown_values.update(
+            chunk.value[unknown_value].unique().tolist())
+
+        # join the outcome of each distinct combination onto the rows
+        combinations = keys.drop_duplicates()
+        outcomes = pd.DataFrame(
+            [self._outcome(*key)
+             for key in combinations.itertuples(index=False)],
+            columns=HPO_COLUMNS + ['unknown_flag'], index=combinations.index,
+        )
+        report.unknown_flags.update(
+            combinations.flag[outcomes.unknown_flag].tolist())
+        columns = keys.merge(pd.concat([combinations, outcomes], axis=1),
+                             how='left', on=list(keys.columns))
+
+        for column in HPO_COLUMNS:
+            chunk[column] = columns[column].to_numpy()
+        return chunk
+
+
+class ByteRange(io.RawIOBase):
+    '''reads `header` followed by the bytes `[start, end)` of the file at `path`.
+    Used to let pandas parse a part of a csv file.
+    '''
+
+    def __init__(self, path: str, header: bytes, start: int, end: int):
+        self._file = open(path, 'rb')
+        self._file.seek(start)
+        self._header = header
+        self._remaining = end - start
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        if self._header:
+            n = min(len(b), len(self._header))
+            b[:n] = self._header[:n]
+            self._header = self._header[n:]
+            return n
+        n = self._file.readinto(memoryview(b)[:min(len(b), self._remaining)])
+        self._remaining -= n
+        return n
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+def read_header(path: str) -> tuple[bytes, int]:
+    'returns the first line of the csv file at `path` and the offset of the second line'
+    with open(path, 'rb') as f:
+        header = f.readline()
+        return header, f.tell()
+
+
+def last_line_end(path: str, start: int, end: int) -> int:
+    'returns the offset after the last line break in the bytes `[start, end)` of the file at `path`'
+    with open(path, 'rb') as f:
+        while end > start:
+            block_start = max(start, end - 2**16)
+            f.seek(block_start)
+            block = f.read(end - block_start)
+            i = block.rfind(b'\n')
+            if i >= 0:
+                return block_start + i + 1
+            end = block_start
+    return start
+
+
+def line_aligned_shards(path: str, start: int, size: int, shard_bytes: int) -> list[tuple[int, int]]:
+    '''splits the bytes `[start, size)` of the file at `path` into ranges of about `shard_bytes`.
+    Each range ends after a line break, so every row has to be written on a single line.
+    '''
+    shards: list[tuple[int, int]] = []
+    with open(path, 'rb') as f:
+        while start < size:
+            end = start + shard_bytes
+            if end < size:
+                f.seek(end)
+                f.readline()
+                end = f.tell()
+            end = min(end, size)
+            shards.append((start, end))
+            start = end
+    return shards
+
+
+def _count_rows(path: str, start: int, end: int) -> int:
+    'counts the lines in the byte range `[start, end)` of the file at `path`'
+    rows = 0
+    last = b'\n'
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            block = f.read(min(remaining, 1 << 24))
+            rows += block.count(b'\n')
+            remaining -= len(block)
+            last = block[-1:]
+    if last != b'\n':
+        rows += 1  # last line without line break
+    return rows
+
+
+def _write(chunk: pd.DataFrame, out: output, header: bool = False):
+    if isinstance(out, ColumnarWriter):
+        out.write(chunk)
+    else:
+        chunk.to_csv(out, header=header)
+
+
+def _annotate_csv(annotator: Annotator, source, out: output, first_row: int, chunksize: int,
+                  report: AnnotationReport, progress: bool = False):
+    '''annotates the labevents csv `source` chunk by chunk and writes them to `out` without header.
+    The rows are numbered from `first_row` on.
+    '''
+    reader = pd.read_csv(source, dtype=str, chunksize=chunksize)
+    with reader:
+        chunks = iter(tqdm.tqdm(reader, unit='chunk') if progress else reader)
+        while True:
+            with instrument.timed('read_seconds'):
+                chunk = next(chunks, None)
+            if chunk is None:
+                break
+            instrument.count('rows', len(chunk.index))
+            with instrument.timed('annotate_seconds'):
+                chunk = annotator.annotate(chunk, report)
+            chunk.index += first_row  # the index of the reader continues across chunks
+            with instrument.timed('write_seconds'):
+                _write(chunk, out)
+
+
+def _write_header(annotator: Annotator, header: bytes, out: output):
+    '''writes the header of the annotated labevents (or the columns of the columnar table),
+    given the `header` line of the labevents
+    '''
+    columns = pd.read_csv(io.BytesIO(header), dtype=str)
+    _write(annotator.annotate(columns, AnnotationReport()), out, header=True)
+
+
+_shard_annotator: Optional[Annotator] = None
+'the annotator of a worker process, see `_init_shard_worker`'
+
+
+def _init_shard_worker(itemid_to_loinc: dict[int, str], loinc_to_hpo: dict[str, dict[str, str]]):
+    global _shard_annotator
+    _shard_annotator = Annotator(itemid_to_loinc, loinc_to_hpo)
+
+
+def _annotate_shard(labevents_path: str, header: bytes, start: int, end: int,
+                    first_row: int, rows: int, out_path: str, chunksize: int,
+                    columnar: bool) -> AnnotationReport:
+    '''annotates the byte range `[start, end)` of the labevents in a worker process
+    and writes the annotated rows (without header) to `out_path`.
+    '''
+    assert _shard_annotator is not None
+    report = AnnotationReport()
+    out = ColumnarWriter(out_path, INTEGER_COLUMNS) if columnar else \
+        open(out_path, 'w', newline='')
+    with io.BufferedReader(ByteRange(labevents_path, header, start, end)) as source, out:
+        _annotate_csv(_shard_annotator, source, out,
+                      first_row, chunksize, report)
+    assert report.lines == rows, \
+        f'expected {rows} rows in bytes {start}-{end}, found {report.lines}. Rows must not span multiple lines'
+    return report
+
+
+def _annotate_parallel(annotator: Annotator, labevents_path: str, header: bytes,
+                       start: int, end: int, first_row: int, out: output, out_path: str,
+                       chunksize: int, workers: int, shard_bytes: int) -> AnnotationReport:
+    '''splits the byte range `[start, end)` of the labevents in line aligned shards
+    and annotates them in `workers` processes.
+    The annotated shards are appended to `out` in their original order.
+    '''
+    shards = line_aligned_shards(labevents_path, start, end, shard_bytes)
+    shard_paths = [f'{out_path}.{i}.part' for i in range(len(shards))]
+    columnar = isinstance(out, ColumnarWriter)
+    report = AnnotationReport()
+
+    with ProcessPoolExecutor(workers, initializer=_init_shard_worker,
+                             initargs=(annotator.itemid_to_loinc, annotator.loinc_to_hpo)) as executor:
+        rows = list(executor.map(_count_rows, [labevents_path] * len(shards),
+                                 *zip(*shards)))
+        first_rows = [first_row + sum(rows[:i]) for i in range(len(shards))]
+        reports = executor.map(
+            _annotate_shard,
+            [labevents_path] * len(shards), [header] * len(shards),
+            *zip(*shards), first_rows, rows, shard_paths, [chunksize] * len(shards),
+            [columnar] * len(shards),
+        )
+        for shard_path, shard_report in tqdm.tqdm(zip(shard_paths, reports), total=len(shards), unit='shard'):
+            report.update(shard_report)
+            if isinstance(out, ColumnarWriter):
+                out.extend(ColumnarTable(shard_path))
+                shutil.rmtree(shard_path)
+            else:
+                with open(shard_path) as shard:
+                    shutil.copyfileobj(shard, out)
+                os.remove(shard_path)
+    return report
+
+
+WATERMARK_BYTES = 2**16
+'number of bytes before the end of the annotated part of the labevents hashed to detect changes'
+
+
+def _incremental_state(labitems_path: str, anno_path: str, labevents_path: str,
+                       header: bytes, start: int, end: int, rows: int, out_size: int) -> dict:
+    '''describes which part of the labevents is annotated in the output.
+    The last bytes before `end` act as a watermark to detect changes of the annotated part.
+    '''
+    watermark_start = max(start, end - WATERMARK_BYTES)
+    return {
+        'labitems': file_digest(labitems_path),
+        'annotations': file_digest(anno_path),
+        'header': header.decode(),
+        'end': end,
+        'watermark': range_digest(labevents_path, watermark_start, end),
+        'rows': rows,
+        'output_size': out_size,
+    }
+
+
+def _output_size(labevents_hpo_path: str, columnar: bool) -> int:
+    'the size of the output: bytes of a csv file, rows of a columnar table'
+    return len(ColumnarTable(labevents_hpo_path)) if columnar else os.path.getsize(labevents_hpo_path)
+
+
+def _can_append(state: Optional[dict], labitems_path: str, anno_path: str, labevents_path: str,
+                labevents_hpo_path: str, header: bytes, start: int, end: int, columnar: bool) -> bool:
+    '''checks whether the output described by `state` is still valid,
+    so new labevents can be appended to it
+    '''
+    exists = is_columnar(labevents_hpo_path) if columnar else os.path.isfile(labevents_hpo_path)
+    if state is None or not exists:
+        return False
+    if state['end'] > end or _output_size(labevents_hpo_path, columnar) < state['output_size']:
+        return False
+    expected = _incremental_state(labitems_path, anno_path, labevents_path, header, start,
+                                  state['end'], state['rows'], state['output_size'])
+    return expected == state
+
+
 def add_hpo_information(
     labitems_path: str,
     labevents_path: str,
     anno_path: str,
     labevents_hpo_path: str,
-):
+    chunksize: int = 1_000_000,
+    workers: Optional[int] = 1,
+    shard_bytes: int = 64 * 2**20,
+    incremental: bool = False,
+    output_format: Literal['csv', 'columnar'] = 'csv',
+) -> AnnotationReport:
     '''
     Inserts the Human Phenotype Ontology features in the labevents from the MIMIC III dataset.
 
@@ -33,100 +464,77 @@ def add_hpo_information(
     - `labevents_path` is the path to the `LABEVENTS.csv` file from the MIMIC dataset
     - `anno_path` is the path to the `loinc2hpo-annotations.tsv` file
     - `labevents_hpo_path` is the path where the labevents with hpo_features will be saved
+    - `chunksize` is the number of labevents processed at once, it bounds the memory usage
+    - `workers` is the number of processes used, `None` uses all cores.
+    With more than one worker, the labevents are split into shards of about `shard_bytes` bytes.
+    This requires every row to be written on a single line, like in the MIMIC dataset.
+    The output does not depend on the number of workers.
+    - `incremental`: only annotates the labevents appended since the last call and appends them
+    to the output. The state is kept in `<labevents_hpo_path>.state.json`. If the labitems, the
+    annotations or the already annotated labevents changed, the output is rebuilt.
+    A row is only annotated once it is terminated by a line break. Changes of the already annotated
+    labevents are detected by the digest of their last `WATERMARK_BYTES` bytes only, earlier edits
+    are not noticed and require a call without `incremental`. `AnnotationReport.rebuilt` tells
+    whether the output was rebuilt.
+    - `output_format`: `'columnar'` writes a `utils.columnar` table (a directory) to `labevents_hpo_path`
+    instead of a csv file. The `INTEGER_COLUMNS` are stored as integers, all other columns (including
+    the `;`-separated HPO features) are dictionary encoded. `nn_data.LoadedData` reads both formats.
+
+    All columns of the labevents are copied as they are in `labevents_path`.
+    Returns an `AnnotationReport` with the problems found in the annotated labevents.
     '''
-    # variables to keep track of errors
-    missing_annotation: set[str] = set()
-    missing_loinc: set[str] = set()
-    unknown_flags: set[str] = set()
-    unknown_values: set[str] = set()
-
-    # parse labitems and annotations
-
-    itemid_to_loinc: dict[str, str] = {}  # former loinc_dict
-    # contains loinc-code for each item
-    labitems_df = pd.read_csv(labitems_path).fillna('')
-    for _, line in labitems_df.iterrows():
-        if line.loinc_code != '':
-            itemid_to_loinc[line.itemid] = line.loinc_code
-    del labitems_df
-
-    # for each loinc code contains outcome to HPO mapping.
-    loinc_to_hpo: dict[str, dict[str, str]] = {}
-    # Example: `loinc_to_hpo['2345-7'] = {'L': 'HP:0001943', 'N': 'HP:0011015', 'H': 'HP:0003074'}`
-    anno_df = pd.read_csv(anno_path, sep='\t').fillna('')
-    for _, line in anno_df.iterrows():
-        entry = loinc_to_hpo.setdefault(line.loincId, {})
-        entry[line.outcome] = line.hpoTermId
-    del anno_df
-
-    # go through each entry in labevents
-
-    labevents_df = pd.read_csv(labevents_path).fillna('')
-
-    selected_hpo_features: list[str] = []
-    not_selected_hpo_features: list[str] = []
-    unknown_hpo_features: list[str] = []
-    for _, line in tqdm.tqdm(labevents_df.iterrows(), total=len(labevents_df.index)):
-        # info["lines"] += 1
-        selected: list[str] = []
-        not_selected: list[str] = []
-        unassigned: dict[str, str] = {}
-
-        if line.itemid not in itemid_to_loinc:
-            missing_loinc.add(line.itemid)
+    with instrument.stage('read annotations', labitems_path=labitems_path, anno_path=anno_path):
+        annotator = Annotator(read_itemid_to_loinc(labitems_path),
+                              read_loinc_to_hpo(anno_path))
+        instrument.count('items', len(annotator.itemid_to_loinc))
+        instrument.count('loinc_codes', len(annotator.loinc_to_hpo))
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    columnar = output_format == 'columnar'
+    header, data_start = read_header(labevents_path)
+    end = os.path.getsize(labevents_path)
+    start, first_row, mode = data_start, 0, 'w'
+    rebuilt = False
+    state_path = f'{labevents_hpo_path}.state.json'
+    if incremental:
+        end = last_line_end(labevents_path, data_start, end)
+        state = read_json(state_path)
+        if _can_append(state, labitems_path, anno_path, labevents_path,
+                       labevents_hpo_path, header, data_start, end, columnar):
+            assert state is not None
+            start, first_row, mode = state['end'], state['rows'], 'r+'
         else:
-            loinc_code = itemid_to_loinc[line.itemid]
+            rebuilt = True
 
-            if loinc_code not in loinc_to_hpo:
-                missing_annotation.add(loinc_code)
-            else:
-                annotation = loinc_to_hpo[loinc_code]
-                unassigned = annotation.copy()
-                if not type(line.value) is str:
-                    print(line)
-                    return
-                value: str = line.value.lower()
-                if value == '' or is_number(value):
-                    # quantitative result
-                    if line.flag == '':
-                        # normal
-                        if 'L' in unassigned:
-                            not_selected.append(unassigned.pop('L'))
-                        if 'N' in unassigned:
-                            not_selected.append(unassigned.pop('N'))
-                        if 'H' in unassigned:
-                            not_selected.append(unassigned.pop('H'))
-                    elif line.flag == 'abnormal':
-                        # abnormal does not say anything about high or low
-                        if 'N' in unassigned:
-                            selected.append(unassigned.pop('N'))
-                    else:
-                        unknown_flags.add(line.flag)
-                elif value in NEG or value in POS:
-                    # ordinal result
-                    if 'NEG' in unassigned and 'POS' in unassigned:
-                        if value in POS:
-                            selected.append(unassigned.pop('POS'))
-                        else:  # value in NEG
-                            not_selected.append(unassigned.pop('NEG'))
-                else:
-                    unknown_values.add(line.value)
-
-        selected_hpo_features.append(";".join(selected))
-        not_selected_hpo_features.append(";".join(not_selected))
-        unknown = [e for e in unassigned.values() if (
-            e not in selected) and (e not in not_selected)]
-        unknown_hpo_features.append(";".join(unknown))
-
-    # put new columns into dataframe
-    labevents_df['selected_hpo_features'] = selected_hpo_features
-    labevents_df['not_selected_hpo_features'] = not_selected_hpo_features
-    labevents_df['unknown_hpo_features'] = unknown_hpo_features
-    # save dataframe
-    labevents_df.to_csv(labevents_hpo_path)
-
-    # print statistics
-    print(f'missing loinc id for {len(missing_loinc)} items')
-    print(f'missing annoation for {len(missing_annotation)} loinc ids')
-    print(f'{unknown_flags=}')
-    print(f'{unknown_values=}')
+    if columnar:
+        # appending drops the rows written by an interrupted call
+        out = ColumnarWriter(labevents_hpo_path, INTEGER_COLUMNS,
+                             rows=first_row if mode == 'r+' else None)
+    else:
+        out = open(labevents_hpo_path, mode, newline='')
+    with instrument.stage('annotate labevents', path=labevents_path, workers=workers), out:
+        if mode == 'w':
+            _write_header(annotator, header, out)
+        elif not columnar:
+            # drop rows appended by an interrupted call
+            out.truncate(state['output_size'])
+            out.seek(state['output_size'])
+
+        if workers > 1:
+            report = _annotate_parallel(annotator, labevents_path, header, start, end, first_row,
+                                        out, labevents_hpo_path, chunksize, workers, shard_bytes)
+            # the rows annotated by the workers are not counted in their processes
+            instrument.count('rows', report.lines)
+        else:
+            report = AnnotationReport()
+            with io.BufferedReader(ByteRange(labevents_path, header, start, end)) as source:
+                _annotate_csv(annotator, source, out, first_row,
+                              chunksize, report, progress=True)
+
+    report.rebuilt = rebuilt
+    if incremental:
+        write_json(state_path, _incremental_state(
+            labitems_path, anno_path, labevents_path, header, data_start, end,
+            first_row + report.lines, _output_size(labevents_hpo_path, columnar)))
+    return report
@@ -1,6 +1,15 @@
-from typing import Iterable, Optional
+import functools
+import html
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Optional, Union
+import graphviz
+import numpy as np
+import tqdm
 from graphviz import Digraph
+from . import csr
 from .hpo import HPOEntry, HPO
+from .compact_hpo import CompactHPO
 from .design import *
 
 
@@ -26,41 +35,182 @@ def safe_id(id: str):
     return id.replace(':', '_')
 
 
-def _add_node(g: Digraph, entry: HPOEntry, color: str = BASIC_GREY):
+def _add_node(g: Digraph, entry: HPOEntry, color: str = BASIC_GREY, note: Optional[str] = None):
+    text = html.escape(entry.name) if note is None else f'{html.escape(entry.name)}<br/>{note}'
     g.node(safe_id(entry.id),
-           f'<{entry.id}<br/><FONT POINT-SIZE="8">{entry.name}</FONT>>', fillcolor=color)
+           f'<{entry.id}<br/><FONT POINT-SIZE="8">{text}</FONT>>', fillcolor=color)
 
 
 def _graph_to_depth(g: Digraph, node: HPOEntry, depth: int):
-    'adds `node` and all children of `node` up to a depth of `depth` to `g`'
+    '''adds `node` and all children of `node` up to a depth of `depth` to `g`.
+    Entries reachable on several paths are added once, as well as each edge'''
     _add_node(g, node)
-    if depth <= 0:
-        return
-    for child in node._children:
-        _graph_to_depth(g, child, depth-1)
-        g.edge(safe_id(node.id), safe_id(child.id))
+    added = {node.id}
+    level = [node]
+    for _ in range(depth):
+        next_level = []
+        for parent in level:
+            for child in parent._children:
+                if child.id not in added:
+                    added.add(child.id)
+                    _add_node(g, child)
+                    next_level.append(child)
+                g.edge(safe_id(parent.id), safe_id(child.id))
+        level = next_level
 
 
-def make_graph_2(hpo: HPO, labevents: Iterable[str], diagnoses: Iterable[str]) -> Digraph:
+def make_graph_2(hpo: Union[HPO, CompactHPO], labevents: Iterable[str], diagnoses: Iterable[str]) -> Digraph:
     'generates a graph displaying the labevents and diagnoses'
-    g = _graph()
-    e: set[str] = set()  # a set to keep track of the nodes added already
-
-    def _add_upwards(node: HPOEntry, color: Optional[str] = None):
-        'adds `node` and all of its parents (if they are not in `e`)'
-        if color:
-            _add_node(g, node, color)
-        else:
-            _add_node(g, node)
-        if node.id not in e:
-            for parent in node._parents:
-                if parent.id not in e:
-                    _add_upwards(parent)
-                g.edge(safe_id(parent.id), safe_id(node.id))
-        e.add(node.id)
-
-    for id in labevents:
-        _add_upwards(hpo.entries_by_id[id], LIGHT_BLUE)
-    for id in diagnoses:
-        _add_upwards(hpo.entries_by_id[id], BASIC_BLUE)
-    return g
+    return patient_graphs(hpo, [labevents], [diagnoses])[0]
+
+
+class Subgraph:
+    '''the part of the HPO made of the features of a cohort of subjects and all their ancestors.
+    The entries are identified by their position in `hpo.ancestor_index.ids`.
+    '''
+
+    def __init__(self, hpo: Union[HPO, CompactHPO], nodes: np.ndarray, subjects: np.ndarray,
+                 cohort_size: int, hidden: dict[int, int]):
+        self.hpo = hpo
+        self.nodes = nodes
+        'the positions of the entries, sorted'
+        self.subjects = subjects
+        'the number of subjects having each entry or one of its descendants'
+        self.cohort_size = cohort_size
+        self.hidden = hidden
+        'the number of collapsed entries below an entry, see `extract_subgraph`'
+
+    @property
+    def ids(self) -> list[str]:
+        ids = self.hpo.ancestor_index.ids
+        return [ids[i] for i in self.nodes.tolist()]
+
+    def edges(self) -> tuple[np.ndarray, np.ndarray]:
+        '''returns the positions of the parents and children of all edges.
+        The parents of an entry are in the subgraph as well, so these are all edges to its entries'''
+        index = self.hpo.ancestor_index
+        children = np.repeat(self.nodes, np.diff(index.parent_indptr)[self.nodes])
+        parents = csr.gather_rows(index.parent_indptr, index.parent_indices, self.nodes)
+        return parents, children
+
+    def to_graph(self, colors: Optional[dict[str, str]] = None) -> Digraph:
+        '''returns the subgraph as graphviz graph, every entry and edge is added once.
+        `colors` maps ids to the color of their nodes, the other nodes are grey.
+        For a cohort of several subjects the number of subjects of each entry is shown.
+        The collapsed entries are shown as dashed node below their closest ancestors.
+        '''
+        colors = colors or {}
+        g = _graph()
+        ids = self.hpo.ancestor_index.ids
+        entries = self.hpo.entries_by_id
+        for i, subjects in zip(self.nodes.tolist(), self.subjects.tolist()):
+            note = f'{subjects} of {self.cohort_size} subjects' if self.cohort_size > 1 else None
+            g.body.append(_node_statement(ids[i], entries[ids[i]].name, colors.get(ids[i], BASIC_GREY), note))
+        g.body.extend(_edge_statement(ids[parent], ids[child])
+                      for parent, child in zip(*(a.tolist() for a in self.edges())))
+        for i, count in sorted(self.hidden.items()):
+            hidden_id = f'{safe_id(ids[i])}_hidden'
+            g.node(hidden_id, f'+{count} rarer', fillcolor='white', color=BASIC_GREY,
+                   style='dashed,rounded', penwidth='1.0')
+            g.edge(safe_id(ids[i]), hidden_id, style='dashed')
+        return g
+
+
+# graphviz quotes the statements slowly, the statements of the patient graphs repeat a lot
+
+@functools.lru_cache(maxsize=2**16)
+def _node_statement(id: str, name: str, color: str, note: Optional[str]) -> str:
+    g = Digraph()
+    _add_node(g, HPOEntry(id, name, {}), color, note)
+    return g.body[0]
+
+
+@functools.lru_cache(maxsize=2**17)
+def _edge_statement(parent: str, child: str) -> str:
+    g = Digraph()
+    g.edge(safe_id(parent), safe_id(child))
+    return g.body[0]
+
+
+def _closure(hpo: Union[HPO, CompactHPO], feature_sets: Iterable[Iterable[str]]) -> tuple[np.ndarray, np.ndarray]:
+    '''the features of each subject and all their ancestors as CSR structure of positions
+    in `hpo.ancestor_index.ids`. The ancestors of all subjects are looked up at once'''
+    index = hpo.ancestor_index
+    indptr, indices = csr.from_lists(
+        [[index.index[hpo.proper_id[id]] for id in features] for features in feature_sets])
+    ancestor_indptr, ancestor_indices = index.union_rows(indptr, indices)
+    return csr.from_pairs(
+        np.concatenate([csr.row_ids(indptr), csr.row_ids(ancestor_indptr)]),
+        np.concatenate([indices, ancestor_indices]), len(indptr) - 1, len(index.ids))
+
+
+def extract_subgraph(hpo: Union[HPO, CompactHPO], feature_sets: Iterable[Iterable[str]],
+                     min_subjects: int = 1) -> Subgraph:
+    '''returns the union of the features of all subjects (a set of ids per subject) and their ancestors.
+
+    Entries of fewer than `min_subjects` subjects are collapsed to keep large graphs readable:
+    they are left out and counted in `Subgraph.hidden` of their closest remaining ancestors.
+    An entry never has more subjects than its ancestors, so whole branches are collapsed.
+    '''
+    indptr, indices = _closure(hpo, feature_sets)
+    index = hpo.ancestor_index
+    subjects = np.bincount(indices, minlength=len(index.ids))
+    kept = subjects >= max(min_subjects, 1)
+    hidden: dict[int, int] = {}
+    for i in np.flatnonzero((subjects > 0) & ~kept).tolist():
+        ancestors = index.ancestor_indices(i)
+        ancestors = ancestors[kept[ancestors]]
+        # the kept ancestors that are not an ancestor of another kept ancestor
+        closest = ancestors[~np.isin(ancestors, index.union(ancestors))]
+        for a in closest.tolist():
+            hidden[a] = hidden.get(a, 0) + 1
+    nodes = np.flatnonzero(kept)
+    return Subgraph(hpo, nodes, subjects[nodes], len(indptr) - 1, hidden)
+
+
+def extract_subgraphs(hpo: Union[HPO, CompactHPO], feature_sets: Iterable[Iterable[str]]) -> list[Subgraph]:
+    'returns the `Subgraph` of each subject (a set of ids per subject), in one pass over the ancestors'
+    indptr, indices = _closure(hpo, feature_sets)
+    return [Subgraph(hpo, indices[indptr[i]:indptr[i + 1]], np.ones(indptr[i + 1] - indptr[i], dtype=np.int64), 1, {})
+            for i in range(len(indptr) - 1)]
+
+
+def patient_graphs(hpo: Union[HPO, CompactHPO], labevents: Iterable[Iterable[str]],
+                   diagnoses: Iterable[Iterable[str]]) -> list[Digraph]:
+    'generates the graphs of `make_graph_2` for many subjects (a set of ids per subject)'
+    labevents = [[hpo.proper_id[id] for id in ids] for ids in labevents]
+    diagnoses = [[hpo.proper_id[id] for id in ids] for ids in diagnoses]
+    assert len(labevents) == len(diagnoses), 'there must be labevents and diagnoses for each subject'
+    graphs = []
+    for subgraph, subject_labevents, subject_diagnoses in zip(
+            extract_subgraphs(hpo, [l + d for l, d in zip(labevents, diagnoses)]), labevents, diagnoses):
+        colors = {id: LIGHT_BLUE for id in subject_labevents}
+        colors.update({id: BASIC_BLUE for id in subject_diagnoses})
+        graphs.append(subgraph.to_graph(colors))
+    return graphs
+
+
+def render_graphs(graphs: dict[str, Digraph], directory: str, format: str = 'svg',
+                  workers: Optional[int] = None) -> list[str]:
+    '''renders the `graphs` to `<directory>/<name>.<format>` (e.g. `svg` or `png`) and returns the paths.
+
+    Each graph is laid out by its own graphviz process, `workers` of them run in parallel
+    (by default one per core).
+    '''
+    os.makedirs(directory, exist_ok=True)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    paths = [os.path.join(directory, f'{name}.{format}') for name in graphs]
+    sources = [g.source for g in graphs.values()]
+    # the threads only wait for the graphviz processes
+    with ThreadPoolExecutor(workers) as executor:
+        for _ in tqdm.tqdm(executor.map(_render, sources, paths, [format] * len(paths)),
+                           total=len(paths), unit='graph'):
+            pass
+    return paths
+
+
+def _render(source: str, path: str, format: str):
+    data = graphviz.pipe('dot', format, source.encode())
+    with open(path, 'wb') as f:
+        f.write(data)